@@ -18,15 +18,483 @@ Ensure they share a folder with the script."""
 
 import pygame # Used for playing audio files.
 import json # Used to load database.
+import os # Used for atomic file replacement and syncing writes to disk.
+import threading # Used to compact the database in the background.
+import sqlite3 # Used for the SQLite storage backend.
+import random # Used to keep the position tree balanced.
+import re # Used to split text into words for searching.
+import bisect # Used to look up words by prefix.
+import collections # Used to count matching trigrams.
+import collections.abc # Used to make columns of songs look like a dictionary.
+import heapq # Used to pick the best search results.
+import itertools # Used to walk the sorted word list.
+import io # Used to play tracks that were read into memory ahead of time.
+import concurrent.futures # Used to read the next track on a worker thread.
+import multiprocessing # Used to start feature extraction workers from scratch.
+import queue # Used to send commands to the playback thread.
+import hashlib # Used to recognise analysed tracks by their contents.
+import marshal # Used for the binary copy of the library that is read at startup.
+import sys # Used to share repeated strings between tracks.
+import array # Used for the columns of the columnar song store.
+import time # Used to record when tracks started playing.
+import asyncio # Used for the control server.
+import functools # Used to time library methods without changing their bodies.
+import cProfile # Used to profile the player while it runs.
+import pstats # Used to combine and print profiles.
+import mmap # Used to hand decoded tracks to pygame without reading them into Python first.
 
-pygame.mixer.init() # Initializes pygame.
+try:
+    import mutagen # Used to read ID3 and Vorbis tags when importing a folder, optional.
+except ImportError:
+    mutagen = None
+
+try:
+    import numpy # Used for loudness analysis and radio, optional.
+except ImportError:
+    numpy = None
+
+STORAGE_BACKEND = 'json' # Either 'json' or 'sqlite', large libraries start faster with 'sqlite'.
+DATABASE_FILE = 'music_database.json' # Full snapshot of the library.
+JOURNAL_FILE = 'music_database.journal' # Changes made since the last snapshot, one per line.
+LIBRARY_CACHE_FILE = 'music_database.cache' # Binary copy of the .json snapshot, read instead of it while it is current.
+LIBRARY_CACHE_FORMAT = 2 # Changed whenever the layout of the binary copy changes.
+SQLITE_FILE = 'music_database.sqlite3' # Used instead of the .json file when STORAGE_BACKEND is 'sqlite'.
+COMPACT_AFTER = 500 # Number of journal entries before the snapshot is rewritten.
+PREFETCH_TRACKS = 3 # Number of tracks kept in memory ahead of playback.
+PLAYBACK_POLL_INTERVAL = 0.05 # Seconds the playback thread waits for a command before checking for finished tracks.
+TRACK_END = pygame.USEREVENT + 1 # Event pygame posts when a track finishes.
+SCAN_CACHE_FILE = 'scan_cache.json' # Tags of imported files, so scanning a folder again only reads changed files.
+AUDIO_EXTENSIONS = ('.mp3', '.ogg', '.flac', '.wav', '.m4a', '.opus') # Files picked up by Import Folder.
+LOUDNESS_CACHE_FILE = 'loudness_cache.json' # Loudness of analysed tracks, by file hash.
+LOUDNESS_TARGET = -18.0 # Loudness (LUFS) tracks are turned down to.
+FEATURE_CACHE_FILE = 'feature_cache.json' # Sound features of analysed tracks, by file hash, compared by radio.
+FEATURE_EXCERPT = 60 # Seconds from the middle of a track its sound features are taken from.
+FEATURE_SAVE_INTERVAL = 60 # Seconds between saves while features are extracted, so stopping early keeps most of them.
+RADIO_CHOICES = 5 # Radio picks the next track at random among this many of the most alike ones.
+RADIO_RECENT = 50 # Tracks radio played last, which it does not pick again.
+COLUMNAR_SONGS_AFTER = 250000 # Libraries with more album songs than this keep them in columns instead of objects.
+PLAY_QUEUE_FILE = 'play_queue.json' # Play queue, so it can be picked up again after a restart.
+HISTORY_FILE = 'play_history.sqlite3' # Every play and skip, with play counts kept up to date alongside.
+HISTORY_BATCH_SIZE = 5000 # Most events the history writer saves in one transaction.
+DECODE_CACHE = False # True keeps the most played tracks decoded on disk so they start in milliseconds.
+DECODE_CACHE_FOLDER = 'decode_cache' # Where decoded tracks are kept.
+DECODE_CACHE_LIMIT = 2 << 30 # Bytes of decoded tracks kept before the least recently played are deleted.
+DECODE_CACHE_TRACKS = 50 # Number of most played tracks the cache tries to hold.
+DECODE_CACHE_REFRESH = 10 # Plays between checks of which tracks are played most.
+# Folders searched in order for tracks, file names that are full paths are used as they are. The script's own folder
+# by default, wherever the program is started from.
+MUSIC_ROOTS = [os.path.dirname(os.path.abspath(__file__))]
+PATH_CACHE_FILE = 'path_cache.json' # Folder listings from the last check, reused while a folder is unchanged.
+PATH_CHECK_THREADS = 16 # Folders checked at the same time, which helps most on network drives.
+PAGE_SIZE = 20 # Albums, songs or singles shown at a time in the menus.
+SEARCH_PREFIX_WORDS = 100 # Most words a search word can stand for as a prefix, so short prefixes stay fast.
+CONTROL_HOST = '127.0.0.1' # The control server only accepts connections from this computer.
+CONTROL_PORT = 7654 # Port of the control server started with --serve.
+CONTROL_BUFFER_LIMIT = 1 << 20 # Bytes of unsent events a client may fall behind by before it is disconnected.
+METRICS_FILE = 'metrics.json' # Timings and counters saved from the Statistics menu, for other programs to read.
+PROFILE_FILE = 'profile.pstats' # Profile saved when profiling is turned off, open it with pstats or snakeviz.
+
+# Handed out by Metrics while it is turned off, so timed code only pays for one check.
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = NoSpan()
+
+# Times a block of code and records it when the block ends, even if it raised.
+class Span:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.started)
+        return False
+
+# Timings of slow operations and counts of things that happened, kept while turned on.
+# Menus, the playback thread and the control server all record into the one shared instance.
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.timings = {} # Name -> [times run, total seconds, longest seconds].
+        self.counters = collections.Counter()
+        self.profiling = False
+        self.profilers = {} # Thread id -> cProfile.Profile, cProfile only follows the thread that started it.
+
+    # Context manager that times a block of code.
+    def span(self, name):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    def count(self, name, amount = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += amount
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    # Timings and counters as plain data, times are in milliseconds.
+    def snapshot(self):
+        with self.lock:
+            timings = {name: {'count': count, 'total_ms': round(total * 1000, 3),
+                              'mean_ms': round(total / count * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+                       for name, (count, total, longest) in sorted(self.timings.items())}
+            counters = dict(sorted(self.counters.items()))
+        return {'enabled': self.enabled, 'profiling': self.profiling, 'timings': timings, 'counters': counters}
+
+    # Prints timings, slowest total first, then counters.
+    def report(self):
+        snapshot = self.snapshot()
+        print('\nMetrics are ' + ('on.' if self.enabled else 'off.') +
+              (' Profiling is on.' if self.profiling else ''))
+        if snapshot['timings']:
+            print(f'\n\t{"Operation":<24}{"Count":>8}{"Total ms":>12}{"Mean ms":>10}{"Max ms":>10}')
+            for name, timing in sorted(snapshot['timings'].items(), key = lambda item: -item[1]['total_ms']):
+                print(f'\t{name:<24}{timing["count"]:>8}{timing["total_ms"]:>12.1f}'
+                      f'{timing["mean_ms"]:>10.2f}{timing["max_ms"]:>10.2f}')
+        for name, count in snapshot['counters'].items():
+            print(f'\t{name}: {count}')
+        if not snapshot['timings'] and not snapshot['counters']:
+            print('\nNothing has been recorded yet.')
+
+    # Writes timings and counters to a JSON file.
+    def dump(self, path = METRICS_FILE):
+        write_database(path, self.snapshot())
+
+    # Starts profiling the calling thread, other threads join in through profiled().
+    def start_profiling(self):
+        with self.lock:
+            self.profiling = True
+        self.thread_profiler().enable()
+
+    # Runs a function under the calling thread's profiler while profiling is on.
+    def profiled(self, function, *args):
+        if not self.profiling:
+            return function(*args)
+        return self.thread_profiler().runcall(function, *args)
+
+    def thread_profiler(self):
+        with self.lock:
+            profiler = self.profilers.get(threading.get_ident())
+            if profiler is None:
+                profiler = self.profilers[threading.get_ident()] = cProfile.Profile()
+            return profiler
+
+    # Stops profiling, saves the combined profile and prints where the most time went.
+    def stop_profiling(self, path = PROFILE_FILE, lines = 15):
+        profiler = self.profilers.get(threading.get_ident())
+        if profiler is not None:
+            profiler.disable()
+        with self.lock:
+            self.profiling = False
+            profilers, self.profilers = list(self.profilers.values()), {}
+        stats = None
+        for profiler in profilers:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError: # A profiler that never ran anything has no stats.
+                continue
+        if stats is None:
+            print('\nNothing was profiled.')
+            return
+        stats.dump_stats(path)
+        print(f'\nProfile saved to {path}.')
+        stats.sort_stats('cumulative').print_stats(lines)
+
+metrics = Metrics() # Shared by everything that records timings or counts.
+
+# Decorator that times every call of a function while metrics are on.
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with Span(metrics, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# One entry in a PositionalView.
+class PositionNode:
+    __slots__ = ('key', 'priority', 'size', 'left', 'right', 'parent')
+
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+# Size of a subtree, empty subtrees have a size of 0.
+def subtree_size(node):
+    return node.size if node is not None else 0
+
+# Keeps the display order of the keys in a dictionary so keys never have to be renumbered.
+# It is a randomly balanced tree where each node knows the size of its subtree, so finding the position of a key,
+# the key at a position, inserting at a position and removing a key all take O(log n). Positions start at 1.
+class PositionalView:
+    def __init__(self, keys = ()):
+        self.nodes = {}
+        self.root = self.build(list(keys))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __iter__(self):
+        return self.keys_from(1)
+
+    # Builds a balanced tree from keys that are already in order in O(n).
+    def build(self, keys):
+        if not keys:
+            return None
+        nodes = [PositionNode(key, 0.0) for key in keys]
+        for node in nodes:
+            self.nodes[node.key] = node
+
+        # Links each middle node to the middles of its two halves.
+        visited = []
+        pending = [(0, len(nodes), None, True)]
+        while pending:
+            start, stop, parent, is_left = pending.pop()
+            middle = (start + stop) // 2
+            node = nodes[middle]
+            node.size = stop - start
+            node.parent = parent
+            if parent is not None:
+                if is_left:
+                    parent.left = node
+                else:
+                    parent.right = node
+            visited.append(node)
+            if start < middle:
+                pending.append((start, middle, node, True))
+            if middle + 1 < stop:
+                pending.append((middle + 1, stop, node, False))
+
+        # Parents are visited before their children, so handing out priorities in falling order keeps the heap order.
+        priorities = sorted((random.random() for _ in nodes), reverse = True)
+        for node, priority in zip(visited, priorities):
+            node.priority = priority
+        return visited[0]
+
+    # Splits a subtree into its first count nodes and the rest.
+    def split(self, node, count):
+        if node is None:
+            return None, None
+        if count <= subtree_size(node.left):
+            left, right = self.split(node.left, count)
+            node.left = right
+            if right is not None:
+                right.parent = node
+            node.size = subtree_size(node.left) + subtree_size(node.right) + 1
+            return left, node
+        left, right = self.split(node.right, count - subtree_size(node.left) - 1)
+        node.right = left
+        if left is not None:
+            left.parent = node
+        node.size = subtree_size(node.left) + subtree_size(node.right) + 1
+        return node, right
+
+    # Joins two subtrees, every node of the first one comes before the second one.
+    def merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            left.right.parent = left
+            left.size = subtree_size(left.left) + subtree_size(left.right) + 1
+            return left
+        right.left = self.merge(left, right.left)
+        right.left.parent = right
+        right.size = subtree_size(right.left) + subtree_size(right.right) + 1
+        return right
+
+    # Sets the root after a change and detaches it from its old parent.
+    def set_root(self, node):
+        if node is not None:
+            node.parent = None
+        self.root = node
+
+    # Puts a key at a position, keys at and after that position move down by one.
+    def insert_at(self, position, key):
+        position = min(max(position, 1), len(self.nodes) + 1)
+        node = PositionNode(key, random.random())
+        self.nodes[key] = node
+        left, right = self.split(self.root, position - 1)
+        self.set_root(self.merge(self.merge(left, node), right))
+
+    # Puts a key after every other key.
+    def append(self, key):
+        self.insert_at(len(self.nodes) + 1, key)
+
+    # Takes a key out, keys after it move up by one.
+    def remove(self, key):
+        position = self.position(key)
+        del self.nodes[key]
+        left, right = self.split(self.root, position - 1)
+        middle, right = self.split(right, 1)
+        self.set_root(self.merge(left, right))
+
+    # Moves a key to a new position.
+    def move(self, key, position):
+        self.remove(key)
+        self.insert_at(position, key)
+
+    # Position of a key, counted by walking up to the root.
+    def position(self, key):
+        node = self.nodes[key]
+        position = subtree_size(node.left) + 1
+        while node.parent is not None:
+            if node is node.parent.right:
+                position += subtree_size(node.parent.left) + 1
+            node = node.parent
+        return position
+
+    # Key at a position.
+    def key_at(self, position):
+        if not 1 <= position <= len(self.nodes):
+            raise IndexError(f'Position {position} is out of range.')
+        node = self.root
+        while True:
+            left_size = subtree_size(node.left)
+            if position <= left_size:
+                node = node.left
+            elif position == left_size + 1:
+                return node.key
+            else:
+                position -= left_size + 1
+                node = node.right
+
+    # Iterates over keys in order starting at a position, without visiting the keys before it.
+    def keys_from(self, position):
+        stack = []
+        node = self.root
+        while node is not None:
+            left_size = subtree_size(node.left)
+            if position <= left_size:
+                stack.append(node)
+                node = node.left
+            elif position == left_size + 1:
+                stack.append(node)
+                break
+            else:
+                position -= left_size + 1
+                node = node.right
+
+        while stack:
+            node = stack.pop()
+            yield node.key
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+# Keeps track of which music items are in a dictionary, the order they are shown in and the next free integer key.
+# Lets the library check for duplicates and pick a key without scanning the dictionary. Keys are never reused,
+# so a key keeps pointing at the same music item for as long as it is in the library.
+class IdentityIndex:
+    def __init__(self):
+        self.identities = {} # Identity -> key, None until it is first needed after a rebuild.
+        self.music_dict = None # Dictionary the identities are worked out from when they are first needed.
+        self.positions = PositionalView()
+        self.next_key = 1
+
+    # Identity -> key. Worked out from the dictionary the first time a duplicate check needs it, so loading a large
+    # library does not hold a tuple of strings for every track it is never asked about.
+    def known_identities(self):
+        if self.identities is None:
+            self.identities = {music_item.identity(): key for key, music_item in self.music_dict.items()}
+            self.music_dict = None
+        return self.identities
+
+    def __contains__(self, music_item):
+        return music_item.identity() in self.known_identities()
+
+    # Key of the music item with the same identity, or None.
+    def key_of(self, music_item):
+        return self.known_identities().get(music_item.identity())
+
+    # Records a new music item and hands back the key it should be stored under.
+    # While the identities have not been worked out, the dictionary the item is stored in already covers it.
+    def add(self, music_item):
+        key = self.next_key
+        if self.identities is not None:
+            self.identities[music_item.identity()] = key
+        self.next_key += 1
+        self.positions.append(key)
+        return key
+
+    # Records a music item under a key that was already chosen, used when loading or replaying the journal.
+    def claim(self, music_item, key):
+        if self.identities is not None:
+            self.identities[music_item.identity()] = key
+        self.next_key = max(self.next_key, key + 1)
+        self.positions.append(key)
+
+    def discard(self, music_item, key):
+        if self.identities is not None:
+            self.identities.pop(music_item.identity(), None)
+        self.positions.remove(key)
+
+    # Builds the index again from an existing dictionary, used when the dictionary is replaced.
+    def rebuild(self, music_dict, next_key = 1):
+        self.identities = None
+        self.music_dict = music_dict
+        self.positions = PositionalView(music_dict.keys())
+        self.next_key = max(max(music_dict.keys(), default=0) + 1, next_key)
+
+# Keeps one copy of strings that repeat across many tracks, like artists, album names and release dates.
+def shared(text):
+    return sys.intern(text) if type(text) is str else text
+
+# Fields every music item has, declared in the __slots__ of each kind of music item that stores them itself.
+MUSIC_ITEM_FIELDS = ('name', 'artist', 'release_date', 'is_playing')
 
 # Parent class of all objects music related.
+# Music items use __slots__ so each one is a small fixed record instead of carrying its own dictionary. The fields
+# are declared by the classes that store them, so SongView shares these methods without carrying empty fields.
 class MusicItem:
+    __slots__ = ()
+
     def __init__(self, name, artist, release_date, is_playing = False):
         self.name = name
-        self.artist = artist
-        self.release_date = release_date
+        self.artist = shared(artist)
+        self.release_date = shared(release_date)
         self.is_playing = is_playing
 
     # Formats as string.
@@ -34,6 +502,23 @@ class MusicItem:
         formatted_line = f'{self.name}: {self.artist} ({self.release_date})'
         return formatted_line
 
+    # Fields that make two music items the same item, used for duplicate detection.
+    def identity(self):
+        return (self.name, self.artist, self.release_date)
+
+    # Music items with the same identity are treated as duplicates.
+    def __eq__(self, other):
+        if not isinstance(other, MusicItem):
+            return NotImplemented
+        return self.identity() == other.identity()
+
+    def __hash__(self):
+        return hash(self.identity())
+
+    # Kind of music item, saved with it as music_item_type.
+    def kind(self):
+        return self.__class__.__name__
+
     # Retrieves data from .json file.
     @classmethod
     def from_json(cls, data):
@@ -49,14 +534,33 @@ class MusicItem:
             'name': self.name,
             'artist': self.artist,
             'release_date': self.release_date,
-            'music_item_type': self.__class__.__name__
+            'music_item_type': self.kind()
         }
 
+# Songs and singles, whether they are Song objects or SongView rows of SongColumns.
+class Track(MusicItem):
+    __slots__ = ()
+
+    # A song is the same song if it has the same name, artist and file.
+    def identity(self):
+        return (self.name, self.artist, self.file_name)
+
+    # Writes song data to .json file.
+    def to_json(self):
+        data = super().to_json()
+        data.update({
+            'album': self.album,
+            'file_name': self.file_name
+        })
+        return data
+
 # Stored as a dictionary inside an album.
-class Song(MusicItem):
+class Song(Track):
+    __slots__ = MUSIC_ITEM_FIELDS + ('album', 'file_name')
+
     def __init__(self, name, artist, release_date, album, file_name, is_playing = False):
         super().__init__(name, artist, release_date, is_playing = False)
-        self.album = album
+        self.album = shared(album)
         self.file_name = file_name
 
     # Retrieves song data from .json file.
@@ -70,285 +574,3236 @@ class Song(MusicItem):
             file_name = data.get('file_name')
         )
 
-    # Writes song data to .json file.
-    def to_json(self):
-        data = super().to_json()
-        data.update({
-            'album': self.album,
-            'file_name': self.file_name
-        })
-        return data
+# Stored within the music library.
+class Single(Song):
+    __slots__ = ()
+
+    def __init__(self, name, artist, release_date, file_name):
+        super().__init__(name, artist, release_date, album = 'Single', file_name = file_name)
+
+    # Retrieves single data from .json file, singles have no album.
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            name = data.get('name'),
+            artist = data.get('artist'),
+            release_date = data.get('release_date'),
+            file_name = data.get('file_name')
+        )
+
+# Stored within music library, contains songs.
+class Album(MusicItem):
+    __slots__ = MUSIC_ITEM_FIELDS + ('_songs', 'song_loader', 'identity_index')
+
+    def __init__(self, name, artist, release_date, is_playing = False):
+        super().__init__(name, artist, release_date, is_playing = False)
+        self._songs = {}
+        self.song_loader = None # Set by storage backends that read songs only when the album is opened.
+        self.identity_index = IdentityIndex() # Tracks songs already in the album.
+
+    # Songs in the album, read from storage the first time they are needed.
+    @property
+    def songs(self):
+        if self.song_loader is not None:
+            song_loader = self.song_loader
+            self.song_loader = None
+            self._songs = song_loader(self)
+            self.identity_index.rebuild(self._songs, self.identity_index.next_key)
+        return self._songs
+
+    @songs.setter
+    def songs(self, songs):
+        self.song_loader = None
+        self._songs = songs
+
+    # Songs in the album if they have been loaded already, without reading them from storage.
+    def loaded_songs(self):
+        if self.song_loader is not None:
+            return {}
+        return self._songs
+
+    def __str__(self):
+        formatted_line = f'{self.name}: {self.artist} ({self.release_date})'
+        return formatted_line
+
+
+    # Retrieves and stores album data from .json file.
+    @classmethod
+    def from_json(cls, data):
+        songs = {}
+        for index, song_data in data.get('songs', {}).items():
+            music_type = song_data.get('music_item_type','Song')
+            if music_type == 'Single':
+                songs[int(index)] = Single.from_json(song_data)
+            else:
+                songs[int(index)] = Song.from_json(song_data)
+
+        album = cls(
+            name = data.get('name'),
+            artist = data.get('artist'),
+            release_date = data.get('release_date')
+        )
+
+        album.songs = songs
+        album.identity_index.rebuild(songs, data.get('next_song_key', 1))
+        return album
+
+    # Writes album data to .json file.
+    def to_json(self):
+        data = super().to_json()
+        data.update({
+            'songs': {index: self.songs[index].to_json() for index in self.identity_index.positions},
+            'next_song_key': self.identity_index.next_key
+        })
+        return data
+
+# Creates the right kind of music item from its .json data.
+def music_item_from_json(data):
+    music_types = {
+        'Album': Album,
+        'Song': Song,
+        'Single': Single
+    }
+    return music_types.get(data.get('music_item_type'), Song).from_json(data)
+
+# Text that is different for every track, like names and file names, stored end to end as UTF-8.
+class TextColumn:
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array.array('Q') # Where each row's text ends in data.
+        self.missing = set() # Rows whose value is None.
+
+    def append(self, text):
+        if text is None:
+            self.missing.add(len(self.ends))
+        else:
+            self.data += text.encode('utf-8')
+        self.ends.append(len(self.data))
+
+    def __getitem__(self, row):
+        if row in self.missing:
+            return None
+        start = self.ends[row - 1] if row else 0
+        return self.data[start:self.ends[row]].decode('utf-8')
+
+# The rows of song fields behind SongColumns. Compacting the columns copies the rows still in use into a new SongRows,
+# songs handed out before keep reading the rows they were made from.
+class SongRows:
+    def __init__(self, strings):
+        self.strings = strings # String table, shared with the SongRows before and after this one.
+        self.names = TextColumn()
+        self.file_names = TextColumn()
+        self.artists = array.array('I')
+        self.release_dates = array.array('I')
+        self.albums = array.array('I')
+        self.singles = bytearray() # 1 for singles that were stored inside an album.
+        self.playing = bytearray()
+
+    def __len__(self):
+        return len(self.playing)
+
+    # Adds a row, with repeated text given by its number in the string table, and returns it.
+    def append(self, name, file_name, artist_id, release_date_id, album_id, single = 0, playing = 0):
+        self.names.append(name)
+        self.file_names.append(file_name)
+        self.artists.append(artist_id)
+        self.release_dates.append(release_date_id)
+        self.albums.append(album_id)
+        self.singles.append(single)
+        self.playing.append(playing)
+        return len(self.playing) - 1
+
+    # Adds a copy of a row of another SongRows and returns it.
+    def copy_row(self, other, row):
+        return self.append(other.names[row], other.file_names[row], other.artists[row], other.release_dates[row],
+                           other.albums[row], other.singles[row], other.playing[row])
+
+# Songs of a large library kept in columns instead of one object each. Text that repeats, like artists, albums and
+# release dates, is stored once in a string table and referred to by number. Songs are handed out as SongView objects
+# made when they are asked for. Deleted and replaced songs leave their rows unused until more than half of the rows
+# are unused, then the rows still in use are copied into new columns and the old ones are freed.
+class SongColumns:
+    def __init__(self):
+        self.strings = [] # String table.
+        self.string_ids = {} # String -> its number in the string table.
+        self.rows = SongRows(self.strings)
+        self.unused = 0 # Rows no song uses any more.
+
+    # Number of a string in the string table, adding it the first time it is seen.
+    def string_id(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    # Adds a song from its fields and returns its row.
+    def append_row(self, name, artist, release_date, album, file_name, is_single = False):
+        return self.rows.append(name, file_name, self.string_id(artist), self.string_id(release_date),
+                                self.string_id(album), 1 if is_single else 0)
+
+    # Adds a song object and returns its row.
+    def append(self, song):
+        return self.append_row(song.name, song.artist, song.release_date, song.album, song.file_name,
+                               song.kind() == 'Single')
+
+    # Counts rows that are no longer used.
+    def release(self, count = 1):
+        self.unused += count
+
+    # Whether more than half of the rows are no longer used.
+    def needs_compacting(self):
+        return self.unused > len(self.rows) // 2
+
+    # Copies the rows of the given ColumnSongs into new columns and moves them over, the other rows are freed.
+    @timed('compact_song_columns')
+    def compact(self, column_songs):
+        rows = SongRows(self.strings)
+        for songs in column_songs:
+            old_rows, keys = songs.table
+            songs.table = (rows, {key: rows.copy_row(old_rows, row) for key, row in keys.items()})
+        self.rows = rows
+        self.unused = 0
+
+# A song stored in SongColumns. It behaves like a Song but only holds its row, the fields are read from the columns.
+class SongView(Track):
+    __slots__ = ('columns', 'row')
+
+    def __init__(self, columns, row):
+        self.columns = columns
+        self.row = row
+
+    @property
+    def name(self):
+        return self.columns.names[self.row]
+
+    @property
+    def artist(self):
+        return self.columns.strings[self.columns.artists[self.row]]
+
+    @property
+    def release_date(self):
+        return self.columns.strings[self.columns.release_dates[self.row]]
+
+    @property
+    def album(self):
+        return self.columns.strings[self.columns.albums[self.row]]
+
+    @property
+    def file_name(self):
+        return self.columns.file_names[self.row]
+
+    @property
+    def is_playing(self):
+        return bool(self.columns.playing[self.row])
+
+    @is_playing.setter
+    def is_playing(self, is_playing):
+        self.columns.playing[self.row] = 1 if is_playing else 0
+
+    def kind(self):
+        return 'Single' if self.columns.singles[self.row] else 'Song'
+
+# Songs of one album kept in SongColumns, used in place of the album's song dictionary.
+class ColumnSongs(collections.abc.MutableMapping):
+    def __init__(self, columns):
+        self.columns = columns
+        self.table = (columns.rows, {}) # The SongRows the songs are in and key -> row, replaced together.
+
+    @property
+    def rows(self):
+        return self.table[1]
+
+    def __getitem__(self, key):
+        song_rows, rows = self.table
+        return SongView(song_rows, rows[key])
+
+    def __setitem__(self, key, song):
+        replaced = key in self.rows
+        self.rows[key] = self.columns.append(song)
+        if replaced:
+            self.columns.release()
+
+    def __delitem__(self, key):
+        del self.rows[key]
+        self.columns.release()
+
+    # Lets go of the rows of a deleted album. Its songs can still be read until it is gone, the rows are left out
+    # when the columns are next compacted.
+    def release(self):
+        self.columns.release(len(self.rows))
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+# Splits text into lowercase words for searching.
+def search_tokens(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+# Three letter pieces of a word, used to find words that are spelled slightly differently.
+def trigrams(token):
+    padded = f'  {token} '
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+# Finds music items by name, artist and album. Words are kept in a sorted list for prefix matching and broken into
+# trigrams for fuzzy matching. Music items are added and removed one at a time as the library changes, so the index
+# only has to be built once. While it is first built the sorted list and trigrams are left out, they are made in one
+# go at the end instead of word by word.
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock() # The index is built on a background thread while the menus change the library.
+        self.postings = {} # Word -> references of the music items that contain it.
+        self.sorted_tokens = None # Every word, kept sorted for prefix lookups once finish has made it.
+        self.trigram_tokens = None # Trigram -> words that contain it, made along with the sorted list.
+        self.entries = {} # Reference -> (words, text shown in results).
+        self.album_songs = {} # Album key -> references of its songs, so deleting an album removes them too.
+
+    # Indexes one music item. A reference is ('album', album key, None), ('song', album key, song key)
+    # or ('single', None, single key).
+    def add(self, reference, name, artist, album = None):
+        tokens = set(search_tokens(name)) | set(search_tokens(artist)) | set(search_tokens(album))
+        with self.lock:
+            if reference in self.entries:
+                self.remove_entry(reference)
+            self.entries[reference] = tokens
+            if reference[0] == 'song':
+                self.album_songs.setdefault(reference[1], set()).add(reference)
+
+            for token in tokens:
+                references = self.postings.get(token)
+                if references is None: # First time this word is seen.
+                    references = self.postings[token] = set()
+                    if self.sorted_tokens is not None:
+                        bisect.insort(self.sorted_tokens, token)
+                        for trigram in trigrams(token):
+                            self.trigram_tokens.setdefault(trigram, set()).add(token)
+                references.add(reference)
+
+    # Takes a music item out of the index, and an album's songs along with the album.
+    def remove(self, reference):
+        with self.lock:
+            self.remove_entry(reference)
+
+    def remove_entry(self, reference):
+        if reference[0] == 'album':
+            for song_reference in self.album_songs.pop(reference[1], set()):
+                self.remove_entry(song_reference)
+        elif reference[0] == 'song':
+            self.album_songs.get(reference[1], set()).discard(reference)
+
+        for token in self.entries.pop(reference, ()):
+            references = self.postings[token]
+            references.discard(reference)
+            if not references: # Last music item with this word.
+                del self.postings[token]
+                if self.sorted_tokens is not None:
+                    del self.sorted_tokens[bisect.bisect_left(self.sorted_tokens, token)]
+                    for trigram in trigrams(token):
+                        self.trigram_tokens[trigram].discard(token)
+                        if not self.trigram_tokens[trigram]:
+                            del self.trigram_tokens[trigram]
+
+    # Makes the sorted word list and the trigrams once every music item has been added.
+    def finish(self):
+        with self.lock:
+            if self.sorted_tokens is not None:
+                return
+            trigram_tokens = {}
+            for token in self.postings:
+                for trigram in trigrams(token):
+                    trigram_tokens.setdefault(trigram, set()).add(token)
+            self.trigram_tokens = trigram_tokens
+            self.sorted_tokens = sorted(self.postings)
+
+    # Words a query word matches with their scores, best first: the word itself, then up to SEARCH_PREFIX_WORDS
+    # words it starts, or when nothing starts with it, words sharing enough trigrams with it.
+    def expand(self, query_token):
+        start = bisect.bisect_left(self.sorted_tokens, query_token)
+        matches = []
+        for token in self.sorted_tokens[start:start + SEARCH_PREFIX_WORDS]:
+            if not token.startswith(query_token):
+                break
+            matches.append((token, 3.0 if token == query_token else 2.0)) # The word itself sorts first.
+        if matches:
+            return matches
+
+        query_trigrams = trigrams(query_token)
+        shared = collections.Counter()
+        for trigram in query_trigrams:
+            shared.update(self.trigram_tokens.get(trigram, ()))
+        for token, count in shared.items():
+            similarity = count / max(len(query_trigrams), len(trigrams(token)))
+            if similarity >= 0.4:
+                matches.append((token, similarity))
+        matches.sort(key = lambda match: match[1], reverse = True)
+        return matches
+
+    # Score of a music item's words for one query word, 0 if none of them match. Fuzzy scores are only used for query
+    # words that no word starts with, the same as expand.
+    @staticmethod
+    def word_score(query_token, fuzzy, tokens):
+        if query_token in tokens:
+            return 3.0
+        if fuzzy is None:
+            return 2.0 if any(token.startswith(query_token) for token in tokens) else 0
+        return max((fuzzy.get(token, 0) for token in tokens), default = 0)
+
+    # Returns references of the best matches, every word of the query has to match. Candidates only come from the
+    # query word that matches the fewest music items, the other words are checked against each candidate's own words.
+    # Candidates are taken best first and only the best limit are kept, so once those cannot be beaten the search
+    # stops without looking at the rest.
+    def search(self, query, limit = 20):
+        query_tokens = set(search_tokens(query))
+        if not query_tokens:
+            return []
+        self.finish() # Only does anything if the index was built without finishing.
+
+        with self.lock:
+            matches = {query_token: self.expand(query_token) for query_token in query_tokens}
+            if not all(matches.values()):
+                return []
+            rarest = min(query_tokens, key = lambda query_token: sum(len(self.postings[token])
+                                                                     for token, score in matches[query_token]))
+            others = [(query_token, dict(matches[query_token]) if matches[query_token][0][1] < 2.0 else None)
+                      for query_token in query_tokens if query_token != rarest]
+            best_others = sum(matches[query_token][0][1] for query_token, fuzzy in others)
+
+            best = [] # Heap of (score, -order found, reference), the worst kept result on top.
+            seen = set()
+            for token, score in matches[rarest]:
+                if len(best) == limit and best[0][0] >= score + best_others:
+                    break # Nothing left can beat the results already found.
+                for reference in self.postings[token]:
+                    if len(best) == limit and best[0][0] >= score + best_others:
+                        break
+                    if reference in seen: # A music item with several words this query word matches.
+                        continue
+                    seen.add(reference)
+                    total = score
+                    tokens = self.entries[reference]
+                    for query_token, fuzzy in others:
+                        word_score = self.word_score(query_token, fuzzy, tokens)
+                        if not word_score:
+                            break
+                        total += word_score
+                    else:
+                        result = (total, -len(seen), reference)
+                        if len(best) < limit:
+                            heapq.heappush(best, result)
+                        else:
+                            heapq.heappushpop(best, result)
+            return [reference for score, order, reference in sorted(best, reverse = True)]
+
+# Initializes pygame's mixer the first time something is played, so loading the script does not open the sound device.
+def init_mixer():
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+
+# Checks whether a track is playing, streamed or from the decode cache, without starting the mixer just to ask.
+def music_busy():
+    return bool(pygame.mixer.get_init()) and (pygame.mixer.music.get_busy() or pygame.mixer.get_busy())
+
+# Stops whatever track is playing, streamed or from the decode cache.
+def stop_output():
+    pygame.mixer.music.stop()
+    pygame.mixer.stop()
+
+# Reads upcoming album tracks into memory on a worker thread while the current one plays. The next track is queued
+# in pygame as soon as it has been read so albums play without a gap, and skipping loads it from memory instead of
+# waiting on the disk.
+class TrackPrefetcher:
+    def __init__(self):
+        self.executor = None # Worker thread, started the first time something is prefetched.
+        self.reads = {} # File name -> Future holding the file's bytes.
+        self.lock = threading.Lock()
+        self.generation = 0 # Changes whenever playback moves on, so late reads are not queued for the wrong track.
+        self.playing_buffer = None # pygame reads from these while they play, so they are kept alive here.
+        self.queued_buffer = None
+        self.gapless = True # Queues the next track in pygame, turned off when track ends cannot be detected.
+
+    # Reads a whole audio file.
+    @staticmethod
+    def read_file(file_name):
+        with open(file_name, 'rb') as reader:
+            return reader.read()
+
+    # Starts reading a file in the background, unless it is already being read.
+    def prefetch(self, file_name):
+        with self.lock:
+            future = self.reads.get(file_name)
+            if future is None:
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+                future = self.reads[file_name] = self.executor.submit(self.read_file, file_name)
+                while len(self.reads) > PREFETCH_TRACKS: # Forgets the oldest reads.
+                    del self.reads[next(iter(self.reads))]
+            return future
+
+    # Loads a track into pygame, from memory if it was prefetched.
+    @timed('track_load')
+    def load(self, file_name):
+        with self.lock:
+            self.generation += 1
+            self.queued_buffer = None
+            future = self.reads.pop(file_name, None)
+        if future is not None:
+            try:
+                self.playing_buffer = io.BytesIO(future.result())
+                pygame.mixer.music.load(self.playing_buffer, file_extension(file_name))
+                metrics.count('tracks_loaded_from_memory')
+                return
+            except (OSError, pygame.error):
+                self.playing_buffer = None
+        metrics.count('tracks_loaded_from_disk')
+        pygame.mixer.music.load(file_name)
+
+    # Reads the next track and queues it to start as soon as the current one ends.
+    def queue_next(self, file_name):
+        if not self.gapless:
+            self.prefetch(file_name)
+            return
+        generation = self.generation
+        self.prefetch(file_name).add_done_callback(lambda future: self.queue_read(future, file_name, generation))
+
+    # Queues a finished read if playback has not moved on in the meantime.
+    def queue_read(self, future, file_name, generation):
+        with self.lock:
+            if generation != self.generation or future.exception() is not None:
+                return
+            try:
+                if self.queued_buffer is not None: # The track queued last time is the one playing now.
+                    self.playing_buffer = self.queued_buffer
+                self.queued_buffer = io.BytesIO(future.result())
+                pygame.mixer.music.queue(self.queued_buffer, file_extension(file_name))
+            except pygame.error:
+                self.queued_buffer = None
+
+    # Stops any pending read from being queued.
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            self.queued_buffer = None
+
+# Keeps the most played tracks decoded on disk as raw samples in the mixer's own format. A decoded track is mapped
+# into memory and handed to pygame as a Sound, so it starts without reading or decoding the compressed file.
+# Tracks played longest ago are deleted once the cache grows past its size limit.
+class DecodeCache:
+    def __init__(self, folder, limit):
+        self.folder = folder
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict() # Cache file name -> bytes, least recently played first.
+        self.size = 0
+        self.executor = None # Worker thread that decodes tracks, started the first time one is needed.
+        self.plays_until_refresh = 0 # Plays left before the most played tracks are looked up again.
+        self.channel = None # Mixer channel decoded tracks play on, reserved the first time one plays.
+        self.sounds = [] # The playing and queued Sounds, pygame needs them kept alive.
+
+        # Picks up tracks decoded in earlier runs, in the order they were last played.
+        os.makedirs(folder, exist_ok = True)
+        entries = []
+        for entry in os.scandir(folder):
+            if entry.name.endswith('.pcm'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self.files[name] = size
+            self.size += size
+        with self.lock:
+            self.make_room(0, ())
+
+    # Cache file name of a track, it changes when the track is changed or the mixer uses another format.
+    @staticmethod
+    def cache_name(file_name):
+        stat = os.stat(file_name)
+        key = f'{os.path.abspath(file_name)}|{stat.st_size}|{stat.st_mtime_ns}|{pygame.mixer.get_init()}'
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pcm'
+
+    # Sound of a decoded track, None if it has not been decoded.
+    def sound(self, file_name):
+        try:
+            name = self.cache_name(file_name)
+        except OSError:
+            return None
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        path = os.path.join(self.folder, name)
+        try:
+            with open(path, 'rb') as reader, mmap.mmap(reader.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                sound = pygame.mixer.Sound(buffer = mapped)
+            os.utime(path) # Keeps the order of use for the next run.
+        except (OSError, ValueError, pygame.error):
+            return None
+        return sound
+
+    # Plays a decoded track on the cache's channel.
+    def play_sound(self, sound, volume = 1.0):
+        if self.channel is None:
+            pygame.mixer.set_reserved(1)
+            self.channel = pygame.mixer.Channel(0)
+            self.channel.set_endevent(TRACK_END) # Finished tracks are noticed the same way as streamed ones.
+        sound.set_volume(volume)
+        self.sounds = [sound]
+        self.channel.play(sound)
+
+    # Queues a decoded track to start as soon as the one playing on the cache's channel ends.
+    def queue(self, file_name, volume = 1.0):
+        if not self.playing():
+            return False
+        sound = self.sound(file_name)
+        if sound is None:
+            return False
+        sound.set_volume(volume)
+        self.sounds = self.sounds[-1:] + [sound]
+        self.channel.queue(sound)
+        return True
+
+    def playing(self):
+        return self.channel is not None and self.channel.get_busy()
+
+    # Counts a play, and every DECODE_CACHE_REFRESH plays decodes the most played tracks in the background.
+    # find turns the file names kept in the history into the paths they play from.
+    def played(self, history, find):
+        self.plays_until_refresh -= 1
+        if self.plays_until_refresh > 0:
+            return
+        self.plays_until_refresh = DECODE_CACHE_REFRESH
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.executor.submit(self.decode_most_played, history, find)
+
+    # Decodes the most played tracks, most played first, until the cache is full of them.
+    def decode_most_played(self, history, find):
+        try:
+            file_names = [find(file_name) for file_name in history.most_played_files(DECODE_CACHE_TRACKS)]
+        except sqlite3.Error:
+            return
+        file_names = [file_name for file_name in file_names if file_name is not None]
+        keep = set()
+        for file_name in file_names:
+            try:
+                keep.add(self.cache_name(file_name))
+            except OSError:
+                continue
+        for file_name in file_names:
+            if not self.decode(file_name, keep):
+                break
+
+    # Decodes one track into the cache. Returns False when there is no room for it without deleting a track in keep.
+    def decode(self, file_name, keep = ()):
+        try:
+            name = self.cache_name(file_name)
+        except OSError: # Moved or deleted, there is nothing to decode.
+            return True
+        with self.lock:
+            if name in self.files:
+                return True
+        try:
+            with metrics.span('track_decode'):
+                samples = pygame.mixer.Sound(file_name).get_raw()
+        except pygame.error:
+            metrics.count('decode_errors')
+            return True
+        with self.lock:
+            if not self.make_room(len(samples), keep):
+                return False
+        path = os.path.join(self.folder, name)
+        try:
+            with open(path + '.tmp', 'wb') as writer:
+                writer.write(samples)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            return False
+        with self.lock:
+            self.files[name] = len(samples)
+            self.size += len(samples)
+        return True
+
+    # Deletes the least recently played tracks that are not in keep until size more bytes fit, call with the lock held.
+    def make_room(self, size, keep):
+        while self.size + size > self.limit:
+            name = next((name for name in self.files if name not in keep), None)
+            if name is None:
+                return False
+            self.size -= self.files.pop(name)
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError: # Still mapped by a Sound being created, it is picked up and deleted next run.
+                pass
+        return True
+
+    # Stops the cache's channel and lets go of its Sounds.
+    def stop(self):
+        if self.channel is not None:
+            self.channel.stop()
+        self.sounds = []
+
+# File extension without the dot, pygame uses it to tell the format of tracks loaded from memory.
+def file_extension(file_name):
+    return os.path.splitext(file_name)[1].lstrip('.').lower()
+
+# Finds the file of each track among the music roots. Folders are listed instead of every file being checked, and a
+# listing is reused for as long as the folder's modification time stays the same, which only changes when files are
+# added, removed or renamed in it. Checking a library costs one stat per folder, spread over a thread pool. Folders
+# are only listed once a track in them is checked or looked up, so albums that are never opened cost nothing.
+class PathResolver:
+    def __init__(self, roots, cache_path = None):
+        self.roots = roots
+        self.cache_path = cache_path
+        self.listings = {} # Folder -> (mtime_ns, names in it) listed this run, None for folders that could not be read.
+        self.saved_listings = {} # Listings from the last run, reused for folders whose modification time is the same.
+
+    # Folders a file in a subfolder of the roots could be in, in the order they are searched.
+    def folders(self, subfolder):
+        if os.path.isabs(subfolder):
+            return [subfolder]
+        return [os.path.join(root, subfolder) if subfolder else root for root in self.roots]
+
+    # Reads the listings saved by the last check.
+    def load(self):
+        try:
+            with open(self.cache_path, 'r') as reader:
+                self.saved_listings = {folder: (mtime, set(names))
+                                       for folder, (mtime, names) in json.load(reader).items()}
+        except (OSError, ValueError, TypeError):
+            self.saved_listings = {}
+
+    def save(self):
+        listings = dict(self.saved_listings, **self.listings)
+        write_database(self.cache_path, {folder: [listing[0], sorted(listing[1])]
+                                         for folder, listing in listings.items()
+                                         if listing is not None and listing[0] is not None})
+
+    # Lists a folder again if its modification time changed since it was last listed. Runs on the thread pool.
+    def refresh_folder(self, folder):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            listing = self.listings.get(folder) or self.saved_listings.get(folder)
+            if listing is not None and listing[0] == mtime:
+                return folder, listing
+            names = {os.path.normcase(entry.name) for entry in os.scandir(folder)}
+        except OSError:
+            return folder, None
+        if time.time() - mtime / 1e9 < 2: # Could still change within the same tick, so it is listed again next time.
+            mtime = None
+        return folder, (mtime, names)
+
+    # Lists the folders of some file names, returns how many of the files are not under any root.
+    def check(self, file_names):
+        subfolders = collections.defaultdict(set) # Folder part of a file name -> names of the files in it.
+        for file_name in set(filter(None, file_names)):
+            subfolder, name = os.path.split(file_name)
+            subfolders[subfolder].add(os.path.normcase(name))
+
+        with metrics.span('path_check'):
+            folders = {folder for subfolder in subfolders for folder in self.folders(subfolder)}
+            with concurrent.futures.ThreadPoolExecutor(max_workers = PATH_CHECK_THREADS) as executor:
+                listings = dict(executor.map(self.refresh_folder, folders - self.listings.keys()))
+            changed = any(listing is not self.saved_listings.get(folder) for folder, listing in listings.items())
+            self.listings.update(listings)
+
+            missing = 0
+            for subfolder, names in subfolders.items():
+                for listing in map(self.listings.get, self.folders(subfolder)):
+                    if listing is not None:
+                        names = names - listing[1]
+                missing += len(names)
+
+        if self.cache_path is not None and changed:
+            try:
+                self.save()
+            except OSError as error:
+                print(f'\nError saving {self.cache_path}: {error}')
+        return missing
+
+    # Path of a file under the roots going by the listings, None if it is not in any of them. Folders that were not
+    # listed yet are listed first.
+    def find(self, file_name):
+        subfolder, name = os.path.split(file_name)
+        for folder in self.folders(subfolder):
+            if folder not in self.listings:
+                self.listings[folder] = self.refresh_folder(folder)[1]
+            listing = self.listings[folder]
+            if listing is not None and os.path.normcase(name) in listing[1]:
+                return os.path.join(folder, name)
+        return None
+
+    # Like find, but the folders of a file that is not found are checked again first, so files copied in after the
+    # library was loaded are picked up.
+    def resolve(self, file_name):
+        path = self.find(file_name)
+        if path is None:
+            for folder in self.folders(os.path.dirname(file_name)):
+                self.listings[folder] = self.refresh_folder(folder)[1]
+            path = self.find(file_name)
+        return path
+
+# Runs playback on its own thread so albums keep advancing while the menus wait for input.
+# The menus send commands through a queue, and pygame posts TRACK_END whenever a track finishes.
+class PlaybackEngine:
+    def __init__(self, library):
+        self.library = library
+        self.commands = queue.Queue()
+        self.thread = None
+        self.use_events = True # False when pygame's event system cannot be started, then the mixer is polled.
+        self.was_busy = False
+
+    # Starts the playback thread the first time a command is sent.
+    def start(self):
+        try:
+            init_mixer()
+            if not pygame.display.get_init():
+                os.environ.setdefault('SDL_VIDEODRIVER', 'dummy') # No window is needed, only the event queue.
+                pygame.display.init()
+            pygame.mixer.music.set_endevent(TRACK_END)
+        except pygame.error:
+            self.use_events = False
+            self.library.prefetcher.gapless = False # Without end events a queued track could not be noticed.
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    # Sends a command to the playback thread: 'play_album', 'play_song', 'play_queue', 'play_radio', 'skip', 'stop' or
+    # 'quit'.
+    def send(self, command, *args):
+        if self.thread is None:
+            self.start()
+        self.commands.put((command, args))
+
+    # Waits until every command sent so far has been handled.
+    def wait(self):
+        self.commands.join()
+
+    # Handles commands and finished tracks until told to quit.
+    def run(self):
+        while True:
+            try:
+                command, args = self.commands.get(timeout = PLAYBACK_POLL_INTERVAL)
+            except queue.Empty:
+                command = None
+
+            if command is not None:
+                try:
+                    if command == 'quit':
+                        self.library.stop_music()
+                        return
+                    self.handle(command, args)
+                except Exception as error: # A command that fails must not stop playback for the commands after it.
+                    metrics.count('playback_errors')
+                    print(f'\nError playing music: {error}')
+                finally:
+                    self.commands.task_done()
+
+            if self.track_ended():
+                try:
+                    metrics.profiled(self.library.track_finished)
+                except Exception as error:
+                    metrics.count('playback_errors')
+                    print(f'\nError playing next track: {error}')
+
+    # Runs one command on the library, under the profiler while profiling is on.
+    def handle(self, command, args):
+        with metrics.span(command):
+            metrics.profiled(self.run_command, command, args)
+
+        # Stopping or loading a track can report it as finished, those are not real track ends.
+        if self.use_events:
+            pygame.event.clear(TRACK_END, pump = False)
+        self.was_busy = music_busy()
+
+    def run_command(self, command, args):
+        match command:
+            case 'play_album':
+                self.library.play_album(*args)
+            case 'play_song':
+                self.library.stop_music()
+                self.library.play_song(*args)
+            case 'play_queue':
+                self.library.play_queued(*args)
+            case 'play_radio':
+                self.library.play_radio(*args)
+            case 'skip':
+                metrics.count('skips')
+                self.library.record_skip()
+                self.library.next_song()
+            case 'stop':
+                self.library.stop_music()
+
+    # Checks whether the playing track came to its end.
+    def track_ended(self):
+        if self.use_events:
+            return bool(pygame.event.get(TRACK_END, pump = False))
+        busy = music_busy()
+        ended = self.was_busy and not busy
+        self.was_busy = busy
+        return ended
+
+# Hash of a file's contents, used to recognise a track that was analysed before even if it was moved or touched.
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Prepares a worker process to decode audio without opening a sound device.
+def init_analysis_worker():
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.mixer.init()
+
+# Magnitude response of a biquad filter at the given angular frequencies.
+def biquad_response(b, a, omega):
+    z = numpy.exp(-1j * omega)
+    return numpy.abs(numpy.polyval(b[::-1], z) / numpy.polyval(a[::-1], z))
+
+# Squared magnitude of the ITU-R BS.1770 K-weighting filter (high shelf then high pass) at each FFT bin.
+def k_weighting(sample_rate, bins):
+    omega = 2 * numpy.pi * numpy.fft.rfftfreq(bins, 1 / sample_rate) / sample_rate
+
+    gain = 10 ** (4.0 / 40) # +4 dB shelf above 1.5 kHz.
+    w0 = 2 * numpy.pi * 1500 / sample_rate
+    alpha = numpy.sin(w0) / (2 / numpy.sqrt(2))
+    cos_w0 = numpy.cos(w0)
+    shelf = biquad_response(
+        [gain * ((gain + 1) + (gain - 1) * cos_w0 + 2 * numpy.sqrt(gain) * alpha),
+         -2 * gain * ((gain - 1) + (gain + 1) * cos_w0),
+         gain * ((gain + 1) + (gain - 1) * cos_w0 - 2 * numpy.sqrt(gain) * alpha)],
+        [(gain + 1) - (gain - 1) * cos_w0 + 2 * numpy.sqrt(gain) * alpha,
+         2 * ((gain - 1) - (gain + 1) * cos_w0),
+         (gain + 1) - (gain - 1) * cos_w0 - 2 * numpy.sqrt(gain) * alpha],
+        omega)
+
+    w0 = 2 * numpy.pi * 38 / sample_rate # High pass at 38 Hz.
+    alpha = numpy.sin(w0) / (2 * 0.5)
+    cos_w0 = numpy.cos(w0)
+    high_pass = biquad_response([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2],
+                                [1 + alpha, -2 * cos_w0, 1 - alpha], omega)
+    return (shelf * high_pass) ** 2
+
+# Decodes a file into samples scaled so 1.0 is full scale, one column per channel. Returns them and the sample rate.
+def decode_samples(path):
+    sound = pygame.mixer.Sound(path)
+    sample_rate, size, channels = pygame.mixer.get_init()
+    samples = pygame.sndarray.array(sound).astype(numpy.float32) / float(2 ** (abs(size) - 1))
+    return samples.reshape(len(samples), -1), sample_rate # Mono arrays come back with one dimension.
+
+# Decodes a file and measures its integrated loudness (LUFS) and sample peak.
+def analyze_file(path):
+    return measure_loudness(*decode_samples(path))
+
+# Integrated loudness (LUFS) and sample peak (1.0 is full scale) of decoded samples. The signal is cut into 100 ms
+# segments that are all K-weighted in one FFT, then 400 ms blocks are gated the way BS.1770 describes.
+def measure_loudness(samples, sample_rate):
+    peak = float(numpy.max(numpy.abs(samples))) if samples.size else 0.0
+    segment = sample_rate // 10
+    segment_count = len(samples) // segment
+    if segment_count < 4: # Shorter than one 400 ms block.
+        return None, peak
+
+    # Power of every 100 ms segment per channel, summed over channels.
+    segments = samples[:segment_count * segment].reshape(segment_count, segment, -1).transpose(0, 2, 1)
+    spectrum = numpy.abs(numpy.fft.rfft(segments, axis = 2)) ** 2
+    spectrum[..., 1:(segment + 1) // 2] *= 2 # One-sided spectrum, the mirrored bins count twice.
+    power = (spectrum * k_weighting(sample_rate, segment)).sum(axis = 2) / segment ** 2
+    power = power.sum(axis = 1)
+
+    # Four consecutive segments make one 400 ms block, blocks overlap by 75%.
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(power)))
+    blocks = (cumulative[4:] - cumulative[:-4]) / 4
+    block_loudness = -0.691 + 10 * numpy.log10(numpy.maximum(blocks, 1e-12))
+
+    gated = blocks[block_loudness > -70] # Absolute gate.
+    if not gated.size:
+        return None, peak
+    relative_gate = -0.691 + 10 * numpy.log10(gated.mean()) - 10
+    gated = blocks[(block_loudness > -70) & (block_loudness > relative_gate)]
+    loudness = -0.691 + 10 * numpy.log10(gated.mean())
+    return float(loudness), peak
+
+# Hashes and analyses a file in a worker process.
+def hash_and_analyze(path):
+    try:
+        return hash_file(path), analyze_file(path)
+    except (OSError, pygame.error) as error:
+        return None, str(error)
+
+# How much each feature counts when radio compares tracks, in the order track_features lists them. The eight spectrum
+# bands share their weight, so together they count about as much as two of the other features.
+FEATURE_WEIGHTS = [1.0] * 9 + [0.5] * 8
+
+# Sound features radio compares tracks by, taken from up to FEATURE_EXCERPT seconds in the middle of the track:
+# loudness, how much the loudness varies, spectral centroid, bandwidth, roll off and flatness, zero crossings per
+# second, tempo, how clear the beat is, and the share of energy in eight bands from 60 Hz up. Frequencies and tempo
+# are kept as octaves so a difference means the same thing anywhere in the range. Returns None for very short tracks
+# and silent ones, which have no spectrum to compare.
+def track_features(samples, sample_rate):
+    excerpt = FEATURE_EXCERPT * sample_rate
+    if len(samples) > excerpt:
+        start = (len(samples) - excerpt) // 2
+        samples = samples[start:start + excerpt]
+    frame, hop = 2048, 1024
+    mono = samples.mean(axis = 1)
+    if len(mono) < frame * 16:
+        return None
+
+    # Spectrum of every frame in one FFT.
+    window = numpy.hanning(frame).astype(numpy.float32)
+    frames = numpy.lib.stride_tricks.sliding_window_view(mono, frame)[::hop] * window
+    spectrum = numpy.abs(numpy.fft.rfft(frames, axis = 1))
+    power = spectrum.astype(numpy.float64) ** 2
+    frequencies = numpy.fft.rfftfreq(frame, 1 / sample_rate)
+    total = power.sum(axis = 1) + 1e-12
+    centroid = power @ frequencies / total
+    bandwidth = numpy.sqrt(numpy.maximum(power @ frequencies ** 2 / total - centroid ** 2, 0))
+    rolloff = frequencies[numpy.argmax(numpy.cumsum(power, axis = 1) >= 0.85 * total[:, None], axis = 1)]
+    flatness = numpy.exp(numpy.log(power + 1e-12).mean(axis = 1)) / (power.mean(axis = 1) + 1e-12)
+    frame_loudness = 10 * numpy.log10(total / frame)
+    audible = frame_loudness[frame_loudness > -70] # Silence between tracks or songs would count as variation.
+    crossings = numpy.count_nonzero(numpy.diff(numpy.signbit(mono))) * sample_rate / len(mono)
+
+    # Share of the energy in each band, measured over the whole excerpt.
+    edges = numpy.geomspace(60, sample_rate / 2, 9)
+    band_power = numpy.add.reduceat(power.sum(axis = 0), numpy.searchsorted(frequencies, edges[:-1]))
+    if not band_power.sum() > 0:
+        return None
+    bands = numpy.log10(band_power / band_power.sum() + 1e-6)
+
+    # Tempo from the autocorrelation of how much the spectrum rises from frame to frame, looking between 60 and 200
+    # beats a minute and favouring tempos near 120 so a beat is not mistaken for half or twice its speed.
+    onsets = numpy.maximum(numpy.diff(numpy.log1p(spectrum), axis = 0), 0).sum(axis = 1)
+    onsets -= onsets.mean()
+    correlation = numpy.fft.irfft(numpy.abs(numpy.fft.rfft(onsets, 2 * len(onsets))) ** 2)[:len(onsets)]
+    rate = sample_rate / hop # Frames a second.
+    lags = numpy.arange(int(rate * 60 / 200), int(rate * 60 / 60) + 1)
+    preference = numpy.exp(-0.5 * numpy.log2(60 * rate / lags / 120) ** 2)
+    lag = lags[numpy.argmax(correlation[lags] * preference)]
+    before, peak, after = correlation[lag - 1:lag + 2]
+    curve = before - 2 * peak + after
+    lag = lag + (0.5 * (before - after) / curve if curve < 0 else 0) # Between frames, from the shape of the peak.
+    beat = max(peak / correlation[0], 0) if correlation[0] > 0 else 0.0
+
+    loudness, sample_peak = measure_loudness(samples, sample_rate)
+    features = [loudness if loudness is not None else -70.0, audible.std() if audible.size else 0.0,
+                numpy.log2(centroid.mean() + 1), numpy.log2(bandwidth.mean() + 1), numpy.log2(rolloff.mean() + 1),
+                numpy.log10(flatness.mean() + 1e-12), numpy.log2(crossings + 1), numpy.log2(60 * rate / lag),
+                beat] + list(bands)
+    if not numpy.isfinite(features).all():
+        return None
+    return [round(float(feature), 4) for feature in features]
+
+# Prepares a worker process that extracts features in the background, at a lower priority so playback keeps up.
+def init_feature_worker():
+    init_analysis_worker()
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+# Hashes a file and extracts its sound features in a worker process.
+def hash_and_extract(path):
+    try:
+        return hash_file(path), track_features(*decode_samples(path))
+    except (OSError, pygame.error, ValueError) as error:
+        return None, str(error)
+
+# Remembers the loudness of every analysed track by file hash, and the hash of every file by path, size and mtime so
+# unchanged files are never read again. Playback only looks up a ready made volume here.
+class LoudnessCache:
+    def __init__(self, path):
+        self.path = path
+        self.files = {} # Absolute path -> [size, mtime, hash].
+        self.results = {} # Hash -> [loudness, peak].
+        self.volumes = {} # Absolute path -> volume to play the track at.
+
+    # Reads the cache file if there is one.
+    def load(self):
+        try:
+            with open(self.path, 'r') as reader:
+                data = json.load(reader)
+            self.files = data.get('files', {})
+            self.results = data.get('results', {})
+        except (FileNotFoundError, ValueError):
+            pass
+        self.update_volumes()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as writer:
+            json.dump({'files': self.files, 'results': self.results}, writer)
+        os.replace(self.path + '.tmp', self.path)
+
+    # Works out the volume of every analysed track. Louder tracks are turned down to LOUDNESS_TARGET, set_volume
+    # cannot go above 1.0 so quieter tracks play at full volume.
+    def update_volumes(self):
+        self.volumes = {}
+        for path, (size, mtime, file_hash) in self.files.items():
+            loudness = self.results.get(file_hash, [None])[0]
+            if loudness is not None:
+                self.volumes[path] = min(1.0, 10 ** ((LOUDNESS_TARGET - loudness) / 20))
+
+    # Volume for a track, tracks that were never analysed play at full volume.
+    def volume_for(self, file_name):
+        return self.volumes.get(os.path.abspath(file_name), 1.0)
+
+    # Analyses every file that changed since the last run, spread across all cores. Returns how many were analysed.
+    def analyze(self, file_names):
+        pending = []
+        for file_name in set(file_names):
+            path = os.path.abspath(file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            known = self.files.get(path)
+            if known and known[:2] == [stat.st_size, stat.st_mtime_ns] and known[2] in self.results:
+                continue
+            pending.append((path, stat.st_size, stat.st_mtime_ns))
+
+        if pending:
+            # Workers are started from scratch like FeatureIndex's, forking while playback threads run can hang them.
+            with concurrent.futures.ProcessPoolExecutor(mp_context = multiprocessing.get_context('spawn'),
+                                                        initializer = init_analysis_worker) as executor:
+                paths = [path for path, size, mtime in pending]
+                for (path, size, mtime), (file_hash, result) in zip(pending, executor.map(hash_and_analyze, paths)):
+                    if file_hash is None:
+                        print(f'\nError analysing {path}: {result}')
+                        continue
+                    self.files[path] = [size, mtime, file_hash]
+                    self.results[file_hash] = list(result)
+            self.save()
+            self.update_volumes()
+        return len(pending)
+
+# Sound features of every analysed track, kept by file hash like LoudnessCache, and a matrix of them for finding the
+# tracks that sound most alike. Features are extracted on a background thread that hands files to a process pool, and
+# the matrix is built again as new features come in so radio can use them without waiting for the rest.
+class FeatureIndex:
+    def __init__(self, path):
+        self.path = path
+        self.files = {} # Absolute path -> [size, mtime, hash].
+        self.results = {} # Hash -> features, None for tracks too short to have any.
+        self.index = ([], {}, None, None) # Track references, reference -> row, scaled features, squared row lengths.
+        self.extractor = None # Thread extracting features.
+        self.stopping = False
+        self.progress = [0, 0] # Tracks extracted so far and tracks to extract.
+
+    # Number of tracks radio can compare.
+    def __len__(self):
+        return len(self.index[0])
+
+    # Reads the cache file if there is one.
+    def load(self):
+        try:
+            with open(self.path, 'r') as reader:
+                data = json.load(reader)
+            self.files = data.get('files', {})
+            self.results = data.get('results', {})
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as writer:
+            json.dump({'files': self.files, 'results': self.results}, writer)
+        os.replace(self.path + '.tmp', self.path)
+
+    def extracting(self):
+        return self.extractor is not None and self.extractor.is_alive()
+
+    # Builds the index from the features known so far, then extracts the features of tracks that are new or changed
+    # in the background. Tracks are (reference, absolute path) pairs, read from the library by the caller since the
+    # library can change while this runs.
+    def start(self, tracks):
+        if self.extracting():
+            return
+        tracks = list(tracks)
+        self.build(tracks)
+        self.stopping = False
+        self.progress = [0, 0]
+        self.extractor = threading.Thread(target = self.extract, args = (tracks,), daemon = True)
+        self.extractor.start()
+
+    # Stops extracting, the features extracted so far are saved.
+    def stop(self):
+        self.stopping = True
+        if self.extractor is not None:
+            self.extractor.join()
+
+    def extract(self, tracks):
+        pending = []
+        for path in {path for reference, path in tracks}:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            known = self.files.get(path)
+            if known and known[:2] == [stat.st_size, stat.st_mtime_ns] and known[2] in self.results:
+                continue
+            pending.append((path, stat.st_size, stat.st_mtime_ns))
+        self.progress = [0, len(pending)]
+        if not pending:
+            return
+
+        # Workers are started from scratch, a forked worker would inherit the lock the menu holds while it waits for
+        # input and hang when it closes its copy of stdin.
+        saved_at = time.monotonic()
+        workers = max(1, (os.cpu_count() or 2) - 1) # One core is left for playback and the menus.
+        try:
+            with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'),
+                                                        init_feature_worker) as executor:
+                futures = {executor.submit(hash_and_extract, path): (path, size, mtime)
+                           for path, size, mtime in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    if self.stopping:
+                        executor.shutdown(cancel_futures = True)
+                        break
+                    path, size, mtime = futures[future]
+                    file_hash, result = future.result()
+                    self.progress[0] += 1
+                    if file_hash is None:
+                        metrics.count('feature_errors')
+                        continue
+                    self.files[path] = [size, mtime, file_hash]
+                    self.results[file_hash] = result
+                    if time.monotonic() - saved_at > FEATURE_SAVE_INTERVAL:
+                        self.save_and_build(tracks)
+                        saved_at = time.monotonic()
+        except concurrent.futures.BrokenExecutor as error: # A worker crashed, or could not be started.
+            print(f'\nTrack analysis stopped: {error}')
+        self.save_and_build(tracks)
+
+    def save_and_build(self, tracks):
+        try:
+            self.save()
+        except OSError as error:
+            print(f'\nError saving {self.path}: {error}')
+        self.build(tracks)
+
+    # Builds the matrix of features of every track that has them. Each feature is scaled to the same spread across the
+    # library and then weighted, so no feature counts more just because its numbers are bigger. The new index
+    # replaces the old one in one assignment, so radio can keep reading while it is built.
+    @timed('feature_index_build')
+    def build(self, tracks):
+        references = []
+        rows = []
+        for reference, path in tracks:
+            known = self.files.get(path)
+            features = self.results.get(known[2]) if known is not None else None
+            if features is not None and len(features) == len(FEATURE_WEIGHTS):
+                references.append(reference)
+                rows.append(features)
+        if not rows:
+            self.index = ([], {}, None, None)
+            return
+
+        features = numpy.array(rows)
+        finite = numpy.isfinite(features).all(axis = 1) # One bad row would turn every scaled row into NaN.
+        if not finite.all():
+            references = [reference for reference, keep in zip(references, finite) if keep]
+            features = features[finite]
+            if not references:
+                self.index = ([], {}, None, None)
+                return
+        spread = numpy.nan_to_num(features.std(axis = 0))
+        spread[spread == 0] = 1
+        scaled = ((features - features.mean(axis = 0)) / spread * FEATURE_WEIGHTS).astype(numpy.float32)
+        self.index = (references, {reference: row for row, reference in enumerate(references)}, scaled,
+                      numpy.einsum('ij,ij->i', scaled, scaled))
+
+    def has(self, reference):
+        return reference in self.index[1]
+
+    # References of the tracks that sound most like a track, most alike first, leaving out excluded ones. Empty when the
+    # track has no features. One matrix product gives the distance to every track: |a - b|² = |a|² - 2a·b + |b|²,
+    # where |b|² is the same for every row and |a|² was worked out when the matrix was built.
+    def nearest(self, reference, count, exclude = ()):
+        references, rows, scaled, lengths = self.index
+        row = rows.get(reference)
+        if row is None:
+            return []
+        distances = lengths - 2 * (scaled @ scaled[row])
+        excluded = {rows[excluded] for excluded in exclude if excluded in rows}
+        excluded.add(row)
+        distances[list(excluded)] = numpy.inf
+        count = min(count, len(references) - len(excluded))
+        if count <= 0:
+            return []
+        nearest = numpy.argpartition(distances, count - 1)[:count]
+        return [references[row] for row in nearest[numpy.argsort(distances[nearest])]]
+
+# Keeps music going by playing, after each track, one of the tracks that sound most like it. The next track is picked
+# when it is first asked for, so it can be read ahead while the one before plays.
+class Radio:
+    def __init__(self, features, lookup):
+        self.features = features
+        self.lookup = lookup # Finds the song or single a reference points to, None if it was deleted.
+        self.current = None # Reference of the playing track.
+        self.upcoming = None # Reference of the track picked to play next.
+        self.recent = collections.deque(maxlen = RADIO_RECENT)
+
+    # Starts from a track, returns False if its features have not been extracted.
+    def start(self, reference):
+        if not self.features.has(reference):
+            return False
+        self.current = reference
+        self.upcoming = None
+        self.recent.clear()
+        self.recent.append(reference)
+        return True
+
+    # Reference of the playing track, or with an offset of 1 the track that plays next.
+    def reference(self, offset = 0):
+        if offset == 0:
+            return self.current
+        if offset == 1 and self.current is not None:
+            if self.upcoming is None:
+                self.upcoming = self.pick()
+            return self.upcoming
+        return None
+
+    # Moves on to the next track, returns False when no track is alike enough and not played recently.
+    def advance(self):
+        self.current = self.reference(1)
+        self.upcoming = None
+        if self.current is None:
+            return False
+        self.recent.append(self.current)
+        return True
+
+    # Picks at random among the nearest tracks that did not play recently and are still in the library.
+    def pick(self):
+        with metrics.span('radio_pick'):
+            nearest = self.features.nearest(self.current, RADIO_CHOICES * 2, self.recent)
+            choices = [reference for reference in nearest if self.lookup(reference) is not None][:RADIO_CHOICES]
+        return random.choice(choices) if choices else None
+
+# What is playing right now: the track, the album being played through and the position in it, and when they started.
+# Kept in one place so playing, skipping and stopping only touch the items involved instead of the whole library, and
+# menus or listeners can read the playback state without searching for it. Listeners are called with the state
+# whenever it changes, from the thread that changed it.
+class NowPlaying:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.music_item = None # Song or single that is playing.
+        self.album = None # Album being played through, None when a single track was played.
+        self.album_index = None
+        self.from_queue = False # True while the play queue is being played.
+        self.radio = False # True while radio is picking the tracks.
+        self.song_keys = [] # Keys of the album's songs in the order they play, they stay valid if songs are deleted.
+        self.position = None # Index in song_keys of the playing song.
+        self.started_at = None # time.time() when the playing track started.
+        self.album_started_at = None # time.time() when the album started.
+        self.listeners = []
+
+    # Calls a function with this state every time it changes.
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self):
+        for listener in self.listeners:
+            listener(self)
+
+    # Starts playing through an album, from its first song.
+    def start_album(self, album_index, album, song_keys):
+        with self.lock:
+            self.clear()
+            self.album = album
+            self.album_index = album_index
+            self.song_keys = song_keys
+            self.position = 0
+            self.album_started_at = time.time()
+            album.is_playing = True
+
+    # Starts playing through the play queue.
+    def start_queue(self):
+        with self.lock:
+            self.clear()
+            self.from_queue = True
+            self.album_started_at = time.time()
+
+    # Starts playing tracks picked by radio.
+    def start_radio(self):
+        with self.lock:
+            self.clear()
+            self.radio = True
+            self.album_started_at = time.time()
+
+    # Marks a track as playing, the track that was playing before is no longer marked.
+    def start_track(self, music_item):
+        with self.lock:
+            if self.music_item is not None:
+                self.music_item.is_playing = False
+            self.music_item = music_item
+            self.started_at = time.time()
+            music_item.is_playing = True
+        self.notify()
+
+    # Key of the album song at the current position plus offset, or None past the end of the album.
+    def song_key(self, offset = 0):
+        if self.position is None or not 0 <= self.position + offset < len(self.song_keys):
+            return None
+        return self.song_keys[self.position + offset]
+
+    # Moves to the next song of the album, returns False when the album has no more songs.
+    def advance(self):
+        with self.lock:
+            self.end_track()
+            self.position += 1
+            return self.position < len(self.song_keys)
+
+    # The playing track is no longer marked as playing, used when moving on to another one.
+    def end_track(self):
+        if self.music_item is not None:
+            self.music_item.is_playing = False
+            self.music_item = None
+
+    # Nothing is playing any more.
+    def stop(self):
+        with self.lock:
+            self.clear()
+        self.notify()
+
+    def clear(self):
+        if self.music_item is not None:
+            self.music_item.is_playing = False
+        if self.album is not None:
+            self.album.is_playing = False
+        self.music_item = None
+        self.album = None
+        self.album_index = None
+        self.from_queue = False
+        self.radio = False
+        self.song_keys = []
+        self.position = None
+        self.started_at = None
+        self.album_started_at = None
+
+    # Seconds the playing track has been playing, or None.
+    def elapsed(self):
+        started_at = self.started_at
+        return time.time() - started_at if started_at is not None else None
+
+    # Plain copy of the state, safe to read while the playback thread changes it.
+    def snapshot(self):
+        with self.lock:
+            return {
+                'music_item': self.music_item,
+                'album': self.album,
+                'album_index': self.album_index,
+                'from_queue': self.from_queue,
+                'radio': self.radio,
+                'position': self.position,
+                'album_length': len(self.song_keys),
+                'started_at': self.started_at,
+                'album_started_at': self.album_started_at
+            }
+
+# Songs and singles lined up to play, taken from any number of albums. Entries are kept in a PositionalView like the
+# library's own listings, so adding, adding right after the playing song and removing by position take O(log n).
+# Shuffling makes a second order for playing, so every entry plays once before the queue is finished.
+# The queue is saved when it is changed and the playing entry is saved on its own when it changes, which only
+# writes a few bytes per track.
+class PlayQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock() # Menus change the queue while the playback thread reads it.
+        self.entries = {} # Entry id -> (music item type, album index, key), the same references search uses.
+        self.order = PositionalView() # Entry ids in the order they are listed.
+        self.play_order = None # Entry ids in the order they play while shuffled.
+        self.current = None # Entry id that is playing or played last, None before the first one.
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.order)
+
+    # Order entries play in.
+    def playing_order(self):
+        return self.play_order if self.play_order is not None else self.order
+
+    # Adds an entry at the end, or right after the playing entry. Returns the entry id.
+    def add(self, reference, play_next = False):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = reference
+            after = self.order.position(self.current) + 1 if self.current is not None else 1
+            self.order.insert_at(after if play_next else len(self.order) + 1, entry_id)
+            if self.play_order is not None:
+                # While shuffled a new entry goes somewhere among the entries that have not played yet.
+                after = self.play_order.position(self.current) + 1 if self.current is not None else 1
+                self.play_order.insert_at(after if play_next else random.randint(after, len(self.play_order) + 1),
+                                          entry_id)
+            return entry_id
+
+    # Removes the entry listed at a position.
+    def remove_at(self, position):
+        with self.lock:
+            return self.remove(self.order.key_at(position))
+
+    # Removes an entry. If it is playing, the entry after it still plays next.
+    def remove(self, entry_id):
+        with self.lock:
+            if entry_id == self.current:
+                play_position = self.playing_order().position(entry_id)
+                self.current = self.playing_order().key_at(play_position - 1) if play_position > 1 else None
+            self.order.remove(entry_id)
+            if self.play_order is not None:
+                self.play_order.remove(entry_id)
+            return self.entries.pop(entry_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.order = PositionalView()
+            self.play_order = None if self.play_order is None else PositionalView()
+            self.current = None
+
+    # Turns shuffling on or off. The entries that already played stay in front, the rest are mixed.
+    def set_shuffle(self, shuffle):
+        with self.lock:
+            if not shuffle:
+                self.play_order = None
+                return
+            entry_ids = list(self.playing_order())
+            played = entry_ids.index(self.current) + 1 if self.current is not None else 0
+            remaining = entry_ids[played:]
+            random.shuffle(remaining)
+            self.play_order = PositionalView(entry_ids[:played] + remaining)
+
+    # Reference of the entry offset places from the playing one in playing order, or None.
+    def reference(self, offset = 0):
+        with self.lock:
+            order = self.playing_order()
+            position = (order.position(self.current) if self.current is not None else 0) + offset
+            if not 1 <= position <= len(order) or (self.current is None and offset == 0):
+                return None
+            return self.entries[order.key_at(position)]
+
+    # Starts at the entry listed at a position, or carries on from the saved entry. Returns False if it is empty.
+    def start(self, position = None):
+        with self.lock:
+            if not self.order:
+                return False
+            if position is not None:
+                entry_id = self.order.key_at(position)
+                self.current = entry_id
+                if self.play_order is not None: # The chosen entry starts a new round of shuffling.
+                    self.play_order.move(entry_id, 1)
+                    self.set_shuffle(True)
+            elif self.current is None:
+                self.current = self.playing_order().key_at(1)
+            return True
+
+    # Moves on to the next entry. Returns False once every entry has played, the next start begins again.
+    def advance(self):
+        with self.lock:
+            if self.reference(1) is None:
+                self.current = None
+                if self.play_order is not None:
+                    self.set_shuffle(True) # The next round plays in a new order.
+                return False
+            order = self.playing_order()
+            self.current = order.key_at(order.position(self.current) + 1 if self.current is not None else 1)
+            return True
+
+    # Lists (position, reference, is current) in the order entries are listed.
+    def ordered_entries(self):
+        with self.lock:
+            return [(position, self.entries[entry_id], entry_id == self.current)
+                    for position, entry_id in enumerate(self.order, 1)]
+
+    # Saves the whole queue, used when it was changed.
+    def save(self):
+        with self.lock:
+            data = {
+                'next_id': self.next_id,
+                'entries': [[entry_id] + list(self.entries[entry_id]) for entry_id in self.order],
+                'play_order': list(self.play_order) if self.play_order is not None else None
+            }
+        try:
+            write_database(self.path, data)
+            self.save_position()
+        except OSError as error:
+            print(f'\nError saving play queue: {error}')
+
+    # Saves only which entry is playing, used every time a track starts.
+    def save_position(self):
+        try:
+            with open(self.path + '.position', 'w') as writer:
+                writer.write(json.dumps(self.current))
+        except OSError as error:
+            print(f'\nError saving play queue: {error}')
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as reader:
+                data = json.load(reader)
+        except (FileNotFoundError, ValueError):
+            return
+        with self.lock:
+            self.entries = {entry_id: (music_item_type, album_index, key)
+                            for entry_id, music_item_type, album_index, key in data['entries']}
+            self.order = PositionalView(entry_id for entry_id, *reference in data['entries'])
+            if data.get('play_order') is not None:
+                self.play_order = PositionalView(data['play_order'])
+            self.next_id = data.get('next_id', 1)
+            try:
+                with open(self.path + '.position', 'r') as reader:
+                    current = json.load(reader)
+                self.current = current if current in self.entries else None
+            except (FileNotFoundError, ValueError):
+                pass
+
+# Holds and manipulates all music items.
+class Library:
+    def __init__(self):
+        self.albums = {}
+        self.singles = {}
+        self.album_identities = IdentityIndex()
+        self.single_identities = IdentityIndex()
+        self.now_playing = NowPlaying() # What is playing, read by the menus.
+        self.play_queue = PlayQueue(PLAY_QUEUE_FILE) # Songs lined up to play, from any album.
+        self.store = None # Receives every change once the library has been loaded.
+        self.search_index = None # Built in the background once the library is loaded, or by the first search.
+        self.search_ready = threading.Event() # Cleared while the search index is being built.
+        self.search_ready.set()
+        self.prefetcher = TrackPrefetcher() # Reads the next album track ahead of time.
+        self.loudness = None # Volumes worked out by loudness analysis, set once the cache has been read.
+        self.history = None # Where plays and skips are recorded, opened with the library.
+        self.decode_cache = None # Most played tracks decoded ahead of time, set when DECODE_CACHE is on.
+        self.paths = PathResolver(MUSIC_ROOTS) # Finds track files under the music roots.
+        self.rows = {} # (music item type, album index, key) -> text the menus list the music item with.
+        self.features = None # Sound features of tracks, set when numpy is installed.
+        self.radio = None # Picks tracks that sound alike, set along with the features.
+
+    # Passes a change on to storage so it can be saved without rewriting the database.
+    def record_change(self, change):
+        if self.store is not None:
+            self.store.append(change)
+
+    # Stores a music item under a key that was already chosen, used when loading from storage.
+    def place_music_item(self, music_item_type, key, music_item, album_index):
+        self.map_music_item(music_item_type, album_index)[key] = music_item
+        self.map_identity_index(music_item_type, album_index).claim(music_item, key)
+        self.index_music_item(music_item_type, key, music_item, album_index)
+
+    # Reference used by the search index for a music item.
+    @staticmethod
+    def search_reference(music_item_type, key, album_index):
+        if music_item_type == 'song':
+            return ('song', album_index, key)
+        if music_item_type == 'album':
+            return ('album', key, None)
+        return ('single', None, key)
+
+    # Keeps the search index up to date when a music item is added, if the index has been built.
+    def index_music_item(self, music_item_type, key, music_item, album_index):
+        if self.search_index is not None:
+            reference = self.search_reference(music_item_type, key, album_index)
+            self.search_index.add(reference, music_item.name, music_item.artist, getattr(music_item, 'album', None))
+            if music_item_type == 'album' and music_item.song_loader is None: # Albums can be added with songs.
+                for song_key, song in music_item.songs.items():
+                    self.index_music_item('song', song_key, song, key)
+
+    # Builds the search index once. Songs of albums that have not been opened are read from storage as plain rows.
+    # The index is in place from the start, so music items added or deleted while it is built reach it too.
+    @timed('search_index_build')
+    def build_search_index(self):
+        self.search_ready.clear()
+        self.search_index = SearchIndex()
+        try:
+            unloaded_albums = set()
+            for album_index, album in list(self.albums.items()): # Copied, the menus can add albums meanwhile.
+                self.index_music_item('album', album_index, album, None)
+                if album.song_loader is not None:
+                    unloaded_albums.add(album_index)
+                    continue
+                for key, song in list(album.songs.items()):
+                    self.index_music_item('song', key, song, album_index)
+            for key, single in list(self.singles.items()):
+                self.index_music_item('single', key, single, None)
+
+            if unloaded_albums and self.store is not None:
+                for album_index, key, name, artist, album, file_name in list(self.store.song_metadata()):
+                    if album_index in unloaded_albums:
+                        self.search_index.add(('song', album_index, key), name, artist, album)
+            self.search_index.finish()
+        except Exception:
+            self.search_index = None # Built again by the next search.
+            raise
+        finally:
+            self.search_ready.set()
+
+    # Builds the search index on a background thread, so even a large library can be searched as soon as the first
+    # query is typed. Searches made before it is done wait for it.
+    def start_search_index(self):
+        self.search_ready.clear()
+        threading.Thread(target = self.build_search_index, daemon = True).start()
+
+    # Reference and file name of every song and single, songs of albums that were never opened are read from storage.
+    def tracks(self):
+        unloaded_albums = set()
+        for album_index, album in self.albums.items():
+            if album.song_loader is not None:
+                unloaded_albums.add(album_index)
+                continue
+            for key, song in album.songs.items():
+                yield ('song', album_index, key), song.file_name
+        for key, single in self.singles.items():
+            yield ('single', None, key), single.file_name
+
+        if unloaded_albums and self.store is not None:
+            for album_index, key, name, artist, album, file_name in self.store.song_metadata():
+                if album_index in unloaded_albums:
+                    yield ('song', album_index, key), file_name
+
+    # File names of singles and of songs in albums that have been opened, the tracks that are in memory already.
+    def loaded_file_names(self):
+        for album in self.albums.values():
+            for song in album.loaded_songs().values():
+                yield song.file_name
+        for single in self.singles.values():
+            yield single.file_name
+
+    # Reference and absolute path of every track whose file is under the music roots, for extracting features.
+    def radio_tracks(self):
+        tracks = []
+        for reference, file_name in self.tracks():
+            path = self.paths.find(file_name) if file_name else None
+            if path is not None:
+                tracks.append((reference, os.path.abspath(path)))
+        return tracks
+
+    # Path a song or single plays from, None if it has no file or the file is not under any music root.
+    def track_path(self, song):
+        return self.paths.resolve(song.file_name) if song.file_name else None
+
+    # Marker shown after songs and singles whose file is missing.
+    def missing_marker(self, music_item):
+        if not isinstance(music_item, Track):
+            return ''
+        if not music_item.file_name or self.paths.find(music_item.file_name) is None:
+            return ' (missing)'
+        return ''
+
+    # Searches names, artists and albums, returns (music item type, key, album index, music item) for each match.
+    def search(self, query, limit = 20):
+        self.search_ready.wait()
+        if self.search_index is None:
+            self.build_search_index()
+
+        # Music items deleted while the index was being built can still be in it, they are left out here.
+        results = []
+        for music_item_type, first_key, second_key in self.search_index.search(query, limit):
+            if music_item_type == 'song':
+                album = self.albums.get(first_key)
+                song = album.songs.get(second_key) if album is not None else None
+                if song is not None:
+                    results.append(('song', second_key, first_key, song))
+            elif music_item_type == 'album':
+                if first_key in self.albums:
+                    results.append(('album', first_key, None, self.albums[first_key]))
+            elif second_key in self.singles:
+                results.append(('single', second_key, None, self.singles[second_key]))
+        return results
+
+    # Applies a change read back from the journal.
+    def apply_change(self, change):
+        if change['op'] == 'batch': # Changes saved together by batch mode.
+            for batch_change in change['changes']:
+                self.apply_change(batch_change)
+            return
+
+        music_item_type = change['type']
+        album_index = change.get('album')
+
+        match change['op']:
+            case 'add':
+                self.place_music_item(music_item_type, change['key'], music_item_from_json(change['item']), album_index)
+                if change.get('position') is not None:
+                    self.map_positions(music_item_type, album_index).move(change['key'], change['position'])
+            case 'delete':
+                music_dict = self.map_music_item(music_item_type, album_index)
+                if change['key'] in music_dict:
+                    self.map_identity_index(music_item_type, album_index).discard(music_dict.pop(change['key']),
+                                                                                  change['key'])
+                    if self.search_index is not None:
+                        self.search_index.remove(self.search_reference(music_item_type, change['key'], album_index))
+            case 'move':
+                self.map_positions(music_item_type, album_index).move(change['key'], change['position'])
+
+    # Chooses a dictionary based on music item type.
+    def map_music_item(self, music_item_type, album_index):
+        if music_item_type == 'song':
+            if album_index is None or album_index not in self.albums:
+                raise ValueError('Invalid album index.')
+            return self.albums[album_index].songs
+        mapped = {
+                'album': self.albums,
+                'singles': self.singles
+        }
+
+        return mapped.get(music_item_type, self.singles) # Returns corresponding dictionary.
+
+    # Chooses the identity index that belongs to the same dictionary as map_music_item.
+    def map_identity_index(self, music_item_type, album_index):
+        if music_item_type == 'song':
+            if album_index is None or album_index not in self.albums:
+                raise ValueError('Invalid album index.')
+            album = self.albums[album_index]
+            album.songs # Reads the songs from storage if the album was not opened yet, so their order is known.
+            return album.identity_index
+        if music_item_type == 'album':
+            return self.album_identities
+        return self.single_identities
+
+    # Replaces a whole dictionary in one pass, used when loading from storage.
+    def load_music_items(self, music_item_type, music_dict, album_index, next_key = 1):
+        if music_item_type == 'song':
+            self.albums[album_index].songs = music_dict
+        elif music_item_type == 'album':
+            self.albums = music_dict
+        else:
+            self.singles = music_dict
+        self.map_identity_index(music_item_type, album_index).rebuild(music_dict, next_key)
+        self.search_index = None # Built again on the next search.
+
+    # Chooses the display order of the same dictionary as map_music_item.
+    def map_positions(self, music_item_type, album_index):
+        return self.map_identity_index(music_item_type, album_index).positions
+
+    # Lists (position, key, music item) in display order, starting at a position.
+    def ordered_music_items(self, music_item_type, album_index, start = 1):
+        music_dict = self.map_music_item(music_item_type, album_index)
+        for position, key in enumerate(self.map_positions(music_item_type, album_index).keys_from(start), start):
+            yield position, key, music_dict[key]
+
+    # Adds music item to relevant dictionary, at the end or at a position. Returns its key or None if it is a duplicate.
+    @timed('add_music_item')
+    def add_music_item(self,music_item_type, music_item, album_index, position = None):
+
+        music_dict = self.map_music_item(music_item_type, album_index)
+        identity_index = self.map_identity_index(music_item_type, album_index)
+
+        if music_item in identity_index:
+            return None
+
+        integer_key = identity_index.add(music_item) # Next free integer key for the new addition.
+        music_dict[integer_key] = music_item
+        if position is not None:
+            identity_index.positions.move(integer_key, position)
+        self.index_music_item(music_item_type, integer_key, music_item, album_index)
+        self.record_change({'op': 'add', 'type': music_item_type, 'album': album_index, 'key': integer_key,
+                            'position': position, 'item': music_item.to_json()})
+        return integer_key
+
+    # Adds many music items to the same dictionary in one pass, returns how many were added.
+    @timed('add_music_items')
+    def add_music_items(self, music_item_type, music_items, album_index):
+        music_dict = self.map_music_item(music_item_type, album_index)
+        identity_index = self.map_identity_index(music_item_type, album_index)
+
+        added = 0
+        for music_item in music_items:
+            if music_item in identity_index: # Skips duplicates, including ones within the batch.
+                continue
+            integer_key = identity_index.add(music_item)
+            music_dict[integer_key] = music_item
+            self.index_music_item(music_item_type, integer_key, music_item, album_index)
+            self.record_change({'op': 'add', 'type': music_item_type, 'album': album_index, 'key': integer_key,
+                                'item': music_item.to_json()})
+            added += 1
+        return added
+
+    # Adds albums that already hold their songs. Songs of albums that are already in the library are added to
+    # the existing album instead. Returns how many albums and songs were added.
+    @timed('import_albums')
+    def import_albums(self, albums):
+        added_albums = added_songs = 0
+        for album in albums:
+            album_index = self.album_identities.key_of(album)
+            if album_index is None:
+                self.add_music_item('album', album, None)
+                added_albums += 1
+                added_songs += len(album.songs)
+            else:
+                added_songs += self.add_music_items('song', album.songs.values(), album_index)
+        return added_albums, added_songs
+
+    # Deletes music item from relevant dictionary, other music items keep their keys.
+    @timed('delete_music_item')
+    def delete_music_item(self, music_item_type, index, album_index):
+        music_dict = self.map_music_item(music_item_type, album_index)
+
+        if index in music_dict:
+            self.map_identity_index(music_item_type, album_index).discard(music_dict[index], index)
+            songs = music_dict if music_item_type == 'song' else None
+            if music_item_type == 'album' and isinstance(music_dict[index].loaded_songs(), ColumnSongs):
+                songs = music_dict[index].loaded_songs()
+                songs.release()
+            del music_dict[index]
+            if isinstance(songs, ColumnSongs):
+                self.compact_columns(songs.columns)
+            if self.search_index is not None:
+                self.search_index.remove(self.search_reference(music_item_type, index, album_index))
+            self.rows.pop((music_item_type, album_index, index), None)
+            self.record_change({'op': 'delete', 'type': music_item_type, 'album': album_index, 'key': index})
+
+    # Frees the rows of deleted songs once they are most of the song columns, by copying the songs of every album that
+    # uses the columns into new ones.
+    def compact_columns(self, columns):
+        if columns.needs_compacting():
+            columns.compact(songs for songs in (album.loaded_songs() for album in self.albums.values())
+                            if isinstance(songs, ColumnSongs) and songs.columns is columns)
+
+    # Moves music item to a new position in the listing.
+    @timed('move_music_item')
+    def move_music_item(self, music_item_type, index, position, album_index):
+        positions = self.map_positions(music_item_type, album_index)
+        if index in positions:
+            positions.move(index, position)
+            self.record_change({'op': 'move', 'type': music_item_type, 'album': album_index, 'key': index,
+                                'position': positions.position(index)})
+
+    # Displays the first page of corresponding music item.
+    def view_music_item(self, music_item_type, album_index):
+        ListingView(self, music_item_type, album_index).render()
+
+    # Text a music item is listed with, formatted the first time it is listed and kept until it is deleted.
+    def formatted_row(self, music_item_type, key, music_item, album_index):
+        reference = (music_item_type, album_index, key)
+        row = self.rows.get(reference)
+        if row is None:
+            row = self.rows[reference] = str(music_item)
+        return row + self.missing_marker(music_item) # Found files can go missing, so this is checked every time.
+
+    # Turns the volume up or down for a track that is starting, using the loudness worked out ahead of time.
+    def apply_gain(self, file_name):
+        if self.loudness is not None and file_name is not None:
+            pygame.mixer.music.set_volume(self.loudness.volume_for(file_name))
+
+    # Plays a track from the decode cache, returns False if it is not there and has to be streamed.
+    def play_decoded(self, file_name):
+        if self.decode_cache is None:
+            return False
+        volume = self.loudness.volume_for(file_name) if self.loudness is not None else 1.0
+        with metrics.span('track_load (decoded)'):
+            sound = self.decode_cache.sound(file_name)
+        if sound is None:
+            return False
+        pygame.mixer.music.stop()
+        self.prefetcher.cancel()
+        self.decode_cache.play_sound(sound, volume)
+        metrics.count('tracks_played_decoded')
+        return True
+
+    # Plays songs.
+    def play_song(self, song):
+        path = self.track_path(song)
+        if path is None: # If song was not given a path or its file is not in the music folders.
+            print('\nRequested song could not be found in folder.')
+            return
+
+        # Stops playback if desired song is currently playing.
+        if music_busy():
+            stop_output()
+
+        # Plays song, straight from the decode cache if it was decoded ahead of time.
+        try:
+            init_mixer()
+            if not self.play_decoded(path):
+                with metrics.span('track_load'):
+                    pygame.mixer.music.load(path) # Loads file.
+                self.apply_gain(path)
+                with metrics.span('track_play'):
+                    pygame.mixer.music.play() # Plays file.
+            self.track_started(song) # Marks the song as the one currently playing.
+            print(f'\nNow playing {song.name} by {song.artist}...')
+        except pygame.error as error:
+            metrics.count('play_errors')
+            print(f'\nError playing {path}: {error}')
+
+    # Stops music.
+    def stop_music(self):
+        self.prefetcher.cancel()
+        if music_busy(): # Checks if pygame is working.
+            stop_output() # Stops music.
+            print('\nMusic stopped...')
+        if self.decode_cache is not None:
+            self.decode_cache.stop()
+        self.now_playing.stop() # Only the playing song and album are marked as playing, so only they are updated.
+
+    # Iterates through each song in an album and plays it.
+    def play_album(self, album_index):
+        if album_index not in self.albums: # If the input index is invalid.
+            print(f'\nAlbum with index {album_index} is invalid.')
+            return
+
+        # Prints error if the album is empty.
+        album = self.albums[album_index]
+        if not album.songs:
+            print(f'\nThe album {album} is currently empty.')
+            return
+
+        self.stop_music()
+
+        self.now_playing.start_album(album_index, album, list(album.identity_index.positions))
+        self.play_current_song()
+
+    # Plays the play queue from the entry listed at a position, or from where it was stopped.
+    def play_queued(self, position = None):
+        self.stop_music()
+        if not self.play_queue.start(position):
+            print('\nThe play queue is empty.')
+            return
+
+        self.now_playing.start_queue()
+        self.play_current_song()
+
+    # Starts radio from a track. Features of tracks that are new or changed are extracted in the background meanwhile.
+    def play_radio(self, reference):
+        if self.radio is None:
+            print('\nRadio needs numpy to compare tracks, please install it (pip install numpy).')
+            return
+        self.features.start(self.radio_tracks())
+        self.stop_music()
+        if not self.radio.start(reference):
+            print('\nThis track has not been analysed yet, radio can start from it once the analysis gets to it.')
+            return
+
+        self.now_playing.start_radio()
+        self.play_current_song()
+
+    # Song or single a play queue or radio reference points to, None if it was deleted from the library.
+    def queued_song(self, reference):
+        music_item_type, album_index, key = reference
+        if music_item_type == 'song':
+            album = self.albums.get(album_index)
+            return album.songs.get(key) if album is not None else None
+        return self.singles.get(key)
+
+    # Whether an album, the play queue or radio is being played through.
+    def playing_through(self):
+        return self.now_playing.album is not None or self.now_playing.from_queue or self.now_playing.radio
+
+    # Whether there is a song after the playing one in the album, play queue or radio.
+    def has_following_song(self):
+        if self.now_playing.album is not None:
+            return self.now_playing.song_key(1) is not None
+        if self.now_playing.radio:
+            return self.radio.reference(1) is not None
+        return self.now_playing.from_queue and self.play_queue.reference(1) is not None
+
+    # Song offset places from the playing one in the album, play queue or radio, None if it was deleted.
+    def song_at(self, offset = 0):
+        now_playing = self.now_playing
+        if now_playing.album is not None:
+            return now_playing.album.songs.get(now_playing.song_key(offset))
+        reference = self.radio.reference(offset) if now_playing.radio else self.play_queue.reference(offset)
+        return self.queued_song(reference) if reference is not None else None
+
+    # Moves on to the next song of the album, play queue or radio, returns False when there are no more songs.
+    def advance_song(self):
+        if self.now_playing.album is not None:
+            return self.now_playing.advance()
+        self.now_playing.end_track()
+        if self.now_playing.radio:
+            return self.radio.advance()
+        return self.play_queue.advance()
+
+    # Marks the song as playing and records the play, and remembers the queue position so a restart carries on from it.
+    def track_started(self, song):
+        metrics.count('plays')
+        if self.history is not None:
+            self.history.record('play', song)
+            if self.decode_cache is not None:
+                self.decode_cache.played(self.history, self.paths.find)
+        self.now_playing.start_track(song)
+        if self.now_playing.from_queue:
+            self.play_queue.save_position()
+
+    # Plays song that is currently active in an album, the play queue or radio.
+    def play_current_song(self):
+        if not self.playing_through():
+            return
+
+        # Songs deleted from the library meanwhile, and songs whose file is missing, are passed over without loading.
+        song = self.song_at()
+        path = self.track_path(song) if song is not None else None
+        while path is None and self.has_following_song():
+            self.skip_missing(song)
+            self.advance_song()
+            song = self.song_at()
+            path = self.track_path(song) if song is not None else None
+        if path is None:
+            self.skip_missing(song)
+            self.next_song()
+            return
+
+        # Plays songs in album, from the decode cache or from memory when the track was read ahead.
+        try:
+            init_mixer()
+            if not self.play_decoded(path):
+                pygame.mixer.stop() # The track before may have come from the decode cache.
+                self.prefetcher.load(path)
+                self.apply_gain(path)
+                with metrics.span('track_play'):
+                    pygame.mixer.music.play()
+            self.track_started(song)
+            print()
+            print(f'\tNow playing {song.name} by {song.artist}...')
+
+        # Handles errors.
+        except pygame.error as error:
+            metrics.count('play_errors')
+            print(f'\nError playing {path}: {error}')
+            return
+
+        self.queue_following_song()
+
+    # Tells that a song of an album or the play queue is passed over because its file is missing.
+    def skip_missing(self, song):
+        if song is not None: # Songs deleted from the library are passed over quietly.
+            metrics.count('missing_files_skipped')
+            print(f'\nSong {song.name} is missing a file, skipping.')
+
+    # Reads the song after the current one while it plays and queues it so there is no gap between them.
+    # Decoded tracks can only be queued behind other decoded tracks, otherwise the next track is read ahead.
+    def queue_following_song(self):
+        if self.has_following_song():
+            next_song = self.song_at(1)
+            path = self.track_path(next_song) if next_song is not None else None
+            if path is None: # Passed over when it is reached.
+                return
+            if self.decode_cache is not None and self.decode_cache.playing():
+                volume = self.loudness.volume_for(path) if self.loudness is not None else 1.0
+                if not self.decode_cache.queue(path, volume):
+                    self.prefetcher.prefetch(path)
+            else:
+                self.prefetcher.queue_next(path)
+
+    # Moves on to the next song of the album, play queue or radio when the current one finishes by itself.
+    def track_finished(self):
+        if not self.playing_through():
+            self.now_playing.stop() # A song played on its own has ended.
+            return
+        if music_busy() and self.has_following_song():
+            # The queued song has already started, only the position has to catch up.
+            self.advance_song()
+            song = self.song_at()
+            if song is not None:
+                self.apply_gain(self.track_path(song))
+                self.track_started(song)
+                print()
+                print(f'\tNow playing {song.name} by {song.artist}...')
+            self.queue_following_song()
+        else:
+            self.next_song()
+
+    # Records that the playing song was skipped.
+    def record_skip(self):
+        song = self.now_playing.music_item
+        if song is not None and self.history is not None:
+            self.history.record('skip', song)
+
+    # Skips current song in album, play queue or radio.
+    def next_song(self):
+        now_playing = self.now_playing
+        if not self.playing_through():
+            return
+
+        # Selects next song to be played.
+        if not self.advance_song():
+            if now_playing.album is not None:
+                print(f'\nAlbum {now_playing.album.name} has finished playing.')
+            elif now_playing.radio:
+                print('\nRadio has run out of tracks that sound alike.')
+            else:
+                print('\nThe play queue has finished playing.')
+                self.play_queue.save_position() # The next start begins from the top.
+            self.stop_music()
+        else:
+            self.play_current_song()
+
+# Append-only log of library changes kept next to the database.
+# Each change costs one short line instead of a rewrite of the whole database.
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0 # Sequence number of the last change written.
+        self.writer = None
+
+    # Writes one change to the end of the journal.
+    def append(self, change):
+        if self.writer is None:
+            self.writer = open(self.path, 'a')
+        self.seq += 1
+        change['seq'] = self.seq
+        self.writer.write(json.dumps(change) + '\n')
+
+    # Writes many changes as one line, so after a crash either all of them are replayed or none are. The sequence
+    # number moves on by the number of changes so a large batch still leads to a compaction.
+    def append_batch(self, changes):
+        if self.writer is None:
+            self.writer = open(self.path, 'a')
+        self.seq += max(len(changes), 1)
+        self.writer.write(json.dumps({'op': 'batch', 'changes': changes, 'seq': self.seq}) + '\n')
+
+    # Makes sure every written change has reached the disk.
+    def commit(self):
+        if self.writer is not None:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+    # Applies changes newer than the snapshot to the library, including ones left over from an unfinished compaction.
+    # A change that was only partly written before a crash is cut off the end of the file, otherwise the next change
+    # would be written onto the end of it and be lost along with it.
+    def replay(self, library, snapshot_seq):
+        self.seq = snapshot_seq
+        for path in (self.path + '.compacting', self.path):
+            try:
+                with open(path, 'rb+') as reader:
+                    good_end = 0 # Where the last complete change ends.
+                    for line in reader:
+                        try:
+                            change = json.loads(line) if line.endswith(b'\n') else None
+                        except ValueError:
+                            change = None
+                        if change is None:
+                            reader.truncate(good_end)
+                            break
+                        good_end += len(line)
+                        if change['seq'] <= self.seq:
+                            continue
+                        library.apply_change(change)
+                        self.seq = change['seq']
+            except FileNotFoundError:
+                continue
+
+    # Moves the current journal aside and starts a new one, the old one is kept until a snapshot includes it.
+    # If a journal moved aside earlier is still there its snapshot failed, so the current journal is added to it
+    # rather than replacing it.
+    def rotate(self):
+        self.commit()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if not os.path.exists(self.path):
+            return
+        if not os.path.exists(self.path + '.compacting'):
+            os.replace(self.path, self.path + '.compacting')
+            return
+        with open(self.path, 'rb') as reader, open(self.path + '.compacting', 'ab') as writer:
+            writer.write(reader.read())
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.remove(self.path) # Changes in both files after a crash here are only replayed once, by sequence number.
+
+    # Removes the journal that was moved aside once the snapshot containing it is in place.
+    def discard_rotated(self):
+        if os.path.exists(self.path + '.compacting'):
+            os.remove(self.path + '.compacting')
+
+# Stores the library in music_database.json with a journal of the changes made since it was last written.
+# The full snapshot is only rewritten every COMPACT_AFTER changes, on a background thread.
+# A binary copy of the snapshot is kept next to it. While it matches the .json file it is read instead, and the
+# songs of each album are only turned into objects when the album is opened, so startup does not parse every song.
+class JsonStore:
+    def __init__(self, path, journal_path, cache_path = None):
+        self.path = path
+        self.journal = Journal(journal_path)
+        self.cache_path = cache_path
+        self.snapshot_seq = 0 # Sequence number already included in the database snapshot.
+        self.compactor = None
+        self.cached_songs = {} # Album key -> songs of that album as stored in the binary copy.
+        self.columns = None # SongColumns holding album songs, used for libraries above COLUMNAR_SONGS_AFTER songs.
+
+    # Loads the library, then brings it up to date with changes saved after the snapshot.
+    def load(self, library):
+        if not self.load_cache(library):
+            self.load_json(library)
+        self.journal.replay(library, self.snapshot_seq)
+
+    # Loads data from .json file.
+    def load_json(self, library):
+        try:
+            with open(self.path, 'rb') as reader:
+                contents = reader.read()
+                data = json.loads(contents)
+                self.snapshot_seq = data.get('journal_seq', 0)
+                self.use_columns(sum(len(album_data.get('songs', {}))
+                                     for album_data in data.get('albums', {}).values()))
+
+                # Gathers data and creates albums from .json file, keeping the keys they were saved with.
+                albums = {}
+                for album_index, album_data in data.get('albums', {}).items():
+                    album = Album(
+                        album_data['name'],
+                        album_data['artist'],
+                        album_data['release_date'],
+                        is_playing=False
+                    )
+
+                    # Gathers data and creates songs from .json file, adding the whole album at once.
+                    if self.columns is not None:
+                        songs = ColumnSongs(self.columns)
+                        for song_index, song_data in album_data.get('songs', {}).items():
+                            songs.rows[int(song_index)] = self.columns.append_row(
+                                song_data['name'],
+                                song_data['artist'],
+                                song_data['release_date'],
+                                album.name,
+                                song_data['file_name']
+                            )
+                    else:
+                        songs = {
+                            int(song_index): Song(
+                                song_data['name'],
+                                song_data['artist'],
+                                song_data['release_date'],
+                                album.name,
+                                song_data['file_name'],
+                            )
+                            for song_index, song_data in album_data.get('songs', {}).items()
+                        }
+                    album.songs = songs
+                    album.identity_index.rebuild(songs, album_data.get('next_song_key', 1))
+                    albums[int(album_index)] = album
+                library.load_music_items('album', albums, None, data.get('next_album_key', 1))
+
+                # Gathers data and creates singles from .json file.
+                singles = {
+                    int(single_index): Single(
+                        single_data['name'],
+                        single_data['artist'],
+                        single_data['release_date'],
+                        single_data['file_name']
+                    )
+                    for single_index, single_data in data.get('singles', {}).items()
+                }
+                library.load_music_items('single', singles, None, data.get('next_single_key', 1))
+
+        # Displays error if the file could not be located.
+        except FileNotFoundError:
+            print('\nUnable to find music database, please ensure it is in the same folder as your script.')
+            return
+
+        self.cached_songs = {}
+        self.write_cache(data, os.stat(self.path), hashlib.sha1(contents).hexdigest())
+
+    # Loads the library from the binary copy if it was made from the current .json file. Returns whether it was used.
+    def load_cache(self, library):
+        if self.cache_path is None:
+            return False
+        try:
+            stat = os.stat(self.path)
+            with open(self.cache_path, 'rb') as reader:
+                cache = marshal.loads(reader.read()) # Much faster than letting marshal read the file piece by piece.
+            (cache_format, size, mtime, digest, journal_seq,
+             next_album_key, next_single_key, song_count, albums, singles) = cache
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if cache_format != LIBRARY_CACHE_FORMAT or size != stat.st_size:
+            return False
+
+        # A .json file that was only touched or copied still matches by its contents, the copy is then marked current.
+        if mtime != stat.st_mtime_ns:
+            if hash_file(self.path) != digest:
+                return False
+            self.save_cache((cache_format, size, stat.st_mtime_ns) + cache[3:])
+
+        self.snapshot_seq = journal_seq
+        self.use_columns(song_count)
+        self.cached_songs = {}
+        album_dict = {}
+        for key, name, artist, release_date, next_song_key, songs in albums:
+            album = Album(name, artist, release_date)
+            album.identity_index.next_key = next_song_key
+            album.song_loader = lambda album, songs = songs: self.songs_from_cache(songs)
+            album_dict[key] = album
+            self.cached_songs[key] = songs
+        library.load_music_items('album', album_dict, None, next_album_key)
+
+        single_dict = {key: Single(name, artist, release_date, file_name)
+                       for key, name, artist, release_date, file_name in singles}
+        library.load_music_items('single', single_dict, None, next_single_key)
+        return True
+
+    # Keeps album songs in columns from now on if the library has more songs than COLUMNAR_SONGS_AFTER.
+    def use_columns(self, song_count):
+        self.columns = SongColumns() if song_count > COLUMNAR_SONGS_AFTER else None
+
+    # Creates the songs of one album from the binary copy.
+    def songs_from_cache(self, songs):
+        if self.columns is not None:
+            column_songs = ColumnSongs(self.columns)
+            for key, name, artist, release_date, album, file_name, music_item_type in marshal.loads(songs):
+                column_songs.rows[key] = self.columns.append_row(name, artist, release_date, album, file_name,
+                                                                 music_item_type == 'Single')
+            return column_songs
+        return {
+            key: Single(name, artist, release_date, file_name) if music_item_type == 'Single'
+            else Song(name, artist, release_date, album, file_name)
+            for key, name, artist, release_date, album, file_name, music_item_type in marshal.loads(songs)
+        }
+
+    # Writes the binary copy of a snapshot in .json form, stamped with the .json file's size, time and hash.
+    def write_cache(self, data, stat, digest):
+        if self.cache_path is None:
+            return
+        albums = []
+        song_count = 0
+        for album_index, album_data in data.get('albums', {}).items():
+            song_count += len(album_data.get('songs', {}))
+            songs = [(int(song_index), song_data['name'], song_data['artist'], song_data['release_date'],
+                      song_data.get('album', album_data['name']), song_data['file_name'],
+                      song_data.get('music_item_type', 'Song'))
+                     for song_index, song_data in album_data.get('songs', {}).items()]
+            albums.append((int(album_index), album_data['name'], album_data['artist'], album_data['release_date'],
+                           album_data.get('next_song_key', 1), marshal.dumps(songs)))
+        singles = [(int(single_index), single_data['name'], single_data['artist'], single_data['release_date'],
+                    single_data['file_name'])
+                   for single_index, single_data in data.get('singles', {}).items()]
+        self.save_cache((LIBRARY_CACHE_FORMAT, stat.st_size, stat.st_mtime_ns, digest, data.get('journal_seq', 0),
+                         data.get('next_album_key', 1), data.get('next_single_key', 1), song_count, albums, singles))
+
+    # Replaces the binary copy. It only speeds up startup, so failing to write it is not an error.
+    def save_cache(self, cache):
+        try:
+            with open(self.cache_path + '.tmp', 'wb') as writer:
+                marshal.dump(cache, writer)
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+        except OSError:
+            pass
+
+    # Lists (album key, song key, name, artist, album, file name) for the songs of albums read from the binary copy.
+    def song_metadata(self):
+        for album_index, songs in self.cached_songs.items():
+            for key, name, artist, release_date, album, file_name, music_item_type in marshal.loads(songs):
+                yield album_index, key, name, artist, album, file_name
+
+    # Writes a change to the journal.
+    def append(self, change):
+        self.journal.append(change)
 
-# Stored within the music library.
-class Single(Song):
-    def __init__(self, name, artist, release_date, file_name):
-        super().__init__(name, artist, release_date, album = 'Single', file_name = file_name)
+    def append_batch(self, changes):
+        self.journal.append_batch(changes)
 
-# Stored within music library, contains songs.
-class Album(MusicItem):
-    def __init__(self, name, artist, release_date, is_playing = False):
-        super().__init__(name, artist, release_date, is_playing = False)
-        self.songs = {}
+    # Saves the journal to disk, and rewrites the snapshot when the journal gets long.
+    def commit(self, library):
+        self.journal.commit()
+        if self.journal.seq - self.snapshot_seq < COMPACT_AFTER:
+            return
+        if self.compactor is not None and self.compactor.is_alive():
+            return
 
-    def __str__(self):
-        formatted_line = f'{self.name}: {self.artist} ({self.release_date})'
-        return formatted_line
+        snapshot = self.copy_library(library)
+        self.journal.rotate()
+        self.compactor = threading.Thread(target = self.write_snapshot, args = snapshot + (self.journal.seq,))
+        self.compactor.start()
 
+    # Copies the library's structure in display order so the menus can keep changing it while the snapshot is written.
+    # Albums that were never opened cannot have changed, their songs are written from the binary copy as they are,
+    # without creating songs or adding rows to the shared columns from the compaction thread.
+    def copy_library(self, library):
+        albums = [
+            (index, album, self.cached_songs[index] if album.song_loader is not None else
+             [(song_index, album.songs[song_index]) for song_index in album.identity_index.positions],
+             album.identity_index.next_key)
+            for position, index, album in library.ordered_music_items('album', None)
+        ]
+        singles = [(index, single) for position, index, single in library.ordered_music_items('single', None)]
+        next_keys = (library.album_identities.next_key, library.single_identities.next_key)
+        return albums, singles, next_keys
 
-    # Retrieves and stores album data from .json file.
-    @classmethod
-    def from_json(cls, data):
-        songs = {}
-        for index, song_data in data.get('songs', {}).items():
-            music_type = song_data.get('music_item_type','Song')
-            if music_type == 'Single':
-                songs[int(index)] = Single.from_json(song_data)
+    # Writes the copied library to the database file and removes the journal it replaces.
+    def write_snapshot(self, albums, singles, next_keys, seq):
+        data = {
+            'journal_seq': seq,
+            'next_album_key': next_keys[0],
+            'next_single_key': next_keys[1],
+            'albums': {},
+            'singles': {index: single.to_json() for index, single in singles}
+        }
+        for index, album, songs, next_song_key in albums:
+            album_data = MusicItem.to_json(album)
+            if isinstance(songs, bytes): # Songs of an album that was never opened, as kept in the binary copy.
+                album_data['songs'] = {
+                    key: {'name': name, 'artist': artist, 'release_date': release_date,
+                          'music_item_type': music_item_type, 'album': album_name, 'file_name': file_name}
+                    for key, name, artist, release_date, album_name, file_name, music_item_type in marshal.loads(songs)
+                }
             else:
-                songs[int(index)] = Song.from_json(song_data)
+                album_data['songs'] = {song_index: song.to_json() for song_index, song in songs}
+            album_data['next_song_key'] = next_song_key
+            data['albums'][index] = album_data
 
-        album = cls(
-            name = data.get('name'),
-            artist = data.get('artist'),
-            release_date = data.get('release_date')
-        )
+        try:
+            write_database(self.path, data)
+            self.snapshot_seq = seq # Only once it is written, so a failed snapshot is tried again on the next save.
+            self.journal.discard_rotated()
+            self.write_cache(data, os.stat(self.path), hash_file(self.path))
+        except Exception as error:
+            print(f'\nError compacting library: {error}')
 
-        album.songs = songs
-        return album
+# Stores the library in an SQLite database. Albums are listed at startup but their songs are only read
+# when the album is opened, so startup time and memory do not grow with the number of songs.
+# Display order is kept in a position column, moving a row only changes its own position.
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS albums (
+                id INTEGER PRIMARY KEY, key INTEGER, name TEXT, artist TEXT, release_date TEXT, position REAL,
+                next_song_key INTEGER DEFAULT 1);
+            CREATE TABLE IF NOT EXISTS songs (
+                id INTEGER PRIMARY KEY, album_id INTEGER, key INTEGER, name TEXT, artist TEXT,
+                release_date TEXT, album TEXT, file_name TEXT, music_item_type TEXT, position REAL);
+            CREATE TABLE IF NOT EXISTS singles (
+                id INTEGER PRIMARY KEY, key INTEGER, name TEXT, artist TEXT, release_date TEXT, file_name TEXT,
+                position REAL);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE INDEX IF NOT EXISTS albums_key ON albums (key);
+            CREATE INDEX IF NOT EXISTS albums_position ON albums (position);
+            CREATE INDEX IF NOT EXISTS albums_name ON albums (name);
+            CREATE INDEX IF NOT EXISTS albums_artist ON albums (artist);
+            CREATE INDEX IF NOT EXISTS songs_album_key ON songs (album_id, key);
+            CREATE INDEX IF NOT EXISTS songs_album_position ON songs (album_id, position);
+            CREATE INDEX IF NOT EXISTS songs_name ON songs (name);
+            CREATE INDEX IF NOT EXISTS songs_artist ON songs (artist);
+            CREATE INDEX IF NOT EXISTS songs_album ON songs (album);
+            CREATE INDEX IF NOT EXISTS singles_key ON singles (key);
+            CREATE INDEX IF NOT EXISTS singles_position ON singles (position);
+            CREATE INDEX IF NOT EXISTS singles_name ON singles (name);
+            CREATE INDEX IF NOT EXISTS singles_artist ON singles (artist);
+        ''')
 
-    # Writes album data to .json file.
-    def to_json(self):
-        data = super().to_json()
-        data.update({
-            'songs': {index: song.to_json() for index, song in self.songs.items()}
-        })
-        return data
+    # Reads a saved next key counter.
+    def counter(self, name):
+        row = self.connection.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 1
 
-# Holds and manipulates all music items.
-class Library:
-    def __init__(self):
-        self.albums = {}
-        self.singles = {}
-        self.current_album = None
-        self.current_song_index = None
-        self.current_song_keys = []
+    # Lists albums and singles, songs are left to be loaded by each album when it is first opened.
+    def load(self, library):
+        albums = {}
+        for album_id, key, name, artist, release_date, next_song_key in self.connection.execute(
+                'SELECT id, key, name, artist, release_date, next_song_key FROM albums ORDER BY position'):
+            album = Album(name, artist, release_date)
+            album.identity_index.next_key = next_song_key or 1
+            album.song_loader = lambda album, album_id = album_id: self.load_songs(album_id)
+            albums[key] = album
+        library.load_music_items('album', albums, None, self.counter('album'))
 
-    # Chooses a dictionary based on music item type.
-    def map_music_item(self, music_item_type, album_index):
-        if music_item_type == 'song':
-            if album_index is None or album_index not in self.albums:
-                raise ValueError('Invalid album index.')
-            return self.albums[album_index].songs
-        mapped = {
-                'album': self.albums,
-                'singles': self.singles
+        singles = {
+            key: Single(name, artist, release_date, file_name)
+            for key, name, artist, release_date, file_name in self.connection.execute(
+                'SELECT key, name, artist, release_date, file_name FROM singles ORDER BY position')
         }
+        library.load_music_items('single', singles, None, self.counter('single'))
 
-        return mapped.get(music_item_type, self.singles) # Returns corresponding dictionary.
+    # Reads the songs of one album.
+    def load_songs(self, album_id):
+        songs = {}
+        for key, name, artist, release_date, album, file_name, music_item_type in self.connection.execute(
+                'SELECT key, name, artist, release_date, album, file_name, music_item_type FROM songs '
+                'WHERE album_id = ? ORDER BY position', (album_id,)):
+            if music_item_type == 'Single':
+                songs[key] = Single(name, artist, release_date, file_name)
+            else:
+                songs[key] = Song(name, artist, release_date, album, file_name)
+        return songs
 
-    # Updates dictionary with new index for elements, used to update indexes when a song is removed from an album.
-    def reindex(self, music_item_type, album_index = None):
-        music_dict = self.map_music_item(music_item_type, album_index)
-        new_dict = {index + 1: music_item for index, music_item in enumerate(music_dict.values())}
+    # Lists (album key, song key, name, artist, album, file name) for every song without creating Song objects.
+    def song_metadata(self):
+        return self.connection.execute(
+            'SELECT albums.key, songs.key, songs.name, songs.artist, songs.album, songs.file_name FROM songs '
+            'JOIN albums ON albums.id = songs.album_id')
+
+    # Works out the position value that puts a row at a display position among the other rows of its group.
+    def position_value(self, table, group, group_args, row_id, position):
+        others = f'SELECT position FROM {table} WHERE {group} AND id != ? ORDER BY position'
+        if position is None:
+            last = self.connection.execute(f'SELECT MAX(position) FROM {table} WHERE {group}', group_args).fetchone()[0]
+            return (last or 0) + 1
+
+        for attempt in range(2):
+            if position <= 1:
+                before = None
+                row = self.connection.execute(others + ' LIMIT 1', group_args + (row_id,)).fetchone()
+                after = row[0] if row else None
+            else:
+                rows = self.connection.execute(others + ' LIMIT 2 OFFSET ?', group_args + (row_id, position - 2)).fetchall()
+                before = rows[0][0] if rows else None
+                after = rows[1][0] if len(rows) > 1 else None
+                if before is None: # Position is past the end.
+                    return self.position_value(table, group, group_args, row_id, None)
+
+            if before is None:
+                return after - 1 if after is not None else 1
+            if after is None:
+                return before + 1
+            middle = (before + after) / 2
+            if before < middle < after:
+                return middle
+
+            # No room left between the neighbours, so the group is spread out again.
+            rows = self.connection.execute(f'SELECT id FROM {table} WHERE {group} ORDER BY position', group_args)
+            self.connection.executemany(f'UPDATE {table} SET position = ? WHERE id = ?',
+                                        [(index, row_id) for index, (row_id,) in enumerate(rows.fetchall(), start = 1)])
+        return middle
+
+    # Applies a change to the database, it becomes permanent on the next commit.
+    def append(self, change):
+        music_item_type = change['type']
         if music_item_type == 'song':
-            self.albums[album_index].songs = new_dict
+            album_id = self.connection.execute('SELECT id FROM albums WHERE key = ?', (change['album'],)).fetchone()[0]
+            table, group, group_args = 'songs', 'album_id = ?', (album_id,)
         elif music_item_type == 'album':
-            self.albums = new_dict
+            table, group, group_args = 'albums', '1 = 1', ()
         else:
-            self.singles = new_dict
+            table, group, group_args = 'singles', '1 = 1', ()
+        row = self.connection.execute(f'SELECT id FROM {table} WHERE {group} AND key = ?',
+                                      group_args + (change['key'],)).fetchone()
+        row_id = row[0] if row else None
 
-    # Adds music item to relevant dictionary.
-    def add_music_item(self,music_item_type, music_item, album_index):
+        match change['op']:
+            case 'add':
+                item = change['item']
+                position = self.position_value(table, group, group_args, -1, change.get('position'))
+                if music_item_type == 'album':
+                    album_id = self.connection.execute(
+                        'INSERT INTO albums (key, name, artist, release_date, position, next_song_key) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (change['key'], item['name'], item['artist'], item['release_date'], position,
+                         item.get('next_song_key', 1))).lastrowid
+                    self.connection.executemany( # Albums can be added together with their songs.
+                        'INSERT INTO songs (album_id, key, name, artist, release_date, album, file_name, '
+                        'music_item_type, position) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(album_id, int(song_key), song['name'], song['artist'], song['release_date'], song['album'],
+                          song['file_name'], song['music_item_type'], song_position)
+                         for song_position, (song_key, song) in enumerate(item.get('songs', {}).items(), start = 1)])
+                    self.connection.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', ('album', change['key'] + 1))
+                elif music_item_type == 'song':
+                    self.connection.execute(
+                        'INSERT INTO songs (album_id, key, name, artist, release_date, album, file_name, '
+                        'music_item_type, position) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (album_id, change['key'], item['name'], item['artist'], item['release_date'], item['album'],
+                         item['file_name'], item['music_item_type'], position))
+                    self.connection.execute('UPDATE albums SET next_song_key = ? WHERE id = ?',
+                                            (change['key'] + 1, album_id))
+                else:
+                    self.connection.execute(
+                        'INSERT INTO singles (key, name, artist, release_date, file_name, position) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (change['key'], item['name'], item['artist'], item['release_date'], item['file_name'], position))
+                    self.connection.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', ('single', change['key'] + 1))
+            case 'delete':
+                if music_item_type == 'album':
+                    self.connection.execute('DELETE FROM songs WHERE album_id = ?', (row_id,))
+                self.connection.execute(f'DELETE FROM {table} WHERE id = ?', (row_id,))
+            case 'move':
+                position = self.position_value(table, group, group_args, row_id, change['position'])
+                self.connection.execute(f'UPDATE {table} SET position = ? WHERE id = ?', (position, row_id))
 
-        music_dict = self.map_music_item(music_item_type, album_index)
+    # Writes many changes in one transaction, the next commit saves them together.
+    def append_batch(self, changes):
+        try:
+            for change in changes:
+                self.append(change)
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
 
-        if music_item in music_dict.values():
-            return None
+    def commit(self, library):
+        self.connection.commit()
 
-        integer_key = max(music_dict.keys(), default=0) + 1 # Takes max integer key in dict and adds 1 for the new addition.
-        music_dict[integer_key] = music_item
+    # Copies a whole library into the database in one transaction.
+    def import_library(self, library):
+        with self.connection:
+            for position, key, album in library.ordered_music_items('album', None):
+                album_id = self.connection.execute(
+                    'INSERT INTO albums (key, name, artist, release_date, position, next_song_key) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, album.name, album.artist, album.release_date, position,
+                     album.identity_index.next_key)).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO songs (album_id, key, name, artist, release_date, album, file_name, music_item_type, '
+                    'position) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(album_id, song_key, song.name, song.artist, song.release_date, song.album, song.file_name,
+                      song.kind(), song_position)
+                     for song_position, song_key, song in library.ordered_music_items('song', key)])
+            self.connection.executemany(
+                'INSERT INTO singles (key, name, artist, release_date, file_name, position) VALUES (?, ?, ?, ?, ?, ?)',
+                [(key, single.name, single.artist, single.release_date, single.file_name, position)
+                 for position, key, single in library.ordered_music_items('single', None)])
+            self.connection.executemany('INSERT OR REPLACE INTO counters VALUES (?, ?)',
+                                        [('album', library.album_identities.next_key),
+                                         ('single', library.single_identities.next_key)])
 
-    # Deletes music item from relevant dictionary.
-    def delete_music_item(self, music_item_type, index, album_index):
-        music_dict = self.map_music_item(music_item_type, album_index)
+# Records plays and skips in a SQLite database next to the library. Playback only puts events on a queue, a writer
+# thread saves whatever has piled up in one transaction and updates the per-track and per-month counts with it, so
+# questions like "most played this month" read the counts instead of scanning the history.
+class PlayHistory:
+    def __init__(self, path):
+        self.path = path
+        self.events = queue.Queue()
+        self.writer = None # Writer thread, started with the first event.
+        self.lock = threading.Lock() # The writer and the menus share the connection.
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, kind TEXT NOT NULL, at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS tracks (
+                file_name TEXT PRIMARY KEY, name TEXT, artist TEXT, plays INTEGER NOT NULL DEFAULT 0,
+                skips INTEGER NOT NULL DEFAULT 0, last_played REAL);
+            CREATE TABLE IF NOT EXISTS monthly_plays (
+                month TEXT NOT NULL, file_name TEXT NOT NULL, plays INTEGER NOT NULL,
+                PRIMARY KEY (month, file_name)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS tracks_plays ON tracks (plays);
+            CREATE INDEX IF NOT EXISTS monthly_plays_count ON monthly_plays (month, plays);
+        ''')
 
-        if index in music_dict:
-            del music_dict[index]
-            self.reindex(music_item_type, album_index)
+    # Queues a 'play' or 'skip' of a song or single, returns straight away.
+    def record(self, kind, song):
+        if not song.file_name:
+            return
+        if self.writer is None:
+            self.writer = threading.Thread(target = self.write_events, daemon = True)
+            self.writer.start()
+        self.events.put((kind, song.file_name, song.name, song.artist, time.time()))
 
-    # Displays corresponding music item.
-    def view_music_item(self, music_item_type, album_index):
-        music_dict = self.map_music_item(music_item_type, album_index)
+    # Saves events as they arrive, everything that queued up while the last batch was written goes in the next one.
+    def write_events(self):
+        while True:
+            batch = [self.events.get()]
+            while len(batch) < HISTORY_BATCH_SIZE:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with metrics.span('history_write'):
+                    self.write_batch([event for event in batch if event is not None])
+            except sqlite3.Error as error:
+                metrics.count('history_errors')
+                print(f'\nError saving play history: {error}')
+            for _ in batch:
+                self.events.task_done()
+            if None in batch: # Sent by close().
+                return
 
-        for integer, music_item in music_dict.items():
-            print(f'{integer}: {music_item}')
+    # Adds a batch of events and folds them into the counts, summed per track first so each track is updated once.
+    def write_batch(self, batch):
+        tracks = {} # File name -> [name, artist, plays, skips, last played].
+        months = collections.Counter()
+        for kind, file_name, name, artist, at in batch:
+            track = tracks.setdefault(file_name, [name, artist, 0, 0, None])
+            track[0], track[1] = name, artist # The latest names win.
+            if kind == 'play':
+                track[2] += 1
+                track[4] = at if track[4] is None else max(track[4], at)
+                months[(time.strftime('%Y-%m', time.localtime(at)), file_name)] += 1
+            else:
+                track[3] += 1
 
-    # Plays songs.
-    @staticmethod
-    def play_song(song):
-        if not song.file_name: # If song was not given a path.
-            print('\nRequested song could not be found in folder.')
-            return
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO events (kind, file_name, at) VALUES (?, ?, ?)',
+                                        [(kind, file_name, at) for kind, file_name, name, artist, at in batch])
+            self.connection.executemany('''
+                INSERT INTO tracks (file_name, name, artist, plays, skips, last_played) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_name) DO UPDATE SET
+                    name = excluded.name, artist = excluded.artist, plays = plays + excluded.plays,
+                    skips = skips + excluded.skips,
+                    last_played = coalesce(max(last_played, excluded.last_played), last_played, excluded.last_played)
+            ''', [(file_name,) + tuple(track) for file_name, track in tracks.items()])
+            self.connection.executemany('''
+                INSERT INTO monthly_plays (month, file_name, plays) VALUES (?, ?, ?)
+                ON CONFLICT (month, file_name) DO UPDATE SET plays = plays + excluded.plays
+            ''', [(month, file_name, plays) for (month, file_name), plays in months.items()])
 
-        # Stops playback if desired song is currently playing.
-        if pygame.mixer.music.get_busy():
-            pygame.mixer.music.stop()
+    # Waits until every event recorded so far has been saved.
+    def flush(self):
+        if self.writer is not None:
+            self.events.join()
+
+    # Most played tracks as (name, artist, plays), for a month ('YYYY-MM') or of all time.
+    def most_played(self, month = None, limit = 10):
+        self.flush()
+        with self.lock:
+            if month is None:
+                return self.connection.execute('SELECT name, artist, plays FROM tracks WHERE plays > 0 '
+                                               'ORDER BY plays DESC, last_played DESC LIMIT ?', (limit,)).fetchall()
+            return self.connection.execute('SELECT name, artist, monthly_plays.plays FROM monthly_plays '
+                                           'JOIN tracks USING (file_name) WHERE month = ? '
+                                           'ORDER BY monthly_plays.plays DESC, last_played DESC LIMIT ?',
+                                           (month, limit)).fetchall()
+
+    # File names of the most played tracks, most played first.
+    def most_played_files(self, limit):
+        self.flush()
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT file_name FROM tracks WHERE plays > 0 '
+                                                              'ORDER BY plays DESC, last_played DESC LIMIT ?',
+                                                              (limit,))]
+
+    # Plays, skips and when a file was last played, as (plays, skips, last_played), zeros if it never was.
+    def track_stats(self, file_name):
+        self.flush()
+        with self.lock:
+            row = self.connection.execute('SELECT plays, skips, last_played FROM tracks WHERE file_name = ?',
+                                          (file_name,)).fetchone()
+        return row if row is not None else (0, 0, None)
 
-        # Plays song.
+    # Saves what is still queued and stops the writer.
+    def close(self):
+        if self.writer is not None:
+            self.events.put(None)
+            self.writer.join()
+            self.writer = None
+        with self.lock:
+            self.connection.close()
+
+# Writes a database snapshot to a temporary file and swaps it in, so a crash never leaves a half written database.
+def write_database(path, data):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as writer:
+        json.dump(data, writer, indent = 4)
+        writer.flush()
+        os.fsync(writer.fileno())
+    os.replace(temp_file, path)
+
+# Opens the storage backend chosen by STORAGE_BACKEND.
+def open_store():
+    if STORAGE_BACKEND != 'sqlite':
+        return JsonStore(DATABASE_FILE, JOURNAL_FILE, LIBRARY_CACHE_FILE)
+
+    # The first time SQLite is used, the existing .json library is copied into it. The copy is made in a temporary file
+    # that only takes the database's name once it is complete, so a copy that is interrupted is made again next time.
+    if not os.path.exists(SQLITE_FILE) and os.path.exists(DATABASE_FILE):
+        print('\nMoving music database to SQLite, this only happens once...')
+        json_library = Library()
+        JsonStore(DATABASE_FILE, JOURNAL_FILE).load(json_library)
+        temp_file = SQLITE_FILE + '.tmp'
+        if os.path.exists(temp_file):
+            os.remove(temp_file) # Left by a copy that was interrupted.
+        sqlite_store = SqliteStore(temp_file)
         try:
-            pygame.mixer.music.load(song.file_name) # Loads file.
-            pygame.mixer.music.play() # Plays file.
-            song.is_playing = False # Sets condition of music item to state that it is currently playing.
-            print(f'\nNow playing {song.name} by {song.artist}...')
-        except pygame.error as error:
-            print(f'\nError playing {song.file_name}: {error}')
+            sqlite_store.import_library(json_library)
+        finally:
+            sqlite_store.connection.close()
+        os.replace(temp_file, SQLITE_FILE)
+    return SqliteStore(SQLITE_FILE)
 
-    # Stops music.
-    def stop_music(self):
-        if pygame.mixer.music.get_busy(): # Checks if pygame is working.
-            pygame.mixer.music.stop() # Stops music.
-            print('\nMusic stopped...')
+# Reads the tags of one audio file. Runs in a worker process, so it only uses plain data.
+def read_tags(path):
+    folder_name = os.path.basename(os.path.dirname(path))
+    tags = {
+        'name': os.path.splitext(os.path.basename(path))[0],
+        'artist': 'Unknown Artist',
+        'album': folder_name or 'Imported',
+        'album_artist': None,
+        'release_date': '',
+        'track': 0
+    }
+    if mutagen is None:
+        return tags
 
-        for album in self.albums.values(): # Updates all albums, is playing value to False.
-            album.is_playing = False
+    try:
+        audio = mutagen.File(path, easy = True) # Easy tags use the same names for ID3 and Vorbis comments.
+    except Exception:
+        return tags
+    if audio is None or not audio.tags:
+        return tags
 
-            for song in album.songs.values(): # Updates all songs, is playing value to False.
-                song.is_playing = False
+    # Returns the first value of a tag, or None when the file does not have it.
+    def first(tag):
+        values = audio.tags.get(tag)
+        return str(values[0]).strip() if values else None
 
-        for single in self.singles.values(): # Updates all singles, is playing value to False.
-            single.is_playing = False
-        self.current_album = None
-        self.current_song_index = None
-        self.current_song_keys = [] # List that gathers active song's key and updates it when finished playing for sequencing albums.
+    tags['name'] = first('title') or tags['name']
+    tags['artist'] = first('artist') or tags['artist']
+    tags['album'] = first('album') or tags['album']
+    tags['album_artist'] = first('albumartist')
+    tags['release_date'] = first('date') or ''
+    track = (first('tracknumber') or '').split('/')[0] # Track numbers can look like "3/12".
+    tags['track'] = int(track) if track.isdigit() else 0
+    return tags
 
-    # Iterates through each song in an album and plays it.
-    def play_album(self, album_index):
-        if album_index not in self.albums: # If the input index is invalid.
-            print(f'\nAlbum with index {album_index} is invalid.')
-            return
+# Finds audio files in a folder and its subfolders and reads their tags, reusing tags from earlier scans for files
+# whose size and modification time have not changed. New or changed files are read by a pool of processes.
+def scan_folder(folder):
+    try:
+        with open(SCAN_CACHE_FILE, 'r') as reader:
+            cache = json.load(reader)
+    except (FileNotFoundError, ValueError):
+        cache = {}
 
-        # Prints error if the album is empty.
-        album = self.albums[album_index]
-        if not album.songs:
-            print(f'\nThe album {album} is currently empty.')
-            return
+    # Lists every audio file with its size and modification time.
+    files = []
+    pending = [folder]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks = False):
+                pending.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                stat = entry.stat()
+                files.append((os.path.abspath(entry.path), stat.st_size, stat.st_mtime_ns))
 
-        self.stop_music()
+    changed = [(path, size, mtime) for path, size, mtime in files if cache.get(path, [None, None])[:2] != [size, mtime]]
+    if changed:
+        # Workers are started from scratch like FeatureIndex's, forking while playback threads run can hang them.
+        with concurrent.futures.ProcessPoolExecutor(mp_context = multiprocessing.get_context('spawn')) as executor:
+            paths = [path for path, size, mtime in changed]
+            for (path, size, mtime), tags in zip(changed, executor.map(read_tags, paths, chunksize = 64)):
+                cache[path] = [size, mtime, tags]
 
-        self.current_album = album
-        self.current_song_keys = sorted(album.songs.keys())
-        self.current_song_index = 0
-        self.play_current_song()
+        with open(SCAN_CACHE_FILE + '.tmp', 'w') as writer:
+            json.dump(cache, writer)
+        os.replace(SCAN_CACHE_FILE + '.tmp', SCAN_CACHE_FILE)
 
-    # Plays song that is currently active in an album.
-    def play_current_song(self):
-        if self.current_album is None or self.current_song_index is None:
-            return
+    return [(path, cache[path][2]) for path, size, mtime in files], len(changed)
 
-        song_key = self.current_song_keys[self.current_song_index]
-        song = self.current_album.songs[song_key]
+# File name a track is stored with. Files under a music root are stored relative to it, like the songs that come with
+# the player, so the library still finds them if the root moves. Files anywhere else keep their full path.
+def root_relative_path(path):
+    path = os.path.abspath(path)
+    for root in MUSIC_ROOTS:
+        root = os.path.abspath(root)
+        try:
+            if os.path.commonpath([root, path]) == root:
+                return os.path.relpath(path, root)
+        except ValueError: # On different drives.
+            pass
+    return path
 
-        if not song.file_name:
-            print(f'\nSong {song.name} is missing a file, skipping.') # If song has no path.
-            return
+# Groups scanned files into albums, ordered by track number.
+def group_into_albums(scanned):
+    groups = {}
+    for path, tags in scanned:
+        album_artist = tags['album_artist'] or tags['artist']
+        groups.setdefault((tags['album'], album_artist), []).append((tags['track'], tags['name'], path, tags))
+
+    albums = []
+    for (album_name, album_artist), tracks in groups.items():
+        tracks.sort(key = lambda track: (track[0], track[1]))
+        album = Album(album_name, album_artist, tracks[0][3]['release_date'])
+        for track, name, path, tags in tracks:
+            song = Song(name, tags['artist'], tags['release_date'], album_name, root_relative_path(path))
+            if song not in album.identity_index:
+                album.songs[album.identity_index.add(song)] = song
+        albums.append(album)
+    return albums
 
+# Lets other programs control one player over a local connection, one JSON object per line. A request looks like
+# {"id": 1, "cmd": "play", "album": 3} and is answered with {"id": 1, "ok": true, "result": ...} or an "error".
+# Commands are list, search, add, delete, play, queue, unqueue, skip, stop, state and subscribe.
+# Subscribed clients are sent {"event": "now_playing", "state": ...} whenever playback changes.
+# Every read and change of the library runs in order on one library thread, so clients never see it half changed and
+# the event loop keeps serving while changes are saved. Changes that arrive while a save is running are saved
+# together by the next one.
+class ControlServer:
+    def __init__(self, library, engine):
+        self.library = library
+        self.engine = engine
+        self.library_thread = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.version = 0 # Number of changes made, read and written on the library thread only.
+        self.saved_version = 0 # Number of changes saved.
+        self.subscribers = set()
+        self.loop = None
 
-        # Plays songs in album.
+    # Accepts clients until the program is stopped.
+    async def serve_forever(self, host = CONTROL_HOST, port = CONTROL_PORT):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, host, port, limit = CONTROL_BUFFER_LIMIT)
+        self.library.now_playing.subscribe(self.playback_changed)
+        print(f'\nControl server listening on {host}:{port}.')
         try:
-            pygame.mixer.music.load(song.file_name)
-            pygame.mixer.music.play()
-            song.is_playing = True
-            print()
-            print(f'\tNow playing {song.name} by {song.artist}...')
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.library.now_playing.unsubscribe(self.playback_changed) # The loop is closing, events have nowhere to go.
 
-        # Handles errors.
-        except pygame.error as error:
-            print(f'\nError playing {song.file_name}: {error}')
+    # Reads requests from one client and answers them in order.
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = None
+                try:
+                    request = json.loads(line)
+                    result = await self.handle(request, writer)
+                    response = {'id': request.get('id'), 'ok': True, 'result': result}
+                except (ValueError, KeyError, TypeError, IndexError, AttributeError) as error:
+                    request_id = request.get('id') if isinstance(request, dict) else None
+                    response = {'id': request_id, 'ok': False, 'error': str(error)}
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
 
-    # Skips current song in album.
-    def next_song(self):
-        if self.current_album is None:
-            return
+    # Runs a function on the library thread.
+    def run(self, function, *args):
+        return self.loop.run_in_executor(self.library_thread, function, *args)
 
-        index = self.current_song_keys[self.current_song_index]
-        self.current_album.songs[index].is_playing = False
+    # Changes the library on the library thread and answers once the change has been saved.
+    async def change(self, function, *args):
+        result, version = await self.run(self.apply, function, args)
+        while self.saved_version < version:
+            await self.run(self.save)
+        return result
 
-        # Selects next song in album to be played.
-        self.current_song_index += 1
-        if self.current_song_index >= len(self.current_song_keys):
+    def apply(self, function, args):
+        result = function(*args)
+        self.version += 1
+        return result, self.version
 
-            print(f'\nAlbum {self.current_album.namme} has finished playing.')
-            self.stop_music()
-        else:
-            self.play_current_song()
+    # Saves every change made so far, if another save has not done it already.
+    def save(self):
+        if self.saved_version < self.version:
+            version = self.version
+            self.library.store.commit(self.library)
+            self.saved_version = version
+
+    async def handle(self, request, writer):
+        library = self.library
+        music_item_type = request.get('type')
+        album_index = request.get('album')
+
+        match request['cmd']:
+            case 'list':
+                start = request.get('start', 1)
+                count = request.get('count', 50)
+                return await self.run(self.list_items, music_item_type, album_index, start, count)
+            case 'search':
+                results = await self.run(library.search, request['query'], request.get('limit', 20))
+                return [{'type': result_type, 'key': key, 'album': result_album, 'item': music_item.to_json()}
+                        for result_type, key, result_album, music_item in results]
+            case 'add':
+                return await self.change(self.add_item, music_item_type, request['item'], album_index,
+                                         request.get('position'))
+            case 'delete':
+                await self.change(self.delete_item, music_item_type, request['key'], album_index)
+                return None
+            case 'play':
+                if request.get('queue'):
+                    position = request.get('position')
+                    if position is not None:
+                        await self.run(self.check_queue_position, position)
+                    self.engine.send('play_queue', position)
+                elif music_item_type in ('song', 'single'):
+                    music_dict = await self.run(library.map_music_item, music_item_type, album_index)
+                    self.engine.send('play_song', music_dict[request['key']])
+                else:
+                    self.engine.send('play_album', album_index)
+                return None
+            case 'queue':
+                if 'key' in request:
+                    reference = library.search_reference(music_item_type, request['key'], album_index)
+                    await self.run(self.queue_add, reference, request.get('next', False))
+                return await self.run(self.queue_entries)
+            case 'unqueue':
+                await self.run(self.queue_remove, request['position'])
+                return await self.run(self.queue_entries)
+            case 'radio':
+                self.engine.send('play_radio', library.search_reference(music_item_type, request['key'], album_index))
+                return None
+            case 'skip' | 'stop':
+                self.engine.send(request['cmd'])
+                return None
+            case 'state':
+                return self.playback_state(library.now_playing)
+            case 'stats':
+                return metrics.snapshot()
+            case 'most_played':
+                rows = await self.run(library.history.most_played, request.get('month'), request.get('limit', 10))
+                return [{'name': name, 'artist': artist, 'plays': plays} for name, artist, plays in rows]
+            case 'subscribe':
+                self.subscribers.add(writer)
+                return self.playback_state(library.now_playing)
+            case command:
+                raise ValueError(f'Unknown command "{command}".')
+
+    # Adds a music item checked the same way as in batch mode. Returns its key, or None if it is a duplicate.
+    def add_item(self, music_item_type, data, album_index, position):
+        if music_item_type not in ('album', 'song', 'single'):
+            raise ValueError(f'Unknown type "{music_item_type}", use album, song or single.')
+        self.library.map_music_item(music_item_type, album_index) # Raises ValueError for an album that does not exist.
+        music_item = batch_music_item(music_item_type, data, album_index)
+        return self.library.add_music_item(music_item_type, music_item, album_index, position)
+
+    def delete_item(self, music_item_type, key, album_index):
+        if music_item_type not in ('album', 'song', 'single'):
+            raise ValueError(f'Unknown type "{music_item_type}", use album, song or single.')
+        if key not in self.library.map_music_item(music_item_type, album_index):
+            raise ValueError(f'There is no {music_item_type} with key {key}.')
+        self.library.delete_music_item(music_item_type, key, album_index)
+
+    # Lists count music items in display order from a position, as plain data.
+    def list_items(self, music_item_type, album_index, start, count):
+        items = itertools.islice(self.library.ordered_music_items(music_item_type, album_index, start), count)
+        return [{'position': position, 'key': key, 'item': music_item.to_json()} for position, key, music_item in items]
+
+    # Adds a song or single to the play queue, at the end or right after the playing entry.
+    def queue_add(self, reference, play_next):
+        if reference[0] == 'album' or self.library.queued_song(reference) is None:
+            raise ValueError('Only songs and singles in the library can be queued.')
+        self.library.play_queue.add(reference, play_next)
+        self.library.play_queue.save()
+
+    # Raises ValueError unless a play queue entry is listed at a position, so playing it cannot fail on the playback
+    # thread.
+    def check_queue_position(self, position):
+        if not isinstance(position, int) or not 1 <= position <= len(self.library.play_queue):
+            raise ValueError(f'There is no play queue entry at position {position}.')
+
+    # Removes the play queue entry listed at a position.
+    def queue_remove(self, position):
+        self.library.play_queue.remove_at(position)
+        self.library.play_queue.save()
+
+    # Play queue in listed order, as plain data.
+    def queue_entries(self):
+        return [{'position': position, 'type': music_item_type, 'album': album_index, 'key': key, 'current': is_current}
+                for position, (music_item_type, album_index, key), is_current
+                in self.library.play_queue.ordered_entries()]
+
+    # Playback state as plain data.
+    @staticmethod
+    def playback_state(now_playing):
+        state = now_playing.snapshot()
+        music_item = state.pop('music_item')
+        state['album'] = state.pop('album_index')
+        state['playing'] = music_item.to_json() if music_item is not None else None
+        return state
+
+    # Called by the playback thread, hands the new state to the event loop to send out.
+    def playback_changed(self, now_playing):
+        event = json.dumps({'event': 'now_playing', 'state': self.playback_state(now_playing)}).encode('utf-8') + b'\n'
+        self.loop.call_soon_threadsafe(self.broadcast, event)
+
+    # Sends an event to every subscriber. Clients that stopped reading are disconnected instead of holding up the rest.
+    def broadcast(self, event):
+        for writer in list(self.subscribers):
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > CONTROL_BUFFER_LIMIT:
+                self.subscribers.discard(writer)
+                writer.close()
+            else:
+                writer.write(event)
 
 music_library = Library() # Creates library for program use.
+player = PlaybackEngine(music_library) # Plays music in the background.
+store = None # Where the library is saved, opened by load_data.
 
-# Loads data from .json file.
+# Opens storage and loads the library from it, then starts recording changes to it.
+@timed('load_data')
 def load_data():
-    try:
-        with open('music_database.json', 'r') as reader:
-            data = json.load(reader)
-
-            # Gathers data and creates albums from .json file.
-            for album_index, album_data in data.get('albums', {}).items():
-                album = Album(
-                    album_data['name'],
-                    album_data['artist'],
-                    album_data['release_date'],
-                    is_playing=False
-                )
-                music_library.add_music_item('album', album, None)
-
-                album_index = max(music_library.albums.keys()) # Indexes albums.
-
-                # Gathers data and creates songs from .json file.
-                for song_index, song_data in album_data.get('songs', {}).items():
-                    song = Song(
-                        song_data['name'],
-                        song_data['artist'],
-                        song_data['release_date'],
-                        album.name,
-                        song_data['file_name'],
-                    )
-                    music_library.add_music_item('song', song, album_index)
-
-            # Gathers data and creates singles from .json file.
-            for single_index, single_data in data.get('singles', {}).items():
-                single = Single(
-                    single_data['name'],
-                    single_data['artist'],
-                    single_data['release_date'],
-                    single_data['file_name']
-                )
-                music_library.add_music_item('single', single, None)
-
-    # Displays error if the file could not be located.
-    except FileNotFoundError:
-        print('\nUnable to find music database, please ensure it is in the same folder as your script.')
-
-# Saves data from program and writes it to .json file.
-def save_data():
-    data = {
-        'albums':{index: album.to_json() for index, album in music_library.albums.items()},
-        'singles': {index: single.to_json() for index, single in music_library.singles.items()}
-    }
+    global store
+    store = open_store()
+    store.load(music_library)
+    music_library.store = store
+    music_library.loudness = LoudnessCache(LOUDNESS_CACHE_FILE)
+    music_library.loudness.load()
+    music_library.play_queue.load()
+    music_library.history = PlayHistory(HISTORY_FILE)
+    music_library.paths = PathResolver(MUSIC_ROOTS, PATH_CACHE_FILE)
+    music_library.paths.load()
+    missing = music_library.paths.check(music_library.loaded_file_names()) # Other albums are checked when opened.
+    if missing:
+        print(f'\n{missing} track file{"s" if missing != 1 else ""} could not be found in the music folders, '
+              'they are marked (missing) and skipped.')
+    if DECODE_CACHE:
+        music_library.decode_cache = DecodeCache(DECODE_CACHE_FOLDER, DECODE_CACHE_LIMIT)
+    if numpy is not None:
+        music_library.features = FeatureIndex(FEATURE_CACHE_FILE)
+        music_library.features.load()
+        music_library.radio = Radio(music_library.features, music_library.queued_song)
 
+# Saves changes made to the library since the last save.
+@timed('save_data')
+def save_data():
     try:
-        with open('music_database.json', 'w') as writer:
-            json.dump(data, writer, indent = 4)
+        store.commit(music_library)
         print('\nLibrary saved.')
     except Exception as error:
+        metrics.count('save_errors')
         print(f'\nError saving library: {error}')
 
-# Validates that index is a proper positive integer.
-def validate_index(music_item_type, music_item_dict):
+# Lists albums, songs or singles a page at a time. A page is written to the terminal in one go, and the text of each
+# row comes from the library's row cache, so paging through a large library only formats rows not listed before.
+class ListingView:
+    def __init__(self, library, music_item_type, album_index = None, indent = ''):
+        self.library = library
+        self.music_item_type = music_item_type
+        self.album_index = album_index
+        self.indent = indent
+        self.page = 1
+
+    def page_count(self):
+        return max(1, -(-len(self.library.map_positions(self.music_item_type, self.album_index)) // PAGE_SIZE))
+
+    # Writes the current page, with the page controls when there is more than one page.
+    def render(self):
+        library = self.library
+        page_count = self.page_count()
+        self.page = min(self.page, page_count) # Deletes can leave the page past the end.
+        rows = itertools.islice(library.ordered_music_items(self.music_item_type, self.album_index,
+                                                            (self.page - 1) * PAGE_SIZE + 1), PAGE_SIZE)
+        lines = [f'{self.indent}{position}: '
+                 f'{library.formatted_row(self.music_item_type, key, music_item, self.album_index)}\n'
+                 for position, key, music_item in rows]
+        if page_count > 1:
+            lines.append(f'{self.indent}Page {self.page} of {page_count} '
+                         '(N. Next Page, P. Previous Page, J. Jump To Page)\n')
+        sys.stdout.write(''.join(lines))
+
+    # Turns the page for N, P and J. Returns False for any other choice.
+    def turn(self, choice):
+        page_count = self.page_count()
+        match choice:
+            case 'N':
+                self.page = min(self.page + 1, page_count)
+            case 'P':
+                self.page = max(self.page - 1, 1)
+            case 'J':
+                page = input(f'\nJump to page (1-{page_count}): ')
+                try:
+                    self.page = min(max(int(page), 1), page_count)
+                except ValueError:
+                    print(f'\nInvalid input "{page}", please enter a page number.')
+            case _:
+                return False
+        return True
+
+# Validates that index is a proper positive integer, and returns the key of the music item listed at that index.
+# When the listing's view is given, N, P and J turn its pages while choosing.
+def validate_index(music_item_type, positions, view = None):
     while True:
         index = input(f'\nChoose {music_item_type} (enter index): ')
-        if music_item_dict: # If dict is not empty.
+        if view is not None and view.turn(index.upper()):
+            view.render()
+            continue
+        if positions: # If dict is not empty.
             try:
                 index = abs(int(index))
-                if index in music_item_dict:
-                    return index
+                if 1 <= index <= len(positions):
+                    return positions.key_at(index)
                 else:
                     print(f'\nInvalid input "{index}", please enter a valid {music_item_type} index.')
             except ValueError:
@@ -366,7 +3821,7 @@ def collect_song_inputs(music_item_type, album_index):
     # Depending on music item type, collects exclusive inputs.
     if music_item_type == 'song':
         file_name = input('Enter file (name.ext) name ensure it is in the same folder as the script. or leave blank if N/A :')
-        album = music_library.albums[album_index]
+        album = music_library.albums[album_index].name
         new_song = Song(name, artist, release_date, album, file_name, is_playing = False)
         music_library.add_music_item('song', new_song, album_index) # Adds created song.
     elif music_item_type == 'single':
@@ -377,6 +3832,208 @@ def collect_song_inputs(music_item_type, album_index):
         new_album = Album(name, artist, release_date, is_playing=False, )
         music_library.add_music_item('album',new_album, album_index = None) # Adds created album.
 
+# Imports every audio file in a folder as albums, saving once at the end.
+def import_folder():
+    folder = input('\nEnter folder to import: ').strip().strip('"')
+    if not os.path.isdir(folder):
+        print(f'\nFolder "{folder}" could not be found.')
+        return
+
+    print('\nScanning folder...')
+    scanned, read_count = scan_folder(folder)
+    if not scanned:
+        print('\nNo audio files were found in that folder.')
+        return
+
+    added_albums, added_songs = music_library.import_albums(group_into_albums(scanned))
+    print(f'\nFound {len(scanned)} files ({read_count} read), added {added_albums} albums and {added_songs} songs.')
+    save_data()
+
+# Measures the loudness of every track in the library that has not been analysed yet.
+def analyze_loudness():
+    if numpy is None:
+        print('\nLoudness analysis needs numpy, please install it (pip install numpy).')
+        return
+
+    # Albums that were never opened are not loaded for this, their file names are read from storage.
+    file_names = [music_library.paths.find(file_name) for reference, file_name in music_library.tracks() if file_name]
+    print('\nAnalyzing tracks, this can take a while the first time...')
+    analyzed = music_library.loudness.analyze([file_name for file_name in file_names if file_name])
+    print(f'\nAnalyzed {analyzed} tracks, the rest were already up to date.')
+
+# Asks for a song in an album, returns (album index, song key) or None.
+def choose_album_song():
+    album_index = validate_index('album', music_library.map_positions('album', None))
+    if album_index is None:
+        return None
+    view = ListingView(music_library, 'song', album_index)
+    view.render()
+    song_index = validate_index('song', music_library.map_positions('song', album_index), view)
+    if song_index is None:
+        return None
+    return album_index, song_index
+
+# Submenu that starts radio from a song or single. Opening it starts analysing tracks that are new or changed in the
+# background, so radio knows more of the library each time.
+def radio_menu():
+    features = music_library.features
+    if features is None:
+        print('\nRadio needs numpy to compare tracks, please install it (pip install numpy).')
+        return
+    features.start(music_library.radio_tracks())
+
+    while True:
+        choice = input('\nA. Radio From Song'
+                       '\nB. Radio From Single'
+                       '\nC. Skip Song'
+                       '\nD. Stop Radio'
+                       '\nE. Back'
+                       '\nEnter your choice: ').upper()
+
+        done, total = features.progress
+        if features.extracting():
+            print(f'\nAnalysing tracks in the background, {done} of {total} done.')
+        print(f'\n{len(features)} tracks can be played on the radio.')
+
+        match choice:
+            case 'A':
+                chosen = choose_album_song()
+                if chosen is not None:
+                    player.send('play_radio', ('song',) + chosen)
+            case 'B':
+                view = ListingView(music_library, 'single', None)
+                view.render()
+                single_index = validate_index('single', music_library.map_positions('single', None), view)
+                if single_index is not None:
+                    player.send('play_radio', ('single', None, single_index))
+            case 'C':
+                player.send('skip') # Skips to the next track radio picks.
+            case 'D':
+                player.send('stop')
+            case 'E':
+                break
+            case _:
+                print(f'\nInvalid input "{choice}", please try again.')
+
+# Submenu that lines up songs from any album and singles to play.
+def queue_menu():
+    play_queue = music_library.play_queue
+
+    while True:
+        choice = input('\nA. Add Song'
+                       '\nB. Add Single'
+                       '\nC. Add Album'
+                       '\nD. Remove From Queue'
+                       '\nE. Play Queue'
+                       '\nF. Skip Song'
+                       '\nG. Shuffle On/Off'
+                       '\nH. Clear Queue'
+                       '\nI. Back'
+                       '\nEnter your choice: ').upper()
+
+        # Displays the queue, the entry that is playing or played last is marked.
+        print('\nPlay Queue:' + (' (shuffled)' if play_queue.play_order is not None else ''))
+        for position, reference, is_current in play_queue.ordered_entries():
+            song = music_library.queued_song(reference)
+            marker = ' <' if is_current else ''
+            if song is None:
+                print(f'\t{position}: (removed from library){marker}')
+            else:
+                print(f'\t{position}: {song}{music_library.missing_marker(song)}{marker}')
+
+        match choice:
+            case 'A' | 'B':
+                if choice == 'A':
+                    chosen = choose_album_song()
+                    reference = ('song',) + chosen if chosen is not None else None
+                else:
+                    single_index = validate_index('single', music_library.map_positions('single', None))
+                    reference = ('single', None, single_index) if single_index is not None else None
+                if reference is not None:
+                    play_next = input('Play next? (Y/N): ').upper() == 'Y'
+                    play_queue.add(reference, play_next)
+                    play_queue.save()
+
+            case 'C':
+                album_index = validate_index('album', music_library.map_positions('album', None))
+                if album_index is not None:
+                    for song_index in music_library.map_positions('song', album_index):
+                        play_queue.add(('song', album_index, song_index))
+                    play_queue.save()
+
+            case 'D':
+                if play_queue:
+                    play_queue.remove(validate_index('queue entry', play_queue.order))
+                    play_queue.save()
+                else:
+                    print('\nThe play queue is empty.')
+
+            case 'E':
+                player.send('play_queue') # Carries on from where the queue was stopped.
+
+            case 'F':
+                player.send('skip') # Skips song.
+
+            case 'G':
+                play_queue.set_shuffle(play_queue.play_order is None)
+                play_queue.save()
+                print('\nShuffle is ' + ('on.' if play_queue.play_order is not None else 'off.'))
+
+            case 'H':
+                player.send('stop')
+                player.wait()
+                play_queue.clear()
+                play_queue.save()
+
+            case 'I':
+                break
+
+            case _:
+                print(f'\nInvalid input "{choice}", please try again.')
+
+# Submenu that shows timings, counters and the most played tracks, and turns metrics and profiling on and off.
+def stats_menu():
+    while True:
+        metrics.report()
+        choice = input('\nA. Metrics On/Off'
+                       '\nB. Profiling On/Off'
+                       f'\nC. Save To {METRICS_FILE}'
+                       '\nD. Reset'
+                       '\nE. Most Played This Month'
+                       '\nF. Most Played Of All Time'
+                       '\nG. Back'
+                       '\nEnter your choice: ').upper()
+
+        match choice:
+            case 'A':
+                metrics.enabled = not metrics.enabled
+            case 'B':
+                if metrics.profiling:
+                    metrics.stop_profiling()
+                else:
+                    metrics.start_profiling()
+                    print(f'\nProfiling, turn it off to see the results and save them to {PROFILE_FILE}.')
+            case 'C':
+                try:
+                    metrics.dump()
+                    print(f'\nMetrics saved to {METRICS_FILE}.')
+                except OSError as error:
+                    print(f'\nError saving metrics: {error}')
+            case 'D':
+                metrics.reset()
+            case 'E' | 'F':
+                month = time.strftime('%Y-%m') if choice == 'E' else None
+                rows = music_library.history.most_played(month)
+                print('\nMost played ' + ('this month:' if month else 'of all time:'))
+                for position, (name, artist, plays) in enumerate(rows, 1):
+                    print(f'\t{position}: {name} by {artist}, {plays} play{"s" if plays != 1 else ""}')
+                if not rows:
+                    print('\tNothing has been played yet.')
+            case 'G':
+                break
+            case _:
+                print(f'\nInvalid input "{choice}", please try again.')
+
 # Menu containing options relating to music item type.
 def main_menu():
     print('\nWelcome to Python Music Player!')
@@ -384,7 +4041,12 @@ def main_menu():
     while True:
         choice = input('\nA. Albums'
                        '\nB. Singles'
-                       '\nC. Exit'
+                       '\nC. Search'
+                       '\nD. Play Queue'
+                       '\nE. Radio'
+                       '\nF. Analyze Loudness'
+                       '\nG. Statistics'
+                       '\nH. Exit'
                        '\nEnter your choice: ').upper()
 
         match choice:
@@ -393,14 +4055,48 @@ def main_menu():
             case 'B':
                 singles_menu() # Opens singles submenu.
             case 'C':
+                search_menu() # Opens search.
+            case 'D':
+                queue_menu() # Opens the play queue.
+            case 'E':
+                radio_menu() # Plays tracks that sound alike.
+            case 'F':
+                analyze_loudness() # Evens out the volume of tracks.
+            case 'G':
+                stats_menu() # Shows where time is going.
+            case 'H':
                 # Goodbye message, and closes program.
                 print('\nSee you next time!')
                 break
             case _:
                 print(f'\nInvalid input "{choice}", please try again.') # For invalid choice.
 
+# Searches the library and plays a chosen result.
+def search_menu():
+    query = input('\nSearch for a song, single, album or artist: ')
+    results = music_library.search(query)
+    if not results:
+        print(f'\nNo results for "{query}".')
+        return
+
+    print('\nResults:')
+    for number, (music_item_type, key, album_index, music_item) in enumerate(results, start = 1):
+        print(f'\t{number}: {music_item} [{music_item_type}]{music_library.missing_marker(music_item)}')
+
+    choice = input('\nChoose a result to play (enter number) or press Enter to go back: ')
+    try:
+        music_item_type, key, album_index, music_item = results[int(choice) - 1]
+    except (ValueError, IndexError):
+        return
+
+    if music_item_type == 'album':
+        player.send('play_album', key) # Plays album.
+    else:
+        player.send('play_song', music_item) # Plays song or single.
+
 # Submenu that handles album functions and methods.
 def albums_menu():
+    view = ListingView(music_library, 'album', None, '\t')
     while True:
         choice = input('\nA. Add Album'
                        '\nB. Delete Album'
@@ -408,39 +4104,45 @@ def albums_menu():
                        '\nD. Play Album'
                        '\nE. Stop Album'
                        '\nF. Skip Song'
-                       '\nG. Back'
+                       '\nG. Import Folder'
+                       '\nH. Back'
                        '\nEnter your choice: ').upper()
 
-        # Displays albums with their index.
+        turned = view.turn(choice)
+
+        # Displays a page of albums with their index.
         print('\nAlbums:')
-        for index, album in music_library.albums.items():
-            print(f'\t{index}: {album}')
+        view.render()
+        if turned:
+            continue
 
         match choice:
             case 'A':
                 collect_song_inputs('album', None) # Adds album.
                 save_data()
             case 'B':
-                album_index = validate_index('album',music_library.albums)
+                album_index = validate_index('album', music_library.map_positions('album', None), view)
                 if album_index is not None:
                     music_library.delete_music_item('album', album_index, None) # Deletes album.
                     save_data()
             case 'C':
-                album_index = validate_index('album', music_library.albums)
+                album_index = validate_index('album', music_library.map_positions('album', None), view)
                 if album_index is not None:
                     songs_menu(album_index) # Displays album.
 
             case 'D':
-                album_index = validate_index('album', music_library.albums)
-                music_library.play_album(album_index) # Plays album.
+                album_index = validate_index('album', music_library.map_positions('album', None), view)
+                player.send('play_album', album_index) # Plays album.
 
             case 'E':
-                music_library.stop_music() # Stops album.
+                player.send('stop') # Stops album.
 
             case 'F':
-                music_library.next_song() # Skips song.
+                player.send('skip') # Skips song.
             case 'G':
-                music_library.stop_music() # Stops music and goes back to previous menu.
+                import_folder() # Adds every audio file in a folder.
+            case 'H':
+                player.send('stop') # Stops music and goes back to previous menu.
                 break
             case _:
                 print(f'\nInvalid input "{choice}", please try again.') # For invalid inputs.
@@ -449,7 +4151,7 @@ def albums_menu():
 # Submenu that handles song functions and methods.
 def songs_menu(album_index):
     album = music_library.albums[album_index]
-    current_song = None
+    view = ListingView(music_library, 'song', album_index, '\t\t')
 
     while True:
 
@@ -460,12 +4162,15 @@ def songs_menu(album_index):
                        '\nE. Back'
                        '\nEnter your choice: ').upper()
 
+        turned = view.turn(choice)
+
         print(f'\n{album}')
         if album.songs:
-            for index, song in album.songs.items():
-                print(f'\t\t{index}: {song}')
+            view.render()
         else:
             print(f'\nThe album {album} is currently empty.') # If album is empty.
+        if turned:
+            continue
 
 
         match choice:
@@ -475,26 +4180,26 @@ def songs_menu(album_index):
 
             case 'B':
                 if music_library.albums[album_index].songs:
-                    song_index = validate_index('song', music_library.albums[album_index].songs)
+                    song_index = validate_index('song', music_library.map_positions('song', album_index), view)
                     music_library.delete_music_item('song', song_index, album_index) # Deletes song.
                     save_data()
                 else:
                     print('\nThere are no songs available, please add some or choose another option.')
 
             case 'C':
-                song_index = validate_index('song', music_library.albums[album_index].songs)
-                current_song = music_library.albums[album_index].songs[song_index]
-                music_library.play_song(current_song)
+                song_index = validate_index('song', music_library.map_positions('song', album_index), view)
+                player.send('play_song', music_library.albums[album_index].songs[song_index])
 
             case 'D':
-                if current_song and pygame.mixer.music.get_busy():
-                    music_library.stop_music() # Stops song.
+                current_song = music_library.now_playing.music_item
+                if current_song is not None:
+                    player.send('stop') # Stops song.
                     print(f'\n{current_song.name} by {current_song.artist} stopped...')
                 else:
                     print('\nNo song is currently playing.')
 
             case 'E':
-                music_library.stop_music() # Stops song and goes back to main menu.
+                player.send('stop') # Stops song and goes back to main menu.
                 break
 
             case _:
@@ -502,10 +4207,9 @@ def songs_menu(album_index):
 
 # Submenu that handles functions and methods for singles.
 def singles_menu():
-    current_single = None
-
     if not music_library.singles: # If there are no singles.
         print('\nThere are no singles in your library.')
+    view = ListingView(music_library, 'single', None)
     while True:
         choice = input('\nA. Add Single'
                        '\nB. Delete Single'
@@ -514,8 +4218,10 @@ def singles_menu():
                        '\nE. Back'
                        '\nEnter your choice: ').upper()
 
-        for index, singles in music_library.singles.items():
-            print(f'{index}: {singles}')
+        turned = view.turn(choice)
+        view.render()
+        if turned:
+            continue
 
         match choice:
             case 'A':
@@ -524,29 +4230,185 @@ def singles_menu():
 
             case 'B':
                 if music_library.singles:
-                    single_index = validate_index('single', music_library.singles)
+                    single_index = validate_index('single', music_library.map_positions('single', None), view)
                     music_library.delete_music_item('single', single_index, None) # Deletes single.
                     save_data()
                 else:
                     print('\nThere are no singles available, please add some or choose another option.')
 
             case 'C':
-                single_index = validate_index('single', music_library.singles)
-                current_single = music_library.singles[single_index]
-                music_library.play_song(current_single) # Plays single.
+                single_index = validate_index('single', music_library.map_positions('single', None), view)
+                player.send('play_song', music_library.singles[single_index]) # Plays single.
 
             case 'D':
-                if current_single and pygame.mixer.music.get_busy():
-                    music_library.stop_music() # Stops single.
+                current_single = music_library.now_playing.music_item
+                if current_single is not None:
+                    player.send('stop') # Stops single.
                     print(f'\n{current_single.name} by {current_single.artist} stopped...')
                 else:
                     print('\nNo song is currently playing.')
             case 'E':
-                music_library.stop_music() # Stops single and returns to main menu.
+                player.send('stop') # Stops single and returns to main menu.
                 break
 
             case _:
                 print(f'\nInvalid input "{choice}", please try again.')
 
-load_data()
-main_menu()
+# Album a batch command refers to, by key or by {"name", "artist", "release_date"} so that albums added earlier in
+# the same batch can be used.
+def batch_album(reference):
+    if isinstance(reference, dict):
+        key = music_library.album_identities.key_of(
+            Album(reference['name'], reference['artist'], reference['release_date']))
+    else:
+        key = reference
+    if key not in music_library.albums:
+        raise ValueError(f'There is no album {json.dumps(reference)}.')
+    return key
+
+# Checks that the data of a music item in a batch is an object with the fields every music item needs, and a file name
+# that is text when it is given.
+def check_batch_fields(description, data):
+    if not isinstance(data, dict):
+        raise ValueError(f'The {description} must be a JSON object.')
+    for field in ('name', 'artist', 'release_date'):
+        if not isinstance(data.get(field), str):
+            raise ValueError(f'The {description} needs a "{field}".')
+    if not isinstance(data.get('file_name'), (str, type(None))):
+        raise ValueError(f'The "file_name" of the {description} must be text.')
+
+# Music item of a batch or control server add, after checking it has the fields every music item needs.
+def batch_music_item(music_item_type, data, album_index):
+    check_batch_fields(music_item_type, data)
+    data = dict(data)
+    data['music_item_type'] = music_item_type.capitalize()
+    if music_item_type == 'song':
+        data.setdefault('album', music_library.albums[album_index].name)
+    elif music_item_type == 'album':
+        songs = data.get('songs', {})
+        if isinstance(songs, list): # Songs can be listed without keys, they are numbered in order.
+            songs = {str(key): song for key, song in enumerate(songs, start = 1)}
+        if not isinstance(songs, dict):
+            raise ValueError('The "songs" of the album must be a list or a JSON object.')
+        for key, song in songs.items():
+            if not key.isdigit():
+                raise ValueError(f'Song key "{key}" of the album is not a number.')
+            check_batch_fields(f'song {key} of the album', song)
+        data['songs'] = {key: dict(song, album = song.get('album', data['name']),
+                                   music_item_type = song.get('music_item_type', 'Song'))
+                         for key, song in songs.items()}
+    return music_item_from_json(data)
+
+# Applies one batch command to the library. Returns what was done, to be counted, or raises ValueError, KeyError,
+# TypeError or AttributeError when the command is invalid.
+def run_batch_command(command):
+    if not isinstance(command, dict):
+        raise ValueError('Each line must be a JSON object.')
+    music_item_type = command.get('type')
+    if command['cmd'] != 'import' and music_item_type not in ('album', 'song', 'single'):
+        raise ValueError(f'Unknown type "{music_item_type}", use album, song or single.')
+    album_index = batch_album(command.get('album')) if music_item_type == 'song' else None
+
+    match command['cmd']:
+        case 'add':
+            music_item = batch_music_item(music_item_type, command['item'], album_index)
+            if music_library.add_music_item(music_item_type, music_item, album_index, command.get('position')) is None:
+                return 'duplicates skipped'
+            return 'added'
+        case 'delete' | 'move':
+            key = command['key']
+            if key not in music_library.map_music_item(music_item_type, album_index):
+                raise ValueError(f'There is no {music_item_type} with key {key}.')
+            if command['cmd'] == 'delete':
+                music_library.delete_music_item(music_item_type, key, album_index)
+                return 'deleted'
+            position = command['position']
+            if not isinstance(position, int) or position < 1:
+                raise ValueError(f'Invalid position {position}.')
+            music_library.move_music_item(music_item_type, key, position, album_index)
+            return 'moved'
+        case 'import':
+            folder = command['folder']
+            if not os.path.isdir(folder):
+                raise ValueError(f'Folder "{folder}" could not be found.')
+            scanned, read_count = scan_folder(folder)
+            music_library.import_albums(group_into_albums(scanned))
+            return 'folders imported'
+        case other:
+            raise ValueError(f'Unknown command "{other}".')
+
+# Runs batch commands, one JSON object per line, read from a file or from stdin when source is '-'. Every command is
+# checked and applied to the library in memory first, then all of them are saved as one change. If any command is
+# invalid nothing is saved. Returns whether the batch was saved.
+def run_batch(source):
+    try:
+        reader = sys.stdin if source == '-' else open(source, 'r', encoding = 'utf-8')
+    except OSError as error:
+        print(f'\nUnable to read batch commands: {error}')
+        return False
+
+    changes = [] # Stands in for the store while the batch runs, so nothing reaches the disk before the end.
+    music_library.store = changes
+    done = collections.Counter()
+    try:
+        with metrics.span('batch'):
+            for number, line in enumerate(reader, start = 1):
+                if not line.strip() or line.lstrip().startswith('#'): # Blank lines and comments.
+                    continue
+                try:
+                    done[run_batch_command(json.loads(line))] += 1
+                except KeyError as error:
+                    print(f'\nLine {number}: "{error.args[0]}" is missing.')
+                    print('\nThe batch was not applied, no changes were saved.')
+                    return False
+                except (ValueError, TypeError, AttributeError) as error:
+                    print(f'\nLine {number}: {error}')
+                    print('\nThe batch was not applied, no changes were saved.')
+                    return False
+    finally:
+        music_library.store = store
+        if reader is not sys.stdin:
+            reader.close()
+
+    try:
+        store.append_batch(changes)
+        store.commit(music_library)
+    except Exception as error:
+        print(f'\nError saving library: {error}')
+        return False
+    summary = ', '.join(f'{count} {action}' for action, count in done.items()) or 'nothing to do'
+    print(f'\nBatch saved: {summary}.')
+    return True
+
+# Starts the player. Loading this file only defines the library and menus, nothing is opened until this runs.
+# With --serve the menus are replaced by the control server, and with --batch by the commands in a file.
+def main():
+    metrics.enabled = '--metrics' in sys.argv # Turned on from the start, so loading the library is timed too.
+    load_data()
+    saved = True
+    if '--batch' in sys.argv:
+        arguments = sys.argv[sys.argv.index('--batch') + 1:]
+        saved = run_batch(arguments[0] if arguments and not arguments[0].startswith('--') else '-')
+    elif '--serve' in sys.argv:
+        music_library.start_search_index() # Ready by the time the first search comes in.
+        try:
+            asyncio.run(ControlServer(music_library, player).serve_forever())
+        except KeyboardInterrupt:
+            print('\nControl server stopped.')
+        except OSError as error:
+            print(f'\nUnable to start control server: {error}')
+    else:
+        music_library.start_search_index()
+        main_menu()
+    if player.thread is not None:
+        player.send('quit') # Lets the playback thread finish the commands it was sent before the program closes.
+        player.wait()
+    if music_library.features is not None:
+        music_library.features.stop() # Saves the features extracted so far.
+    music_library.history.close() # Saves plays that are still queued.
+    if not saved:
+        sys.exit(1) # Lets scripts running a batch tell that it failed.
+
+# Worker processes used by Import Folder load this file again, so the menu only starts when it is run directly.
+if __name__ == '__main__':
+    main()
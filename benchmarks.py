@@ -0,0 +1,369 @@
+# Python Music Player Benchmarks
+"""Times the library operations and playback paths of the music player on synthetic libraries and measures the memory
+they take, so slowdowns can be spotted as the database grows. Results are written as JSON and can be compared against
+an earlier run.
+
+Run with:  python benchmarks.py --sizes 1000 10000 100000 --output results.json --compare old_results.json"""
+
+import os # Used to pick the dummy audio driver and to work in a temporary folder.
+import random # Used to make up sound features for radio.
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') # Benchmarks never need real speakers.
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse # Used to read benchmark options.
+import contextlib # Used to hide the player's messages while timing.
+import gc # Used to clean up before measuring memory.
+import io # Used to hide the player's messages while timing.
+import json # Used to write the database and the results.
+import math # Used to make the test tone.
+import platform # Used to record where the benchmark ran.
+import shutil # Used to copy the test tone.
+import struct # Used to write the test tone.
+import sys # Used to record the Python version.
+import tempfile # Used to keep generated files out of the project folder.
+import time # Used to time operations.
+import tracemalloc # Used to measure the memory a loaded library takes.
+import wave # Used to write the test tone.
+
+import DavionFranklin_FinalProject as player # The music player being measured.
+
+ALBUM_SIZE = 12 # Songs per generated album.
+SINGLE_SHARE = 10 # One track in this many is generated as a single.
+OPERATIONS = 1000 # Adds and deletes timed for each library size.
+PLAYBACK_TRACKS = 20 # Tracks in the album used to time playback.
+HISTORY_EVENTS = 100000 # Plays and skips recorded when timing the play history.
+
+# Builds a library of roughly track_count tracks in the music_database.json format.
+def generate_database(track_count):
+    single_count = track_count // SINGLE_SHARE
+    album_count = max(1, (track_count - single_count) // ALBUM_SIZE)
+    albums = {}
+    for album_index in range(1, album_count + 1):
+        album_name = f'Album {album_index}'
+        artist = f'Artist {album_index % 997}'
+        albums[str(album_index)] = {
+            'name': album_name,
+            'artist': artist,
+            'release_date': '01-01-2025',
+            'music_item_type': 'Album',
+            'songs': {
+                str(song_index): {
+                    'name': f'Track {song_index} of {album_name}',
+                    'artist': artist,
+                    'release_date': '01-01-2025',
+                    'music_item_type': 'Song',
+                    'album': album_name,
+                    'file_name': f'album_{album_index}_{song_index}.mp3'
+                }
+                for song_index in range(1, ALBUM_SIZE + 1)
+            }
+        }
+    singles = {
+        str(single_index): {
+            'name': f'Single {single_index}',
+            'artist': f'Artist {single_index % 997}',
+            'release_date': '01-01-2025',
+            'music_item_type': 'Single',
+            'file_name': f'single_{single_index}.mp3'
+        }
+        for single_index in range(1, single_count + 1)
+    }
+    return {'albums': albums, 'singles': singles}
+
+# Writes half a second of a quiet tone, used as a track for playback timings.
+def write_tone(path):
+    with wave.open(path, 'w') as writer:
+        writer.setnchannels(2)
+        writer.setsampwidth(2)
+        writer.setframerate(44100)
+        frames = b''.join(struct.pack('<hh', value, value)
+                          for value in (int(3000 * math.sin(index * 0.06)) for index in range(22050)))
+        writer.writeframes(frames)
+
+# Runs an operation a number of times and returns the total seconds taken.
+def timed(operation, repeat = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    return time.perf_counter() - start
+
+# Collects results as they are measured and prints them.
+class Results:
+    def __init__(self):
+        self.rows = []
+        self.output = sys.stdout # Kept so results still show while the player's own messages are hidden.
+
+    def add(self, benchmark, tracks, seconds, operations = 1):
+        row = {
+            'benchmark': benchmark,
+            'tracks': tracks,
+            'operations': operations,
+            'seconds': seconds,
+            'per_operation_us': seconds / operations * 1e6
+        }
+        self.rows.append(row)
+        print(f'{benchmark:<28} {tracks:>9} tracks  {seconds:10.4f} s  {row["per_operation_us"]:12.1f} us/op',
+              file = self.output)
+
+    def add_memory(self, benchmark, tracks, used):
+        row = {
+            'benchmark': benchmark,
+            'tracks': tracks,
+            'bytes': used,
+            'bytes_per_track': used / tracks
+        }
+        self.rows.append(row)
+        print(f'{benchmark:<28} {tracks:>9} tracks  {used / 2 ** 20:10.1f} MB  {row["bytes_per_track"]:12.1f} B/track',
+              file = self.output)
+
+# Times loading, saving and changing a library of track_count tracks.
+def benchmark_library(track_count, folder, results):
+    database_file = os.path.join(folder, f'library_{track_count}.json')
+    journal_file = database_file + '.journal'
+    with open(database_file, 'w') as writer:
+        json.dump(generate_database(track_count), writer)
+
+    # Loading the .json database, which also writes its binary copy.
+    library = player.Library()
+    store = player.JsonStore(database_file, journal_file, database_file + '.cache')
+    results.add('store load', track_count, timed(lambda: store.load(library)))
+
+    # Loading again from the binary copy, the way the player starts when the .json file has not changed.
+    cached_library = player.Library()
+    cached_store = player.JsonStore(database_file, journal_file, database_file + '.cache')
+    results.add('store load (cache)', track_count, timed(lambda: cached_store.load(cached_library)))
+
+    # Adding singles one at a time.
+    singles = [player.Single(f'New Single {index}', 'Benchmark', '01-01-2025', f'new_{index}.mp3')
+               for index in range(OPERATIONS)]
+    iterator = iter(singles)
+    results.add('add_music_item', track_count,
+                timed(lambda: library.add_music_item('single', next(iterator), None), OPERATIONS), OPERATIONS)
+
+    # Adding a whole album in one call.
+    songs = [player.Song(f'Bulk {index}', 'Benchmark', '01-01-2025', 'Bulk', f'bulk_{index}.mp3')
+             for index in range(OPERATIONS)]
+    album_index = library.add_music_item('album', player.Album('Bulk', 'Benchmark', '01-01-2025'), None)
+    results.add('add_music_items', track_count,
+                timed(lambda: library.add_music_items('song', songs, album_index)), OPERATIONS)
+
+    # Deleting the first song of each album, which used to renumber the whole album every time.
+    deletes = [(library.albums[album_key].identity_index.positions.key_at(1), album_key)
+               for album_key in list(library.album_identities.positions)[:OPERATIONS]]
+    iterator = iter(deletes)
+    results.add('delete_music_item', track_count,
+                timed(lambda: library.delete_music_item('song', *next(iterator)), len(deletes)), len(deletes))
+
+    # Stopping music, which is called whenever a menu is left.
+    results.add('stop_music', track_count, timed(library.stop_music, 100), 100)
+
+    # Looking up the key shown at a position, used by every menu choice.
+    positions = library.single_identities.positions
+    middle = max(1, len(positions) // 2)
+    results.add('position_lookup', track_count, timed(lambda: positions.key_at(middle), OPERATIONS), OPERATIONS)
+
+    # Listing a page of singles from the middle, the first time and then from the row cache.
+    view = player.ListingView(library, 'single', None)
+    view.page = max(1, view.page_count() // 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.add('render page', track_count, timed(view.render))
+        results.add('render page (cached)', track_count, timed(view.render, 100), 100)
+
+    # Saving one change, the way the menus do after every add or delete.
+    library.store = store
+    saves = iter([player.Single(f'Saved Single {index}', 'Benchmark', '01-01-2025', f'saved_{index}.mp3')
+                  for index in range(100)])
+
+    def add_and_save():
+        library.add_music_item('single', next(saves), None)
+        store.journal.commit()
+    results.add('save_data (journal)', track_count, timed(add_and_save, 100), 100)
+
+    # Writing the whole snapshot, done by compaction in the background.
+    snapshot = store.copy_library(library)
+    store.path = database_file + '.snapshot'
+    results.add('save_data (snapshot)', track_count, timed(lambda: store.write_snapshot(*snapshot, 0)))
+
+    # Building the search index and searching it.
+    results.add('search_index_build', track_count, timed(library.build_search_index))
+    results.add('search', track_count, timed(lambda: library.search('track 7 album'), 100), 100)
+
+    library.store = None
+    store.journal.rotate()
+    os.remove(database_file)
+    os.remove(database_file + '.cache')
+
+    # Copying the library into SQLite, then starting up from it with albums loaded only when opened.
+    sqlite_file = os.path.join(folder, f'library_{track_count}.sqlite3')
+    sqlite_store = player.SqliteStore(sqlite_file)
+    results.add('sqlite import', track_count, timed(lambda: sqlite_store.import_library(library)))
+    sqlite_library = player.Library()
+    results.add('sqlite store load', track_count, timed(lambda: sqlite_store.load(sqlite_library)))
+    first_album = sqlite_library.album_identities.positions.key_at(1)
+    results.add('sqlite open album', track_count, timed(lambda: sqlite_library.albums[first_album].songs))
+    sqlite_store.connection.close()
+    os.remove(sqlite_file)
+
+# Times the player's whole start-up, load_data, in a folder of its own: the library, play queue, history, caches and
+# the check of track files. Run once from the .json database and again from the binary copy written the first time.
+def benchmark_startup(track_count, folder, results):
+    startup_folder = os.path.join(folder, f'startup_{track_count}')
+    os.makedirs(startup_folder)
+    with open(os.path.join(startup_folder, player.DATABASE_FILE), 'w') as writer:
+        json.dump(generate_database(track_count), writer)
+
+    working_folder = os.getcwd()
+    os.chdir(startup_folder) # The player keeps its files next to where it is started.
+    try:
+        for benchmark in ('load_data', 'load_data (cache)'):
+            player.music_library = player.Library()
+            with contextlib.redirect_stdout(io.StringIO()): # Hides the message about missing track files.
+                results.add(benchmark, track_count, timed(player.load_data))
+            if player.music_library.features is not None:
+                player.music_library.features.stop()
+            player.music_library.history.close()
+    finally:
+        os.chdir(working_folder)
+
+# Measures the memory a loaded library takes, with album songs as objects and kept in columns.
+def benchmark_memory(track_count, folder, results):
+    database_file = os.path.join(folder, f'memory_{track_count}.json')
+    with open(database_file, 'w') as writer:
+        json.dump(generate_database(track_count), writer)
+
+    columnar_songs_after = player.COLUMNAR_SONGS_AFTER
+    for benchmark, threshold in (('memory (objects)', track_count), ('memory (columns)', 0)):
+        player.COLUMNAR_SONGS_AFTER = threshold
+        gc.collect()
+        tracemalloc.start()
+        library = player.Library()
+        player.JsonStore(database_file, database_file + '.journal').load(library)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.add_memory(benchmark, track_count, used)
+        del library
+    player.COLUMNAR_SONGS_AFTER = columnar_songs_after
+    os.remove(database_file)
+
+# Times recording plays, which playback waits on, and saving them, which happens on the history's writer thread.
+def benchmark_history(folder, results):
+    history = player.PlayHistory(os.path.join(folder, 'history.sqlite3'))
+    songs = [player.Song(f'Track {index}', 'Benchmark', '', 'History', f'track_{index}.mp3') for index in range(1000)]
+    events = iter(range(HISTORY_EVENTS))
+
+    def record():
+        event = next(events)
+        history.record('skip' if event % 5 == 0 else 'play', songs[event % len(songs)])
+    start = time.perf_counter()
+    results.add('history record', HISTORY_EVENTS, timed(record, HISTORY_EVENTS), HISTORY_EVENTS)
+    history.flush()
+    results.add('history saved', HISTORY_EVENTS, time.perf_counter() - start, HISTORY_EVENTS)
+    results.add('history most played', HISTORY_EVENTS, timed(lambda: history.most_played(time.strftime('%Y-%m')), 100),
+                100)
+    history.close()
+
+# Times building radio's feature index and picking the next track, with made up features for track_count tracks.
+def benchmark_radio(track_count, results):
+    features = player.FeatureIndex(None)
+    tracks = [(('single', None, index), f'/music/track_{index}.mp3') for index in range(track_count)]
+    for reference, path in tracks:
+        features.files[path] = [0, 0, path]
+        features.results[path] = [random.gauss(0, 1) for _ in player.FEATURE_WEIGHTS]
+    results.add('feature index build', track_count, timed(lambda: features.build(tracks)))
+
+    radio = player.Radio(features, lambda reference: reference)
+    radio.start(tracks[0][0])
+    results.add('radio pick', track_count, timed(radio.advance, 100), 100)
+
+# Times loading, skipping and the playback thread's response with the dummy audio driver.
+def benchmark_playback(folder, results):
+    tone = os.path.join(folder, 'tone.wav')
+    write_tone(tone)
+    library = player.Library()
+    album_index = library.add_music_item('album', player.Album('Tones', 'Benchmark', '01-01-2025'), None)
+    for index in range(PLAYBACK_TRACKS):
+        file_name = os.path.join(folder, f'tone_{index}.wav')
+        shutil.copyfile(tone, file_name)
+        library.add_music_item('song', player.Song(f'Tone {index}', 'Benchmark', '', 'Tones', file_name), album_index)
+
+    results.add('play_album (track load)', PLAYBACK_TRACKS, timed(lambda: library.play_album(album_index)))
+    time.sleep(0.05) # Gives the prefetch thread time to read the next track.
+    skips = PLAYBACK_TRACKS - 2
+    results.add('next_song (skip)', PLAYBACK_TRACKS, timed(library.next_song, skips), skips)
+    library.stop_music()
+
+    engine = player.PlaybackEngine(library)
+    engine.send('play_album', album_index)
+    engine.wait()
+
+    def skip():
+        engine.send('skip')
+        engine.wait()
+    results.add('engine skip round trip', PLAYBACK_TRACKS, timed(skip, skips), skips)
+    engine.send('quit')
+    engine.wait()
+
+    # The same album once every track has been decoded into the decode cache.
+    library.decode_cache = player.DecodeCache(os.path.join(folder, 'decode_cache'), player.DECODE_CACHE_LIMIT)
+    for song in library.albums[album_index].songs.values():
+        library.decode_cache.decode(song.file_name)
+    results.add('play_album (decoded)', PLAYBACK_TRACKS, timed(lambda: library.play_album(album_index)))
+    results.add('next_song (skip, decoded)', PLAYBACK_TRACKS, timed(library.next_song, skips), skips)
+    library.stop_music()
+
+# Prints how each benchmark changed compared with an earlier results file.
+def compare(results, previous_file):
+    with open(previous_file, 'r') as reader:
+        previous = {(row['benchmark'], row['tracks']): row for row in json.load(reader)['results']}
+
+    print(f'\nCompared with {previous_file}:')
+    for row in results.rows:
+        metric = 'per_operation_us' if 'per_operation_us' in row else 'bytes_per_track'
+        old = previous.get((row['benchmark'], row['tracks']))
+        if old is None or not old.get(metric):
+            continue
+        ratio = row[metric] / old[metric]
+        flag = '  <-- worse' if ratio > 1.25 else ''
+        print(f'{row["benchmark"]:<28} {row["tracks"]:>9} tracks  {ratio:6.2f}x{flag}')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks the Python Music Player.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000],
+                        help = 'library sizes in tracks, up to 1000000')
+    parser.add_argument('--output', default = 'benchmark_results.json', help = 'where to write the results')
+    parser.add_argument('--compare', help = 'earlier results file to compare against')
+    parser.add_argument('--skip-playback', action = 'store_true', help = 'only time library operations')
+    parser.add_argument('--skip-memory', action = 'store_true', help = 'do not measure memory use')
+    arguments = parser.parse_args()
+
+    results = Results()
+    with tempfile.TemporaryDirectory() as folder:
+        for track_count in arguments.sizes:
+            benchmark_library(track_count, folder, results)
+            benchmark_startup(track_count, folder, results)
+            if player.numpy is not None:
+                benchmark_radio(track_count, results)
+        benchmark_history(folder, results)
+        if not arguments.skip_memory:
+            for track_count in arguments.sizes:
+                benchmark_memory(track_count, folder, results)
+        if not arguments.skip_playback:
+            with contextlib.redirect_stdout(io.StringIO()): # Hides the 'Now playing' messages.
+                benchmark_playback(folder, results)
+
+    with open(arguments.output, 'w') as writer:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results.rows
+        }, writer, indent = 4)
+    print(f'\nResults written to {arguments.output}')
+
+    if arguments.compare:
+        compare(results, arguments.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Tests for the control server started with --serve, driven over a real localhost socket by a stand-in client.
+# Run with: python -m unittest test_control_server
+
+import os # Used to run the player in a folder of its own.
+import sys # Used to find the player next to this file.
+import json # Used to write requests and read responses.
+import shutil # Used to copy the example library.
+import socket # Used to find a free port.
+import asyncio # Used to run the server and the client.
+import tempfile # Used for the folder the player saves into.
+import unittest
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') # Tracks are played without a sound card.
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_FOLDER)
+import DavionFranklin_FinalProject as app
+
+RESPONSE_TIMEOUT = 10 # Seconds a response or a change of playback state may take.
+
+# Loads a copy of the example library in a temporary folder, so the tests never change the real one.
+def setUpModule():
+    global folder, working_folder
+    working_folder = os.getcwd()
+    folder = tempfile.mkdtemp()
+    shutil.copy(os.path.join(SCRIPT_FOLDER, app.DATABASE_FILE), folder)
+    os.chdir(folder)
+    app.MUSIC_ROOTS = [SCRIPT_FOLDER] # The example tracks are next to the script.
+    app.load_data()
+
+def tearDownModule():
+    if app.player.thread is not None:
+        app.player.send('quit')
+        app.player.wait()
+    if app.music_library.features is not None:
+        app.music_library.features.stop()
+    app.music_library.history.close()
+    os.chdir(working_folder)
+    shutil.rmtree(folder, ignore_errors = True)
+
+# Port nothing is listening on.
+def free_port():
+    with socket.socket() as probe:
+        probe.bind((app.CONTROL_HOST, 0))
+        return probe.getsockname()[1]
+
+# Whether the track file of a listed song or single is next to the script.
+def track_exists(listed):
+    return os.path.exists(os.path.join(SCRIPT_FOLDER, listed['item']['file_name']))
+
+class ControlServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.port = free_port()
+        self.server = asyncio.create_task(ControlServerTest.serve(self.port))
+        for attempt in range(100): # Waits for the server to start listening.
+            try:
+                self.reader, self.writer = await asyncio.open_connection(app.CONTROL_HOST, self.port)
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.05)
+        else:
+            self.fail('The control server did not start.')
+        self.next_id = 1
+
+    async def asyncTearDown(self):
+        await self.request({'cmd': 'stop'})
+        self.writer.close()
+        self.server.cancel()
+        try:
+            await self.server
+        except asyncio.CancelledError:
+            pass
+        app.player.wait()
+
+    @staticmethod
+    async def serve(port):
+        await app.ControlServer(app.music_library, app.player).serve_forever(app.CONTROL_HOST, port)
+
+    # Sends one line and returns the response to it.
+    async def send_line(self, line):
+        self.writer.write(line + b'\n')
+        await self.writer.drain()
+        while True:
+            response = json.loads(await asyncio.wait_for(self.reader.readline(), RESPONSE_TIMEOUT))
+            if 'event' not in response: # Playback events can arrive in between.
+                return response
+
+    # Sends a request and returns the response to it, which must have the same id.
+    async def request(self, request):
+        request = dict(request, id = self.next_id)
+        self.next_id += 1
+        response = await self.send_line(json.dumps(request).encode('utf-8'))
+        self.assertEqual(response['id'], request['id'])
+        return response
+
+    # Result of a request that must succeed.
+    async def result(self, request):
+        response = await self.request(request)
+        self.assertTrue(response['ok'], response.get('error'))
+        return response['result']
+
+    # Asks for the playback state until it passes a check.
+    async def wait_for_state(self, check):
+        for attempt in range(RESPONSE_TIMEOUT * 20):
+            state = await self.result({'cmd': 'state'})
+            if check(state):
+                return state
+            await asyncio.sleep(0.05)
+        self.fail(f'Playback state never changed, last state: {state}')
+
+    async def test_play_and_stop(self):
+        singles = await self.result({'cmd': 'list', 'type': 'single'})
+        single = [single for single in singles if track_exists(single)][0]
+        await self.result({'cmd': 'play', 'type': 'single', 'key': single['key']})
+        state = await self.wait_for_state(lambda state: state['playing'] is not None)
+        self.assertEqual(state['playing']['name'], single['item']['name'])
+
+        await self.result({'cmd': 'stop'})
+        await self.wait_for_state(lambda state: state['playing'] is None)
+
+    async def test_queue_changes(self):
+        album = (await self.result({'cmd': 'list', 'type': 'album'}))[0]
+        songs = await self.result({'cmd': 'list', 'type': 'song', 'album': album['key']})
+        first, second = [song for song in songs if track_exists(song)][:2] # Missing tracks would be skipped.
+        self.assertEqual(await self.result({'cmd': 'queue'}), [])
+
+        await self.result({'cmd': 'queue', 'type': 'song', 'album': album['key'], 'key': first['key']})
+        entries = await self.result({'cmd': 'queue', 'type': 'song', 'album': album['key'], 'key': second['key']})
+        self.assertEqual([entry['key'] for entry in entries], [first['key'], second['key']])
+
+        response = await self.request({'cmd': 'play', 'queue': True, 'position': 99})
+        self.assertFalse(response['ok'])
+        await self.result({'cmd': 'play', 'queue': True})
+        state = await self.wait_for_state(lambda state: state['playing'] is not None)
+        self.assertTrue(state['from_queue'])
+        self.assertEqual(state['playing']['name'], first['item']['name'])
+
+        entries = await self.result({'cmd': 'unqueue', 'position': 2})
+        self.assertEqual([entry['key'] for entry in entries], [first['key']])
+        entries = await self.result({'cmd': 'unqueue', 'position': 1})
+        self.assertEqual(entries, [])
+
+        response = await self.request({'cmd': 'unqueue', 'position': 1})
+        self.assertFalse(response['ok'])
+        response = await self.request({'cmd': 'queue', 'type': 'album', 'key': album['key']})
+        self.assertFalse(response['ok'])
+
+    async def test_add_and_delete_are_checked(self):
+        response = await self.request({'cmd': 'add', 'type': 'single', 'item': {}})
+        self.assertFalse(response['ok'])
+        self.assertIn('name', response['error'])
+        response = await self.request({'cmd': 'delete', 'type': 'single', 'key': 999999})
+        self.assertFalse(response['ok'])
+
+        album = (await self.result({'cmd': 'list', 'type': 'album'}))[0]
+        item = {'name': 'Server Test', 'artist': 'Tester', 'release_date': '01-01-2026'}
+        key = await self.result({'cmd': 'add', 'type': 'song', 'album': album['key'], 'item': item})
+        songs = await self.result({'cmd': 'list', 'type': 'song', 'album': album['key']})
+        added = [song for song in songs if song['key'] == key][0]
+        self.assertEqual(added['item']['album'], album['item']['name'])
+        await self.result({'cmd': 'delete', 'type': 'song', 'album': album['key'], 'key': key})
+        response = await self.request({'cmd': 'delete', 'type': 'song', 'album': album['key'], 'key': key})
+        self.assertFalse(response['ok'])
+
+    async def test_malformed_line_keeps_connection(self):
+        response = await self.send_line(b'{"cmd": "state"')
+        self.assertFalse(response['ok'])
+        self.assertIsNone(response['id'])
+        self.assertTrue(response['error'])
+
+        response = await self.request({'cmd': 'dance'})
+        self.assertFalse(response['ok'])
+        self.assertIn('dance', response['error'])
+
+        response = await self.send_line(b'[1, 2]')
+        self.assertFalse(response['ok'])
+
+        # The same connection still answers.
+        self.assertIn('playing', await self.result({'cmd': 'state'}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Tests for recovering the journal after a crash or a failed compaction, and for the order kept by PositionalView.
+# Run with: python -m unittest test_storage
+
+import os # Used to run each test in a folder of its own.
+import sys # Used to find the player next to this file.
+import json # Used to write an empty database.
+import random # Used to pick the list operations.
+import shutil # Used to remove the test folders.
+import tempfile # Used for the folder the database is saved into.
+import unittest
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') # Nothing is played, the player module is only imported.
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_FOLDER)
+import DavionFranklin_FinalProject as app
+
+class JournalRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.working_folder = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        with open(app.DATABASE_FILE, 'w') as database:
+            json.dump({'albums': {}, 'singles': {}}, database)
+        self.compact_after = app.COMPACT_AFTER
+        self.write_database = app.write_database
+        self.stores = []
+
+    def tearDown(self):
+        app.COMPACT_AFTER = self.compact_after
+        app.write_database = self.write_database
+        for store in self.stores: # The player keeps its journal open until it exits.
+            if store.journal.writer is not None:
+                store.journal.writer.close()
+        os.chdir(self.working_folder)
+        shutil.rmtree(self.folder, ignore_errors = True)
+
+    # Loads the library the way the player does after a restart.
+    def restart(self):
+        library = app.Library()
+        store = app.JsonStore(app.DATABASE_FILE, app.JOURNAL_FILE)
+        store.load(library)
+        library.store = store
+        self.stores.append(store)
+        return library
+
+    # Adds a single and saves the change, waiting for a compaction it started.
+    def add(self, library, name):
+        library.add_music_item('single', app.Single(name, 'Tester', '01-01-2026', None), None)
+        library.store.commit(library)
+        if library.store.compactor is not None:
+            library.store.compactor.join()
+
+    def names(self, library):
+        return sorted(single.name for single in library.singles.values())
+
+    # Makes the next failures snapshot writes fail as if the disk were full.
+    def fail_writes(self, failures):
+        def write_database(path, data):
+            if failures:
+                failures.pop()
+                raise OSError('disk full')
+            return self.write_database(path, data)
+        app.write_database = write_database
+
+    def test_truncated_last_line_is_dropped(self):
+        library = self.restart()
+        self.add(library, 'a')
+        self.add(library, 'b')
+        with open(app.JOURNAL_FILE, 'a') as journal: # The player stopped halfway through writing a change.
+            journal.write('{"op": "add", "ty')
+
+        library = self.restart()
+        self.assertEqual(self.names(library), ['a', 'b'])
+        self.add(library, 'c')
+        self.assertEqual(self.names(self.restart()), ['a', 'b', 'c'])
+
+    def test_restart_after_failed_compaction(self):
+        app.COMPACT_AFTER = 3
+        failures = [True]
+        self.fail_writes(failures)
+        library = self.restart()
+        for name in 'abcdef':
+            self.add(library, name)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.names(self.restart()), list('abcdef'))
+
+    def test_restart_after_two_failed_compactions(self):
+        app.COMPACT_AFTER = 3
+        failures = [True, True]
+        self.fail_writes(failures)
+        library = self.restart()
+        for name in 'abcd':
+            self.add(library, name)
+        self.assertEqual(failures, [])
+        self.assertTrue(os.path.exists(app.JOURNAL_FILE + '.compacting'))
+
+        library = self.restart()
+        self.assertEqual(self.names(library), list('abcd'))
+        self.add(library, 'e')
+        self.assertEqual(self.names(self.restart()), list('abcde'))
+
+class PositionalViewTest(unittest.TestCase):
+    # Runs random changes on a view and a plain list and checks that they always agree.
+    def test_matches_plain_list(self):
+        generator = random.Random(7)
+        keys = list(range(1, 41))
+        view = app.PositionalView(keys)
+        next_key = len(keys) + 1
+        for step in range(2000):
+            operation = generator.choice(['append', 'insert', 'remove', 'move'])
+            if operation == 'append':
+                view.append(next_key)
+                keys.append(next_key)
+                next_key += 1
+            elif operation == 'insert':
+                position = generator.randint(1, len(keys) + 1)
+                view.insert_at(position, next_key)
+                keys.insert(position - 1, next_key)
+                next_key += 1
+            elif keys and operation == 'remove':
+                key = generator.choice(keys)
+                view.remove(key)
+                keys.remove(key)
+            elif keys:
+                key = generator.choice(keys)
+                position = generator.randint(1, len(keys))
+                view.move(key, position)
+                keys.remove(key)
+                keys.insert(position - 1, key)
+
+            self.assertEqual(len(view), len(keys))
+            if keys:
+                key = generator.choice(keys)
+                self.assertEqual(view.position(key), keys.index(key) + 1)
+                position = generator.randint(1, len(keys))
+                self.assertEqual(view.key_at(position), keys[position - 1])
+                self.assertEqual(list(view.keys_from(position)), keys[position - 1:])
+        self.assertEqual(list(view), keys)
+        with self.assertRaises(IndexError):
+            view.key_at(len(keys) + 1)
+
+if __name__ == '__main__':
+    unittest.main()